@@ -1,20 +1,28 @@
-from rest_framework import viewsets, status, permissions, serializers
+from rest_framework import viewsets, status, permissions, serializers, exceptions
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.conf import settings
 from django.contrib.auth import get_user_model, authenticate
+from django.db import transaction
 from django.shortcuts import get_object_or_404
-from .models import Conversation, Message, ChatRequest, Profile, MessageReaction
+from .models import Conversation, Message, ChatRequest, Profile
 from .serializers import (
     UserSerializer, ConversationSerializer, MessageSerializer,
-    ChatRequestSerializer, ProfileSerializer, MessageReactionSerializer
+    ChatRequestSerializer, ProfileSerializer, MessageReactionSerializer,
+    serialize_archived_messages
 )
+from .archive import message_page
+from .views import parse_disappearing
+from .throttling import throttle_scope
+from . import list_cache, polling, presence, sync, throttling, user_search
 
 User = get_user_model()
 
 
 # Authentication Views
+@throttle_scope('auth')
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def register_api(request):
@@ -39,6 +47,7 @@ def register_api(request):
     }, status=status.HTTP_201_CREATED)
 
 
+@throttle_scope('auth')
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def login_api(request):
@@ -65,49 +74,174 @@ def current_user_api(request):
     return Response(UserSerializer(request.user).data)
 
 
+@throttle_scope('search')
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def user_search_api(request):
+    """
+    Users to send a chat request to: ?q=<part of a username or name>, matched
+    by prefix and tolerant of typos (see chat/user_search.py). Users already
+    in a conversation with the caller are left out.
+    """
+    users = user_search.search_users(request.user, request.query_params.get('q', ''))
+    return Response(UserSerializer(users, many=True).data)
+
+
+@throttle_scope('poll')
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def sync_api(request):
+    """
+    Account-wide delta sync (see chat/sync.py).
+
+    Without `since` (or with an expired one) returns {"reset": true, "token": ...}:
+    the client reloads everything, then syncs from that token. With
+    `since=<token>` returns what changed since, across all conversations:
+    messages (current state), deleted (ids to drop), reactions and read
+    (deltas, safe to apply twice) and conversations (current list entries).
+    Follow `token` while has_more is true; `limit` caps events per page.
+    """
+    since = request.query_params.get('since')
+    try:
+        seq = sync.read_token(since) if since else None
+    except sync.InvalidSyncToken:
+        return Response({'error': 'Invalid sync token'}, status=status.HTTP_400_BAD_REQUEST)
+    if seq is None or sync.is_expired(seq):
+        return Response({'reset': True, 'token': sync.make_token(sync.current_seq()), 'has_more': False})
+
+    page_size = getattr(settings, 'SYNC_PAGE_SIZE', 500)
+    try:
+        limit = max(1, min(int(request.query_params.get('limit', page_size)), page_size))
+    except ValueError:
+        limit = page_size
+    presence.touch(request.user.id)
+    changes, seq, has_more = sync.changes_since(request.user, seq, limit)
+    return Response({
+        'reset': False,
+        'token': sync.make_token(seq),
+        'has_more': has_more,
+        'messages': MessageSerializer(changes['messages'], many=True).data,
+        'deleted': changes['deleted'],
+        'reactions': changes['reactions'],
+        'read': changes['read'],
+        'conversations': ConversationSerializer(changes['conversations'], many=True, context={'request': request}).data,
+    })
+
+
+@throttle_scope('poll')
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def presence_api(request):
+    """
+    POST: heartbeat, marks the user online. GET ?users=1,2,3: which of those
+    users are online, as {user id: last seen (unix time)}. Only users who
+    share a conversation with the caller are reported.
+    """
+    presence.touch(request.user.id)
+    if request.method == 'POST':
+        return Response({'status': 'ok'})
+    try:
+        user_ids = {int(user_id) for user_id in request.query_params.get('users', '').split(',') if user_id}
+    except ValueError:
+        return Response({'error': 'users must be a comma separated list of ids'}, status=status.HTTP_400_BAD_REQUEST)
+    user_ids &= set(
+        Conversation.participants.through.objects
+        .filter(conversation__participants=request.user, user_id__in=user_ids)
+        .values_list('user_id', flat=True)
+    )
+    return Response({'online': presence.last_seen(user_ids)})
+
+
 # Conversation ViewSet
 class ConversationViewSet(viewsets.ModelViewSet):
     """API endpoints for conversations"""
     serializer_class = ConversationSerializer
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'api'  # the polling actions use 'poll'
     
     def get_queryset(self):
-        print(f"DEBUG: Fetching conversations for user: {self.request.user}")
-        queryset = Conversation.objects.filter(participants=self.request.user)
-        print(f"DEBUG: Found {queryset.count()} conversations")
-        return queryset
+        return Conversation.objects.filter(participants=self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Conversation list, served from the per-user list cache (chat/list_cache.py)
+        while none of the user's conversations changed; If-None-Match gets a 304
+        """
+        version = list_cache.version(request.user)
+        etag = sync.etag('conversations', version, request.user, request)
+        not_modified = sync.not_modified(request, etag)
+        if not_modified:
+            return not_modified
+        data = list_cache.cached(request, version)
+        if data is None:
+            # Read from the same database as the version, so the entry matches it
+            data = super().list(request, *args, **kwargs).data
+            list_cache.store(request, version, data)
+        return Response(data, headers={'ETag': etag})
     
-    @action(detail=True, methods=['get'])
+    @action(detail=True, methods=['get'], throttle_scope='poll')
     def messages(self, request, pk=None):
-        """Get messages for a conversation"""
+        """
+        Get messages for a conversation (?before=<message id> pages back through
+        history); X-Poll-Interval says when to poll next (chat/polling.py)
+        """
         conversation = self.get_object()
+        presence.touch(request.user.id)
+        version, changed_at = sync.conversation_state(conversation.id, request.user)
+        etag = sync.etag('messages', version, request.user, request)
+        not_modified = sync.not_modified(request, etag)
+        if not_modified:
+            return polling.hint(not_modified, request, changed_at)
+        try:
+            before = int(request.query_params['before'])
+        except (KeyError, ValueError):
+            before = None
         
         # To support real-time deletions and reactions for existing messages,
         # we return the latest 50 messages. The client handles deduplication.
-        queryset = conversation.messages.order_by('-timestamp')[:50]
-        
-        # We want the messages in chronological order for the client to process
-        # (Though usually chat views show reverse, we'll keep the order consistent)
-        messages = sorted(list(queryset), key=lambda x: x.timestamp)
-        
+        # Older pages transparently include archived (cold) messages.
         # Filter logic: if deleted for everyone, show for everyone (serializer handles content)
         # If deleted for me personally, skip.
-        messages = [
-            msg for msg in messages
-            if request.user not in msg.deleted_by.all()
-        ]
+        queryset = (
+            conversation.messages.unexpired().exclude(deleted_by=request.user)
+            .select_related('sender__profile', 'parent')
+            .prefetch_related('reactions__user__profile', 'deleted_by')
+        )
+        messages, archived = message_page(conversation, request.user, before_id=before, limit=50, queryset=queryset)
         
-        serializer = MessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        data = MessageSerializer(messages, many=True).data + serialize_archived_messages(archived, conversation.id)
+        # We want the messages in chronological order for the client to process
+        data.sort(key=lambda m: m['id'])
+        return polling.hint(Response(data, headers={'ETag': etag}), request, changed_at)
+
+    @action(detail=True, methods=['post'])
+    def disappearing(self, request, pk=None):
+        """Set the disappearing-message timer: {"seconds": <one of DISAPPEARING_MESSAGE_TIMERS> or null, "after": "sent"|"read"}"""
+        conversation = self.get_object()
+        try:
+            seconds, after = parse_disappearing(request.data.get('seconds'),
+                                                request.data.get('after', Conversation.AFTER_SEND))
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        conversation.set_disappearing(seconds, after)
+        return Response({'disappearing_seconds': conversation.disappearing_seconds,
+                         'disappearing_after': conversation.disappearing_after})
+
+    @action(detail=True, methods=['get', 'post'], url_path='presence', throttle_scope='poll')
+    def presence_state(self, request, pk=None):
+        """Online/typing state of the other participants; POST {"typing": true|false} reports the user's own typing"""
+        conversation = self.get_object()
+        if request.method == 'POST':
+            presence.set_typing(conversation.id, request.user.id, bool(request.data.get('typing', True)))
+        else:
+            presence.touch(request.user.id)
+        participant_ids = conversation.participants.values_list('id', flat=True)
+        return Response(presence.conversation_state(conversation.id, list(participant_ids), request.user.id))
 
     @action(detail=True, methods=['post'])
     def mark_as_read(self, request, pk=None):
         """Mark all messages in a conversation as read by the current user"""
-        conversation = self.get_object()
-        unread_messages = conversation.messages.exclude(sender=request.user).exclude(read_by=request.user)
-        for msg in unread_messages:
-            msg.read_by.add(request.user)
-        return Response({'status': 'Conversation marked as read'})
+        return mark_conversation_read(request.user, self.get_object())
 
 
 # Message ViewSet
@@ -117,47 +251,147 @@ class MessageViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        return Message.objects.filter(conversation__participants=self.request.user)
+        return Message.objects.unexpired().filter(conversation__participants=self.request.user)
+
+    @property
+    def throttle_scope(self):
+        return 'send' if self.action == 'create' else 'api'
     
     def perform_create(self, serializer):
-        parent = serializer.validated_data.get('parent')
-        if parent and parent.is_deleted:
-             raise serializers.ValidationError("Cannot reply to a deleted message")
+        check_reply_parent(serializer)
         serializer.save(sender=self.request.user)
     
     @action(detail=True, methods=['post'])
     def delete_message(self, request, pk=None):
         """Delete a message (for me or for everyone)"""
-        message = self.get_object()
-        delete_type = request.data.get('delete_type', 'for_me')
-        
-        if delete_type == 'for_everyone':
-            if message.sender == request.user:
-                message.is_deleted = True
-                message.save()
-                return Response({'status': 'Message deleted for everyone'})
-            return Response({'error': 'Only sender can delete for everyone'}, status=status.HTTP_403_FORBIDDEN)
-        else:
-            message.deleted_by.add(request.user)
-            return Response({'status': 'Message deleted for you'})
+        return delete_message_for(request.user, self.get_object(), request.data.get('delete_type', 'for_me'))
     
     @action(detail=True, methods=['post'])
     def react(self, request, pk=None):
         """Add or remove a reaction"""
-        message = self.get_object()
-        emoji = request.data.get('emoji', '👍')
-        
-        reaction, created = MessageReaction.objects.get_or_create(
-            message=message,
-            user=request.user,
-            emoji=emoji
-        )
-        
-        if not created:
-            reaction.delete()
-            return Response({'status': 'Reaction removed'})
-        
-        return Response({'status': 'Reaction added', 'reaction': MessageReactionSerializer(reaction).data})
+        return toggle_message_reaction(request.user, self.get_object(), request.data.get('emoji', '👍'))
+
+
+# Message/conversation actions, shared by the ViewSets and batch_api
+def check_reply_parent(serializer):
+    parent = serializer.validated_data.get('parent')
+    if parent and parent.is_deleted:
+         raise serializers.ValidationError("Cannot reply to a deleted message")
+
+
+def mark_conversation_read(user, conversation):
+    conversation.mark_as_read(user)
+    return Response({'status': 'Conversation marked as read'})
+
+
+def delete_message_for(user, message, delete_type):
+    if delete_type == 'for_everyone':
+        if message.sender_id == user.id:
+            message.delete_for_everyone()
+            return Response({'status': 'Message deleted for everyone'})
+        return Response({'error': 'Only sender can delete for everyone'}, status=status.HTTP_403_FORBIDDEN)
+    else:
+        message.deleted_by.add(user)
+        return Response({'status': 'Message deleted for you'})
+
+
+def toggle_message_reaction(user, message, emoji):
+    reaction, created = message.toggle_reaction(user, emoji)
+    
+    if not created:
+        return Response({'status': 'Reaction removed'})
+    
+    return Response({'status': 'Reaction added', 'reaction': MessageReactionSerializer(reaction).data})
+
+
+# Batch operations: op name -> the kind of object it targets
+BATCH_OPERATIONS = {
+    'send': 'conversation',
+    'mark_as_read': 'conversation',
+    'react': 'message',
+    'delete_message': 'message',
+}
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def batch_api(request):
+    """
+    Run several message/conversation actions in one round trip.
+
+    Body: {"operations": [
+        {"op": "send", "conversation": 1, "content": "hi", "parent": null},
+        {"op": "react", "message": 7, "emoji": "👍"},
+        {"op": "mark_as_read", "conversation": 1},
+        {"op": "delete_message", "message": 7, "delete_type": "for_me"}]}
+
+    Returns {"results": [{"status": ..., "data": ...}, ...]} in the same order,
+    each matching what the single-operation endpoint would have answered,
+    429 included: every operation spends a token of that endpoint's bucket.
+    Everything runs in one transaction. A failing operation is rolled back
+    on its own and the others still apply. Operations can only target
+    conversations and messages that existed before the batch.
+    """
+    operations = request.data.get('operations') if isinstance(request.data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return Response({'error': 'operations must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = getattr(settings, 'BATCH_MAX_OPERATIONS', 50)
+    if len(operations) > limit:
+        return Response({'error': f'At most {limit} operations per batch'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # One permission pass: load every target the batch names, restricted to the user's conversations
+    ids = {'conversation': set(), 'message': set()}
+    for op in operations:
+        target = BATCH_OPERATIONS.get(op.get('op')) if isinstance(op, dict) else None
+        try:
+            ids[target].add(int(op[target]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    targets = {
+        'conversation': Conversation.objects.filter(participants=request.user).in_bulk(ids['conversation']),
+        'message': Message.objects.unexpired().filter(conversation__participants=request.user).in_bulk(ids['message']),
+    }
+
+    results = []
+    with transaction.atomic():
+        for op in operations:
+            savepoint = transaction.savepoint()
+            try:
+                response = run_batch_operation(request, op, targets)
+            except exceptions.APIException as exc:
+                response = Response(exc.detail, status=exc.status_code)
+            if response.status_code >= 400:
+                transaction.savepoint_rollback(savepoint)
+            else:
+                transaction.savepoint_commit(savepoint)
+            results.append({'status': response.status_code, 'data': response.data})
+    return Response({'results': results})
+
+
+def run_batch_operation(request, op, targets):
+    name = op.get('op') if isinstance(op, dict) else None
+    target = BATCH_OPERATIONS.get(name)
+    if target is None:
+        return Response({'error': f'Unknown operation: {name}'}, status=status.HTTP_400_BAD_REQUEST)
+    wait = throttling.take('send' if name == 'send' else throttling.DEFAULT_SCOPE, throttling.client_id(request))
+    if wait:
+        return Response({'detail': throttling.throttled_detail(wait)}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+    try:
+        obj = targets[target][int(op[target])]
+    except (KeyError, TypeError, ValueError):
+        return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    if name == 'send':
+        serializer = MessageSerializer(data={**op, 'conversation': obj.id}, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        check_reply_parent(serializer)
+        serializer.save(sender=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    if name == 'mark_as_read':
+        return mark_conversation_read(request.user, obj)
+    if name == 'react':
+        return toggle_message_reaction(request.user, obj, op.get('emoji', '👍'))
+    return delete_message_for(request.user, obj, op.get('delete_type', 'for_me'))
 
 
 # ChatRequest ViewSet
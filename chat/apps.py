@@ -3,3 +3,14 @@ from django.apps import AppConfig
 
 class ChatConfig(AppConfig):
     name = 'chat'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from . import authentication, sync, tasks, user_search
+        from .metrics import install_query_recorder
+
+        connection_created.connect(install_query_recorder, dispatch_uid='chat.metrics.install_query_recorder')
+        authentication.connect_signals()
+        sync.connect_signals()
+        tasks.connect_signals()
+        user_search.connect_signals()
@@ -0,0 +1,207 @@
+"""
+Hot/cold message archival.
+
+Messages older than settings.MESSAGE_ARCHIVE_AFTER_DAYS are moved out of
+chat_message (together with their read_by, deleted_by and reaction rows)
+into compressed ArchivedSegment rows, so the hot tables and their indexes
+stay small. History pagination reads them back through message_page().
+
+Segments never hold what "delete for everyone" is meant to destroy: a
+tombstone stays hot until the purge (chat/purge.py) has dropped its content
+and file, a deleted parent's content is not copied into its replies, and
+the purge paths blank the quote in archived replies whose parent they
+remove (forget_archived_parents).
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from . import events
+from .models import ArchivedSegment, Message, MessageReaction, SyncEvent
+
+
+def archivable_messages(cutoff):
+    # A message with replies still in hot storage stays hot: deleting it
+    # would SET_NULL their parent link. It follows once the replies go.
+    # Disappearing messages stay hot until the sweeper deletes them, and
+    # tombstones until the purge has dropped their content and file.
+    return Message.objects.filter(
+        Q(is_deleted=False) | Q(content__isnull=True, file=''),
+        timestamp__lt=cutoff, replies__isnull=True, expires_at__isnull=True, expires_after_read__isnull=True,
+    )
+
+
+def _user_ids_by_message(through, message_ids):
+    result = defaultdict(list)
+    for message_id, user_id in through.objects.filter(message_id__in=message_ids).values_list('message_id', 'user_id'):
+        result[message_id].append(user_id)
+    return result
+
+
+def archive_conversation_batch(conversation_id, cutoff, batch_size):
+    """Moves up to batch_size of the oldest archivable messages of one conversation into a segment."""
+    with transaction.atomic():
+        messages = list(
+            archivable_messages(cutoff)
+            .filter(conversation_id=conversation_id)
+            .select_related('parent')
+            .order_by('id')[:batch_size]
+        )
+        if not messages:
+            return 0
+
+        ids = [m.id for m in messages]
+        read_by = _user_ids_by_message(Message.read_by.through, ids)
+        deleted_by = _user_ids_by_message(Message.deleted_by.through, ids)
+        reactions = defaultdict(list)
+        for reaction in MessageReaction.objects.filter(message_id__in=ids).values(
+                'id', 'message_id', 'user_id', 'emoji', 'created_at'):
+            reactions[reaction.pop('message_id')].append({
+                **reaction, 'created_at': reaction['created_at'].isoformat(),
+            })
+
+        records = [{
+            'id': m.id,
+            'sender_id': m.sender_id,
+            'content': m.content,  # stays encrypted
+            'file': m.file.name or None,
+            'is_audio': m.is_audio,
+            'has_thumbnail': m.has_thumbnail,
+            'parent_id': m.parent_id,
+            'parent_content': m.parent.content if m.parent and not m.parent.is_deleted else None,
+            'timestamp': m.timestamp.isoformat(),
+            'is_deleted': m.is_deleted,
+            'deleted_by': deleted_by[m.id],
+            'read_by': read_by[m.id],
+            'reactions': reactions[m.id],
+        } for m in messages]
+
+        ArchivedSegment.objects.create(
+            conversation_id=conversation_id,
+            first_message_id=messages[0].id,
+            last_message_id=messages[-1].id,
+            first_timestamp=messages[0].timestamp,
+            last_timestamp=messages[-1].timestamp,
+            message_count=len(messages),
+            data=ArchivedSegment.pack(records),
+        )
+        # Cascades to reactions and the read_by/deleted_by join rows
+        Message.objects.filter(id__in=ids).delete()
+        # Moves the conversation's version stamp, so cached pages get refetched
+        SyncEvent.objects.create(conversation_id=conversation_id, kind=SyncEvent.CONVERSATION)
+        events.notify(conversation_id, SyncEvent.CONVERSATION)
+        return len(ids)
+
+
+def forget_archived_parents(messages):
+    """
+    Blanks the quoted content in archived replies to messages, given as
+    (message id, conversation id) pairs the caller is purging or deleting,
+    like a hot reply loses it with its parent. Replies are newer than their
+    parent, so only the conversation's later segments are read.
+    """
+    by_conversation = defaultdict(set)
+    for message_id, conversation_id in messages:
+        by_conversation[conversation_id].add(message_id)
+    for conversation_id, message_ids in by_conversation.items():
+        segments = ArchivedSegment.objects.filter(conversation_id=conversation_id,
+                                                  last_message_id__gt=min(message_ids))
+        for segment in segments:
+            records = segment.unpack()
+            quoting = [r for r in records if r['parent_id'] in message_ids and r['parent_content'] is not None]
+            for record in quoting:
+                record['parent_content'] = None
+            if quoting:
+                segment.data = ArchivedSegment.pack(records)
+                segment.save(update_fields=['data'])
+
+
+def archive_messages(older_than=None, batch_size=None, max_batches=None):
+    """Archives everything older than `older_than` (a timedelta), one transaction per batch. Returns the count."""
+    if older_than is None:
+        older_than = timedelta(days=getattr(settings, 'MESSAGE_ARCHIVE_AFTER_DAYS', 365))
+    batch_size = batch_size or getattr(settings, 'MESSAGE_ARCHIVE_BATCH_SIZE', 500)
+    cutoff = timezone.now() - older_than
+
+    total = batches = 0
+    conversation_ids = list(archivable_messages(cutoff).order_by().values_list('conversation_id', flat=True).distinct())
+    for conversation_id in conversation_ids:
+        while True:
+            archived = archive_conversation_batch(conversation_id, cutoff, batch_size)
+            total += archived
+            if archived:
+                batches += 1
+            if max_batches and batches >= max_batches:
+                return total
+            if archived < batch_size:
+                break
+    return total
+
+
+def load_archived_messages(conversation, user, before_id=None, limit=50):
+    """Newest-first archived records of a conversation, minus those `user` deleted for themselves."""
+    segments = conversation.archived_segments.defer('data').order_by('-last_message_id')
+    if before_id is not None:
+        segments = segments.filter(first_message_id__lt=before_id)
+
+    records = []
+    for segment in segments:
+        if len(records) >= limit and segment.last_message_id < records[limit - 1]['id']:
+            break
+        records.extend(
+            r for r in segment.unpack()
+            if (before_id is None or r['id'] < before_id) and user.id not in r['deleted_by']
+        )
+        records.sort(key=lambda r: r['id'], reverse=True)
+    return records[:limit]
+
+
+def _page_querysets(conversation, before_id, queryset):
+    hot = (queryset if queryset is not None else conversation.messages.unexpired()).order_by('-id')
+    segments = conversation.archived_segments.all()
+    if before_id is not None:
+        hot = hot.filter(id__lt=before_id)
+        segments = segments.filter(first_message_id__lt=before_id)
+    return hot, segments
+
+
+def _merge_page(hot, archived, limit):
+    page_ids = sorted([m.id for m in hot] + [r['id'] for r in archived], reverse=True)[:limit]
+    oldest = page_ids[-1] if page_ids else 0
+    return [m for m in hot if m.id >= oldest], [r for r in archived if r['id'] >= oldest]
+
+
+def _reaches_archive(hot, newest_archived, limit):
+    return newest_archived is not None and not (len(hot) == limit and hot[-1].id > newest_archived)
+
+
+def message_page(conversation, user, before_id=None, limit=50, queryset=None):
+    """
+    One page of history (the `limit` newest messages below before_id), merged
+    from hot and cold storage. Returns (hot Message list, archived records).
+    Cold storage is only read when the page actually reaches into it.
+    `queryset` optionally narrows/prefetches the conversation's hot messages
+    (it replaces the default conversation.messages.unexpired()).
+    """
+    hot, segments = _page_querysets(conversation, before_id, queryset)
+    hot = list(hot[:limit])
+    newest_archived = segments.aggregate(newest=Max('last_message_id'))['newest']
+    if not _reaches_archive(hot, newest_archived, limit):
+        return hot, []
+    return _merge_page(hot, load_archived_messages(conversation, user, before_id, limit), limit)
+
+
+async def amessage_page(conversation, user, before_id=None, limit=50, queryset=None):
+    """Async message_page(): the hot path uses the async ORM, cold storage (rare) runs in a thread."""
+    hot, segments = _page_querysets(conversation, before_id, queryset)
+    hot = [m async for m in hot[:limit]]
+    newest_archived = (await segments.aaggregate(newest=Max('last_message_id')))['newest']
+    if not _reaches_archive(hot, newest_archived, limit):
+        return hot, []
+    archived = await sync_to_async(load_archived_messages)(conversation, user, before_id, limit)
+    return _merge_page(hot, archived, limit)
@@ -0,0 +1,241 @@
+"""
+Async versions of the hot polling and messaging endpoints.
+
+Served only under ASGI (see private_messaging/asgi_urls.py): the database
+work uses Django's async ORM, so a waiting request holds no thread, and the
+CPU-bound decryption and serialization runs in a bounded thread pool of
+settings.ASYNC_CPU_WORKERS threads. DRF has no async views, so the API
+endpoints here authenticate the JWT themselves and answer in the same
+shape as the ViewSet actions they stand in for. Anything unusual (other
+methods, form uploads, invalid input) is handed to the DRF view, which
+keeps the error responses identical.
+
+The polling endpoints also long-poll: with `?wait=<seconds>` a request that
+would get a 304 is held until the conversation changes (announced on the
+event bus, chat/events.py, from any worker process) or the time is up.
+Like their sync versions they are rate limited (chat/throttling.py) and
+tell the client when to poll next (chat/polling.py).
+"""
+import asyncio
+import contextvars
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponse, JsonResponse
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+
+from . import api_views, events, metrics, polling, presence, renderers, sync
+from .archive import amessage_page
+from .authentication import CachedJWTAuthentication
+from .models import Conversation, Message
+from .serializers import MessageSerializer, serialize_archived_messages
+from .throttling import athrottled
+from .utils import encrypt_message
+from .views import message_json
+
+_executor = None
+
+
+def cpu_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ASYNC_CPU_WORKERS', 4), thread_name_prefix='chat-cpu')
+    return _executor
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """Runs fn in the CPU pool, keeping the request's context (metrics, routing) visible to it."""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor(), call)
+
+
+async def jwt_user(request):
+    """The user of a Bearer token, None without one. Raises AuthenticationFailed for a bad token."""
+    result = await sync_to_async(CachedJWTAuthentication().authenticate)(request)
+    if not result:
+        return None
+    request.api_user = result[0]  # for middleware that runs after the view (chat.profiling)
+    return result[0]
+
+
+def api_error(exc):
+    return JsonResponse({'detail': str(exc.detail)}, status=exc.status_code)
+
+
+async def api_response(request, data, status=200, headers=None):
+    """Renders data as MessagePack if the client asks for it (like DRF's negotiation), else JSON."""
+    if renderers.accepts_msgpack(request):
+        body = await run_cpu(renderers.packb, data)
+        return HttpResponse(body, status=status, headers=headers, content_type=renderers.MEDIA_TYPE)
+    return JsonResponse(data, safe=False, status=status, headers=headers, json_dumps_params={'ensure_ascii': False})
+
+
+def long_poll_seconds(request):
+    """?wait=<seconds>, capped at settings.EVENT_LONG_POLL_MAX_SECONDS; 0 without it"""
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        return 0
+    return max(0, min(wait, getattr(settings, 'EVENT_LONG_POLL_MAX_SECONDS', 25)))
+
+
+async def messages_etag(request, conversation_id, user):
+    """
+    (ETag, 304 response or None, time of the last change) of a conversation's
+    messages for user. With ?wait, a 304 is held back until the conversation
+    changes for user or the wait is over.
+    """
+    wait = long_poll_seconds(request)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    channels = [events.conversation_channel(conversation_id)] if wait else []
+    # Subscribed before reading the version, so a change in between still wakes us
+    async with events.listening(channels) as changed:
+        while True:
+            changed.clear()
+            version, changed_at = await sync.aconversation_state(conversation_id, user)
+            etag = sync.etag('messages', version, user, request)
+            not_modified = sync.not_modified(request, etag)
+            remaining = deadline - loop.time()
+            if not_modified is None or remaining <= 0:
+                return etag, not_modified, changed_at
+            started = loop.time()
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass  # one last check above, then the 304
+            stats = metrics.current_stats()
+            if stats is not None:
+                stats.wait_seconds += loop.time() - started
+
+
+@never_cache
+async def get_messages(request, pk):
+    """Async chat.views.get_messages"""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    throttled = await athrottled('poll', request, user)
+    if throttled:
+        return throttled
+    conversation = await Conversation.objects.filter(pk=pk, participants=user).afirst()
+    if conversation is None:
+        raise Http404
+    await presence.atouch(user.id)
+    etag, not_modified, changed_at = await messages_etag(request, conversation.id, user)
+    long_poll = bool(long_poll_seconds(request))
+    if not_modified:
+        return polling.hint(not_modified, request, changed_at, long_poll)
+    if polling.is_visible(request) and await sync_to_async(conversation.mark_as_read)(user):
+        version, changed_at = await sync.aconversation_state(conversation.id, user)
+        etag = sync.etag('messages', version, user, request)
+
+    msgs = [
+        m async for m in conversation.messages.unexpired().exclude(deleted_by=user)
+        .select_related('sender', 'parent__sender').order_by('-timestamp')[:50]
+    ]
+    data = await run_cpu(lambda: [message_json(m, user) for m in reversed(msgs)])
+    response = JsonResponse(data, safe=False, headers={'ETag': etag})
+    return polling.hint(response, request, changed_at, long_poll)
+
+
+@csrf_exempt
+async def conversation_messages(request, pk):
+    """Async ConversationViewSet.messages (GET /chat/api/conversations/<pk>/messages/)"""
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    try:
+        user = await jwt_user(request)
+    except exceptions.AuthenticationFailed as exc:
+        return api_error(exc)
+    if user is None:
+        return api_error(exceptions.NotAuthenticated())
+    throttled = await athrottled('poll', request, user)
+    if throttled:
+        return throttled
+    conversation = await Conversation.objects.filter(pk=pk, participants=user).afirst()
+    if conversation is None:
+        return api_error(exceptions.NotFound())
+    await presence.atouch(user.id)
+    etag, not_modified, changed_at = await messages_etag(request, conversation.id, user)
+    long_poll = bool(long_poll_seconds(request))
+    if not_modified:
+        return polling.hint(not_modified, request, changed_at, long_poll)
+    try:
+        before = int(request.GET['before'])
+    except (KeyError, ValueError):
+        before = None
+
+    queryset = (
+        conversation.messages.unexpired().exclude(deleted_by=user)
+        .select_related('sender__profile', 'parent')
+        .prefetch_related('reactions__user__profile', 'deleted_by')
+    )
+    messages, archived = await amessage_page(conversation, user, before_id=before, limit=50, queryset=queryset)
+
+    data = await run_cpu(lambda: MessageSerializer(messages, many=True).data)
+    if archived:
+        data += await sync_to_async(serialize_archived_messages)(archived, conversation.id)
+    data.sort(key=lambda m: m['id'])
+    response = await api_response(request, data, headers={'ETag': etag})
+    return polling.hint(response, request, changed_at, long_poll)
+
+
+message_list_view = api_views.MessageViewSet.as_view({'get': 'list', 'post': 'create'})
+
+
+def _send_payload(request):
+    """(conversation id, content, parent id, is_audio) of a plain JSON text message, else None."""
+    if request.method != 'POST' or request.content_type != 'application/json':
+        return None
+    try:
+        payload = json.loads(request.body)
+        conversation_id = int(payload['conversation'])
+        parent_id = payload.get('parent')
+        parent_id = int(parent_id) if parent_id is not None else None
+    except (ValueError, TypeError, KeyError):
+        return None
+    content = payload.get('content')
+    if not isinstance(content, str) or not content or payload.get('file'):
+        return None
+    return conversation_id, content, parent_id, payload.get('is_audio') is True
+
+
+@csrf_exempt
+async def message_list(request):
+    """Async send path of MessageViewSet.create (POST /chat/api/messages/); the rest goes to DRF."""
+    payload = _send_payload(request)
+    if payload is None:
+        return await sync_to_async(message_list_view)(request)
+    try:
+        user = await jwt_user(request)
+    except exceptions.AuthenticationFailed as exc:
+        return api_error(exc)
+    if user is None:
+        return api_error(exceptions.NotAuthenticated())
+
+    conversation_id, content, parent_id, is_audio = payload
+    conversation = await Conversation.objects.filter(pk=conversation_id, participants=user).afirst()
+    parent = (await Message.objects.filter(pk=parent_id, conversation_id=conversation_id).afirst()
+              if parent_id is not None else None)
+    if conversation is None or (parent_id is not None and (parent is None or parent.is_deleted)):
+        return await sync_to_async(message_list_view)(request)
+    # After the last hand-off to DRF, which throttles on its own
+    throttled = await athrottled('send', request, user)
+    if throttled:
+        return throttled
+
+    message = await Message.objects.acreate(
+        conversation=conversation, sender=user, parent=parent, is_audio=is_audio,
+        content=await run_cpu(encrypt_message, content),
+    )
+    data = await sync_to_async(lambda: MessageSerializer(message).data)()
+    return await api_response(request, data, status=201)
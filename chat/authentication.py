@@ -0,0 +1,146 @@
+"""
+Cached JWT authentication and a request-scoped identity map.
+
+CachedJWTAuthentication resolves the user of a token from a short-lived
+per-process cache instead of loading the User row on every API call. Its
+entries are keyed by user id and the user's token version, a counter kept in
+the shared Django cache. Saving a User (profile edits, password changes,
+last_login) or a Profile bumps the version. Every process then misses on its
+next lookup. With a per-process cache backend (locmem, the default), other
+processes only notice once AUTH_USER_CACHE_SECONDS have passed.
+
+The identity map lets a request load each user's Profile at most once, no
+matter how many nested serializers ask for it (see profile_for()). The
+authenticated user itself is resolved once per request by DRF.
+IdentityMapMiddleware opens it per request. Outside a request, lookups go
+straight to the database.
+"""
+import pickle
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import Profile
+
+# {(user id, version): (expires at, pickled user with its profile)}
+_users = {}
+_users_lock = threading.Lock()
+
+# {user id: Profile or None} for the current request. A dict is used so that
+# lookups made inside sync_to_async threads are shared.
+_identity_map = ContextVar('identity_map', default=None)
+
+
+def _version_key(user_id):
+    return f'auth:user-version:{user_id}'
+
+
+def token_version(user_id):
+    return cache.get(_version_key(user_id), 0)
+
+
+def invalidate_user(user_id):
+    """Drops every cached copy of a user (in all processes sharing the cache)."""
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), 1, None)
+    with _users_lock:
+        for key in [key for key in _users if key[0] == user_id]:
+            del _users[key]
+
+
+def _user_saved(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+def _profile_saved(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+def connect_signals():
+    """Hooked up in ChatConfig.ready"""
+    User = get_user_model()
+    post_save.connect(_user_saved, sender=User, dispatch_uid='chat.authentication.user_saved')
+    post_delete.connect(_user_saved, sender=User, dispatch_uid='chat.authentication.user_deleted')
+    post_save.connect(_profile_saved, sender=Profile, dispatch_uid='chat.authentication.profile_saved')
+    post_delete.connect(_profile_saved, sender=Profile, dispatch_uid='chat.authentication.profile_deleted')
+
+
+def cached_user(user_id):
+    """The user with its profile, from the per-process cache or the database. None if it doesn't exist."""
+    key = (user_id, token_version(user_id))
+    now = time.monotonic()
+    entry = _users.get(key)
+    if entry is None or entry[0] < now:
+        user = get_user_model().objects.select_related('profile').filter(pk=user_id).first()
+        if user is None:
+            return None
+        entry = (now + getattr(settings, 'AUTH_USER_CACHE_SECONDS', 30), pickle.dumps(user))
+        with _users_lock:
+            # Drop expired entries now and then so the dict can't grow without bound
+            if len(_users) >= getattr(settings, 'AUTH_USER_CACHE_SIZE', 10000):
+                for stale in [k for k, (expires, _) in _users.items() if expires < now] or list(_users):
+                    del _users[stale]
+            _users[key] = entry
+    # Each request gets its own instances, never ones shared with other threads
+    user = pickle.loads(entry[1])
+    remember(user)
+    return user
+
+
+def begin_request():
+    return _identity_map.set({})
+
+
+def end_request(token):
+    _identity_map.reset(token)
+
+
+def remember(user):
+    """Adds a user's loaded profile to the current request's identity map."""
+    identities = _identity_map.get()
+    if identities is not None and 'profile' in user._state.fields_cache:
+        identities.setdefault(user.pk, user._state.fields_cache['profile'])
+
+
+def profile_for(user):
+    """user.profile, loaded at most once per request per user. None if the user has none."""
+    if 'profile' in user._state.fields_cache:
+        return user._state.fields_cache['profile']
+    identities = _identity_map.get()
+    if identities is not None and user.pk in identities:
+        return identities[user.pk]
+    profile = Profile.objects.filter(user_id=user.pk).first()
+    if identities is not None:
+        identities[user.pk] = profile
+    return profile
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves users through cached_user()."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        user = cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+                api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed("The user's password has been changed.", code="password_changed")
+        return user
@@ -0,0 +1,74 @@
+"""
+Rendered message bubbles of conversation_detail.html
+(templates/chat/includes/message_bubble.html).
+
+The markup of a bubble is cached per message and viewer-relative flags,
+stored with version(), a fingerprint of what it shows. Message text never
+goes into the cache, which may be a file or a database table
+(PRIVATE_MESSAGING_CACHE). The template leaves SLOTS where the message and
+the quoted parent go, and render() fills them in, escaped, on every
+request. A cache hit still decrypts, but renders no template. Deleting or
+expiring a message drops its entries (forget()), and anything else that
+changes a bubble changes its version.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.html import escape, escapejs
+from django.utils.safestring import mark_safe
+
+TEMPLATE = 'chat/includes/message_bubble.html'
+# Private-use characters: usernames and stored file names cannot contain them
+SLOTS = {name: f'\ue000{name}\ue000' for name in ('content', 'parent_content', 'reply_text')}
+
+
+def version(message):
+    """
+    Fingerprint of everything a cached bubble shows, taken from the stored
+    ciphertext so it needs no decryption: edits, deletes, reactions and
+    changes to the replied-to message all change it.
+    """
+    parts = [message.content, message.file.name, message.is_audio, message.is_deleted, message.sender.username,
+             sorted(reaction.emoji for reaction in message.reactions.all()), message.expires_at,
+             None if message.is_deleted else message.thumbnail_url]
+    parent = message.parent
+    if parent is not None:
+        parts += [parent.id, parent.content, parent.is_deleted, parent.sender.username]
+    return hashlib.md5(repr(parts).encode(), usedforsecurity=False).hexdigest()
+
+
+def _key(message_id, is_mine, parent_is_mine):
+    return f'chat:bubble:{message_id}:{int(is_mine)}{int(parent_is_mine)}'
+
+
+def render(message):
+    """The bubble of message, whose is_mine and parent_is_mine the view has set."""
+    key = _key(message.id, message.is_mine, message.parent_is_mine)
+    current = version(message)
+    cached = cache.get(key)
+    if cached is not None and cached[0] == current:
+        markup = cached[1]
+    else:
+        markup = render_to_string(TEMPLATE, {'message': message, 'slots': SLOTS})
+        cache.set(key, (current, markup), getattr(settings, 'MESSAGE_FRAGMENT_CACHE_SECONDS', 3600))
+
+    # Only what the markup shows gets decrypted: deleted messages show nothing
+    fills = {
+        'content': lambda: escape(message.decrypted_content),
+        'parent_content': lambda: escape(message.parent.decrypted_content or message.parent.content),
+        'reply_text': lambda: escapejs(message.decrypted_content or message.content or ''),
+    }
+    for name, slot in SLOTS.items():
+        if slot in markup:
+            markup = markup.replace(slot, fills[name]())
+    return mark_safe(markup)
+
+
+def forget(message_ids):
+    """Drops the cached bubbles of messages that are deleted or about to be."""
+    cache.delete_many([
+        _key(message_id, is_mine, parent_is_mine)
+        for message_id in message_ids for is_mine in (False, True) for parent_is_mine in (False, True)
+    ])
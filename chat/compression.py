@@ -0,0 +1,133 @@
+"""
+Response compression negotiated by Accept-Encoding (see CompressionMiddleware).
+
+Brotli is used when the client accepts it and the brotli package (in
+requirements.txt) is installed, gzip otherwise. Only API payloads (COMPRESSION_CONTENT_TYPES)
+are compressed. HTML pages carry CSRF tokens, and compressing them would
+open them to BREACH-style attacks. Bodies smaller than
+COMPRESSION_MIN_BYTES are sent as they are: compression would save a few
+bytes and cost more in CPU time. Streaming responses are compressed chunk
+by chunk as they are sent.
+"""
+import importlib.util
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+DEFAULT_CONTENT_TYPES = ('application/json', 'application/msgpack')
+
+_brotli_available = None
+
+
+def brotli_available():
+    global _brotli_available
+    if _brotli_available is None:
+        _brotli_available = importlib.util.find_spec('brotli') is not None
+    return _brotli_available
+
+
+def accepted_encodings(header):
+    """The codings an Accept-Encoding header allows (q > 0)."""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if coding and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def choose_encoding(request):
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    if 'br' in accepted and brotli_available():
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def _brotli_compressor():
+    import brotli
+
+    return brotli.Compressor(quality=getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 4))
+
+
+def _brotli_sequence(chunks):
+    compressor = _brotli_compressor()
+    for chunk in chunks:
+        output = compressor.process(chunk)
+        if output:
+            yield output
+    yield compressor.finish()
+
+
+async def _abrotli_sequence(chunks):
+    compressor = _brotli_compressor()
+    async for chunk in chunks:
+        output = compressor.process(chunk)
+        if output:
+            yield output
+    yield compressor.finish()
+
+
+async def _agzip_sequence(chunks):
+    # compress_sequence() only takes sync iterators; like Django's
+    # GZipMiddleware, compress one gzip member per chunk
+    async for chunk in chunks:
+        yield compress_string(chunk)
+
+
+def _compressible(response):
+    if response.has_header('Content-Encoding') or response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type not in getattr(settings, 'COMPRESSION_CONTENT_TYPES', DEFAULT_CONTENT_TYPES):
+        return False
+    min_bytes = getattr(settings, 'COMPRESSION_MIN_BYTES', 1024)
+    if response.streaming:
+        length = response.get('Content-Length')
+        return length is None or int(length) >= min_bytes
+    return len(response.content) >= min_bytes
+
+
+def compress_response(request, response):
+    """Compresses response in place if the client and the content allow it. Returns it."""
+    if not _compressible(response):
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+
+    if response.streaming:
+        content = response.streaming_content
+        if response.is_async:
+            response.streaming_content = _abrotli_sequence(content) if encoding == 'br' else _agzip_sequence(content)
+        else:
+            response.streaming_content = _brotli_sequence(content) if encoding == 'br' else compress_sequence(content)
+        del response.headers['Content-Length']
+    else:
+        if encoding == 'br':
+            import brotli
+
+            compressed = brotli.compress(response.content, quality=getattr(settings, 'COMPRESSION_BROTLI_QUALITY', 4))
+        else:
+            compressed = compress_string(response.content)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response.headers['Content-Length'] = str(len(compressed))
+
+    # The body differs byte for byte from the uncompressed one
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response.headers['ETag'] = 'W/' + etag
+    response.headers['Content-Encoding'] = encoding
+    return response
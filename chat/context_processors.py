@@ -1,8 +1,18 @@
 from .models import Conversation
+from . import presence
 
 def conversations_processor(request):
     if request.user.is_authenticated:
+        conversations = Conversation.objects.filter(participants=request.user)
+        # Presence of everyone in the sidebar, read in bulk
+        pairs = list(
+            Conversation.participants.through.objects
+            .filter(conversation__in=conversations).exclude(user_id=request.user.id)
+            .values_list('conversation_id', 'user_id')
+        )
         return {
-            'all_conversations': Conversation.objects.filter(participants=request.user)
+            'all_conversations': conversations,
+            'online_user_ids': set(presence.last_seen({user_id for _, user_id in pairs})),
+            'typing_conversation_ids': {conversation_id for conversation_id, _ in presence.typing(pairs)},
         }
     return {'all_conversations': []}
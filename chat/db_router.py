@@ -0,0 +1,79 @@
+"""
+Primary/replica database routing.
+
+Writes always go to 'default'. Reads go to one of settings.DATABASE_REPLICAS,
+but only inside a request that ReplicaRoutingMiddleware has marked as
+read-only. Management commands, the shell and unsafe requests keep reading
+from the primary, so they always see their own writes.
+
+A request reads from one replica, picked when it begins. Replicas lag by
+different amounts, and a response built from two of them could pair a
+version stamp (ETag) with older data.
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Holds a small mutable dict per request. A dict (instead of plain values) is
+# used so that writes made inside sync_to_async threads are still visible to
+# the middleware that opened the request.
+_request_state = ContextVar('db_routing_state', default=None)
+
+
+def begin_request(use_primary):
+    """Start routing for a request. Returns a token for end_request()."""
+    replicas = get_replicas()
+    return _request_state.set({
+        'use_primary': use_primary, 'wrote': False, 'replica': random.choice(replicas) if replicas else None,
+    })
+
+
+def end_request(token):
+    """Stop routing for a request. Returns True if anything was written."""
+    state = _request_state.get()
+    _request_state.reset(token)
+    return bool(state and state['wrote'])
+
+
+def pin_to_primary():
+    """Send every remaining read of the current request to the primary."""
+    state = _request_state.get()
+    if state is not None:
+        state['use_primary'] = True
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class PrimaryReplicaRouter:
+    """Routes reads to replicas and writes to the primary database."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'django_cache':
+            # The database cache holds version stamps that must never lag behind
+            return 'default'
+        state = _request_state.get()
+        if state is None or state['use_primary'] or state['replica'] is None:
+            return 'default'
+        return state['replica']
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            # Read-your-writes: once this request writes, stop using replicas
+            state['wrote'] = True
+            state['use_primary'] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {'default', *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary (replication or
+        # `manage.py sync_replicas`), never from migrate.
+        return db == 'default'
@@ -0,0 +1,201 @@
+"""
+Publish/subscribe event bus that reaches every worker process.
+
+Writes publish a small notice (conversation, kind, message id; never
+content) on the conversation's channel with notify(), once the transaction
+commits. Waiters such as long-polling requests subscribe to the channels
+they care about and re-read the database when woken. The bus only says that
+something changed; SyncEvent stays the record of what changed.
+
+settings.EVENT_BUS selects the backend, by name or dotted path:
+
+- 'inprocess' (InProcessBus) delivers within the publishing process. It is
+  meant for tests and single-process servers.
+- 'unix' (UnixSocketBus) fans out to every process on the host. Each
+  process that has subscribers binds a Unix datagram socket in
+  EVENT_BUS_SOCKET_DIR, and publishing sends the notice to all of them. No
+  broker is involved. Delivery is best effort: a process that is too slow to
+  drain its socket misses events, and waiters fall back to their timeout.
+"""
+import asyncio
+import atexit
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = {
+    'inprocess': 'chat.events.InProcessBus',
+    'unix': 'chat.events.UnixSocketBus',
+}
+MAX_DATAGRAM = 64 * 1024
+
+
+def conversation_channel(conversation_id):
+    return f'conversation:{conversation_id}'
+
+
+class InProcessBus:
+    """Delivers events to the subscribers of this process only."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, callback):
+        """Calls callback(channel, payload) for each event on channel. Returns an unsubscribe function."""
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(callback)
+        return lambda: self._unsubscribe(channel, callback)
+
+    def _unsubscribe(self, channel, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(channel)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._subscribers[channel]
+
+    def deliver(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(channel, payload)
+            except Exception:
+                logger.exception("Event bus subscriber failed on %s", channel)
+
+    def publish(self, channel, payload):
+        self.deliver(channel, payload)
+
+
+class UnixSocketBus(InProcessBus):
+    """Fans events out to every process on this host through Unix datagram sockets."""
+
+    def __init__(self, directory=None):
+        super().__init__()
+        self.directory = str(directory or getattr(settings, 'EVENT_BUS_SOCKET_DIR'))
+        self.path = None  # this process's socket, bound by the first subscribe()
+        self._socket = None
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # A stalled receiver must not block the publishing request
+        self._sender.setblocking(False)
+
+    def subscribe(self, channel, callback):
+        self._listen()
+        return super().subscribe(channel, callback)
+
+    def _listen(self):
+        with self._lock:
+            if self._socket is not None:
+                return
+            # Only this user's processes may publish to, or listen on, the bus
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            path = os.path.join(self.directory, f'{os.getpid()}.sock')
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)  # left by an earlier process with the same pid
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.bind(path)
+            self._socket, self.path = receiver, path
+        atexit.register(self.close)
+        threading.Thread(target=self._receive, name='chat-event-bus', daemon=True).start()
+
+    def _receive(self):
+        receiver = self._socket
+        while True:
+            try:
+                data = receiver.recv(MAX_DATAGRAM)
+            except OSError:
+                return  # closed
+            try:
+                channel, payload = json.loads(data)
+            except (ValueError, TypeError):
+                continue
+            self.deliver(channel, payload)
+
+    def publish(self, channel, payload):
+        data = json.dumps([channel, payload], separators=(',', ':')).encode()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return  # no process has subscribed yet
+        for name in names:
+            if not name.endswith('.sock'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Its process is gone
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+            except BlockingIOError:
+                logger.warning("Event bus: %s is not keeping up, dropped an event on %s", name, channel)
+            except OSError:
+                logger.exception("Event bus: could not send to %s", name)
+
+    def close(self):
+        with self._lock:
+            receiver, path = self._socket, self.path
+            self._socket = self.path = None
+        if receiver is not None:
+            receiver.close()
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+
+
+_bus = None
+_bus_pid = None
+
+
+def get_bus():
+    """The configured bus of this process (a forked worker gets its own)."""
+    global _bus, _bus_pid
+    if _bus is None or _bus_pid != os.getpid():
+        name = getattr(settings, 'EVENT_BUS', 'inprocess')
+        _bus, _bus_pid = import_string(BACKENDS.get(name, name))(), os.getpid()
+    return _bus
+
+
+def publish(channel, payload):
+    """Publishes now. A failing bus is logged, never raised: delivery is best effort."""
+    try:
+        get_bus().publish(channel, payload)
+    except Exception:
+        logger.exception("Event bus: publish on %s failed", channel)
+
+
+def notify(conversation_id, kind, message_id=None):
+    """Publishes a change of a conversation (a SyncEvent kind) once the current transaction commits."""
+    payload = {'conversation': conversation_id, 'kind': kind, 'message': message_id}
+    transaction.on_commit(lambda: publish(conversation_channel(conversation_id), payload))
+
+
+@contextlib.asynccontextmanager
+async def listening(channels):
+    """
+    Subscribes to channels for the duration of the block and yields an
+    asyncio.Event that is set by the first event on any of them. Subscribe
+    before reading the state to compare against, so no change is missed.
+    """
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+
+    def wake(channel, payload):
+        loop.call_soon_threadsafe(woken.set)
+
+    bus = get_bus()
+    unsubscribes = [bus.subscribe(channel, wake) for channel in channels]
+    try:
+        yield woken
+    finally:
+        for unsubscribe in unsubscribes:
+            unsubscribe()
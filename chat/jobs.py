@@ -0,0 +1,185 @@
+"""
+Database-backed background jobs.
+
+Request handlers, signals and commands call enqueue() to defer slow work; it
+is one INSERT, part of the caller's transaction, so a job never runs for
+a change that was rolled back. `manage.py run_worker` executes jobs with a
+thread pool (or several worker processes), highest priority first.
+
+- Retries: a failing job is retried up to max_attempts times with
+  exponential backoff (JOB_RETRY_BACKOFF_SECONDS, doubled per attempt).
+- De-duplication: while a job with the same dedupe_key is still queued,
+  enqueueing it again only moves it up, if the new delay ends sooner.
+- Visibility timeout: a claimed job is locked for its timeout. If the worker
+  dies, another worker picks it up once the lock expires.
+
+Jobs are plain functions registered with @job('name') (see chat/tasks.py).
+Their arguments must be JSON-serializable.
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def job(name, priority=0, max_attempts=5, timeout=None):
+    """Registers a function as a job; the defaults apply to every enqueue() of it."""
+    def register(fn):
+        registry[name] = {'fn': fn, 'priority': priority, 'max_attempts': max_attempts, 'timeout': timeout}
+        return fn
+    return register
+
+
+def enqueue(name, *args, priority=None, dedupe_key=None, delay=0, max_attempts=None, **kwargs):
+    """Queues registered job `name`. Returns the Job, or the already queued one for dedupe_key."""
+    spec = registry[name]
+    new_job = Job(
+        name=name, args=list(args), kwargs=kwargs, dedupe_key=dedupe_key,
+        priority=spec['priority'] if priority is None else priority,
+        max_attempts=max_attempts or spec['max_attempts'],
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+    if dedupe_key is None:
+        new_job.save()
+        return new_job
+    try:
+        with transaction.atomic():
+            new_job.save()
+        return new_job
+    except IntegrityError:
+        queued = Job.objects.filter(dedupe_key=dedupe_key, status=Job.QUEUED)
+        queued.filter(run_after__gt=new_job.run_after).update(run_after=new_job.run_after)
+        return queued.first()
+
+
+def _claimable(now):
+    return Job.objects.filter(
+        Q(status=Job.QUEUED, run_after__lte=now) | Q(status=Job.RUNNING, locked_until__lt=now)
+    )
+
+
+def claim(worker_id, limit):
+    """
+    Locks up to `limit` due jobs for worker_id. A conditional UPDATE per job
+    decides races between workers, so this works the same on SQLite and Postgres.
+    """
+    now = timezone.now()
+    claimed = []
+    for candidate in _claimable(now).order_by('-priority', 'run_after', 'id')[:limit]:
+        timeout = registry.get(candidate.name, {}).get('timeout') or getattr(settings, 'JOB_VISIBILITY_TIMEOUT', 300)
+        updated = _claimable(now).filter(id=candidate.id).update(
+            status=Job.RUNNING, locked_by=worker_id, locked_until=now + timedelta(seconds=timeout),
+            attempts=F('attempts') + 1,
+        )
+        if updated:
+            claimed.append(candidate.id)
+    return list(Job.objects.filter(id__in=claimed).order_by('-priority', 'run_after', 'id'))
+
+
+def backoff(attempts):
+    base = getattr(settings, 'JOB_RETRY_BACKOFF_SECONDS', 10)
+    return min(base * 2 ** (attempts - 1), getattr(settings, 'JOB_RETRY_BACKOFF_MAX', 3600)) * random.uniform(0.8, 1.2)
+
+
+def run(claimed_job):
+    """Runs a claimed job and records the outcome. Returns True on success."""
+    spec = registry.get(claimed_job.name)
+    locked = Job.objects.filter(id=claimed_job.id, locked_by=claimed_job.locked_by)
+    try:
+        if spec is None:
+            raise LookupError(f"Unknown job {claimed_job.name!r}")
+        spec['fn'](*claimed_job.args, **claimed_job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning("Job %s failed (attempt %s/%s)", claimed_job, claimed_job.attempts, claimed_job.max_attempts,
+                       exc_info=True)
+        if spec is not None and claimed_job.attempts < claimed_job.max_attempts:
+            try:
+                with transaction.atomic():
+                    locked.update(status=Job.QUEUED, locked_until=None, last_error=error,
+                                  run_after=timezone.now() + timedelta(seconds=backoff(claimed_job.attempts)))
+                return False
+            except IntegrityError:
+                error += "\nNot retried: a newer job with the same dedupe key is queued"
+        locked.update(status=Job.FAILED, locked_until=None, last_error=error, finished_at=timezone.now())
+        return False
+    locked.update(status=Job.DONE, locked_until=None, finished_at=timezone.now())
+    return True
+
+
+def prune_finished(older_than=None):
+    """Deletes done/failed jobs finished more than older_than (a timedelta) ago."""
+    if older_than is None:
+        older_than = timedelta(days=getattr(settings, 'JOB_KEEP_FINISHED_DAYS', 7))
+    return Job.objects.filter(
+        status__in=[Job.DONE, Job.FAILED], finished_at__lt=timezone.now() - older_than,
+    ).delete()[0]
+
+
+class Worker:
+    """Claims due jobs and runs them on a pool of `threads` threads until stop(), or until the queue drains with once=True."""
+
+    def __init__(self, threads=4, poll_interval=1.0, once=False, log=None):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.once = once
+        self.log = log or (lambda message: None)
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+
+    def stop(self):
+        self.stopping.set()
+
+    def _run_one(self, claimed_job):
+        ok = False
+        try:
+            ok = run(claimed_job)
+            self.log(f"{'done' if ok else 'failed'}: {claimed_job.name} #{claimed_job.id}")
+        finally:
+            close_old_connections()
+            with self.lock:
+                self.in_flight -= 1
+                self.processed += 1
+                self.failed += not ok
+
+    def run(self):
+        last_prune = None
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='chat-job') as pool:
+            while not self.stopping.is_set():
+                if last_prune is None or timezone.now() - last_prune > timedelta(hours=1):
+                    prune_finished()
+                    last_prune = timezone.now()
+
+                # Only claim what the pool can start now, so other workers can take the rest
+                free = self.threads - self.in_flight
+                claimed = claim(self.worker_id, free) if free > 0 else []
+                with self.lock:
+                    self.in_flight += len(claimed)
+                for claimed_job in claimed:
+                    pool.submit(self._run_one, claimed_job)
+
+                if not claimed:
+                    if self.once and not self.in_flight:
+                        break
+                    # With every thread busy, check back soon instead of a full poll interval
+                    self.stopping.wait(self.poll_interval if free > 0 else 0.05)
+        close_old_connections()
@@ -0,0 +1,75 @@
+"""
+Per-user cache of the rendered conversation list (ConversationViewSet.list).
+
+Cached lists are stored under (user, version, URL). The version comes from
+the database, so every worker process agrees on it whatever the cache
+backend: the newest SyncEvent the user can see in their conversations
+(every change shown in a list writes one, see chat/sync.py), the number of
+their conversations (a user who leaves one cannot see its events anymore)
+and the last expiry that has passed in them (expired messages leave the
+list before the sweep writes their events). It is also the list's ETag.
+
+Message text never goes into the cache, which may be a file or a database
+table (PRIVATE_MESSAGING_CACHE). Entries keep the last messages' ciphertext,
+and cached() decrypts it on every request, like chat/bubbles.py does for
+message bubbles. Entries of older versions expire after
+CONVERSATION_LIST_CACHE_SECONDS.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+
+from . import sync
+from .models import Conversation, Message
+from .utils import decrypt_message, encrypt_message
+
+
+def version(user):
+    conversations = Conversation.objects.filter(participants=user).values('id')
+    latest = sync.visible_events(user).aggregate(latest=Max('id'))['latest'] or 0
+    expired_at = (Message.objects.filter(conversation__in=conversations, expires_at__lte=timezone.now())
+                  .aggregate(last=Max('expires_at'))['last'])
+    return f'{latest}.{conversations.count()}.{int(expired_at.timestamp()) if expired_at else 0}'
+
+
+def _key(request, list_version):
+    url = hashlib.md5(request.build_absolute_uri().encode(), usedforsecurity=False).hexdigest()
+    return f'chat:conversation-list:{request.user.id}:{list_version}:{url}'
+
+
+def _conversations(data):
+    # The list is paginated ({"results": [...]}) unless pagination is turned off
+    return data['results'] if isinstance(data, dict) else data
+
+
+def _last_messages(data):
+    return [conversation['last_message'] for conversation in _conversations(data) if conversation['last_message']]
+
+
+def cached(request, list_version):
+    data = cache.get(_key(request, list_version))
+    if data is not None:
+        for message in _last_messages(data):
+            message['decrypted_content'] = decrypt_message(message['content'])
+            if message['parent_content']:
+                message['parent_content'] = decrypt_message(message['parent_content'])
+    return data
+
+
+def _without_text(message):
+    if message is None:
+        return None
+    parent_content = message['parent_content']
+    return {**message, 'decrypted_content': None,
+            'parent_content': encrypt_message(parent_content) if parent_content else parent_content}
+
+
+def store(request, list_version, data):
+    """Caches data with its message text left encrypted (the quoted parent's is encrypted again)."""
+    conversations = [{**conversation, 'last_message': _without_text(conversation['last_message'])}
+                     for conversation in _conversations(data)]
+    entry = {**data, 'results': conversations} if isinstance(data, dict) else conversations
+    cache.set(_key(request, list_version), entry, getattr(settings, 'CONVERSATION_LIST_CACHE_SECONDS', 300))
@@ -0,0 +1,337 @@
+"""
+In-process load simulation.
+
+Simulated chat clients run as asyncio tasks and talk straight to the
+project's WSGI or ASGI callable: no sockets, no external services. In WSGI
+mode each request is handed to a fixed-size thread pool standing in for
+the worker's threads. In ASGI mode requests run on the event loop like
+under an ASGI server.
+
+Each client logs in through login_api (JWT for the REST calls) and the
+login form (session for the web page). It then polls get_messages at a
+fixed interval, and sends, reacts and marks as read at Poisson-distributed
+rates. conversation_detail.html follows the server's X-Poll-Interval
+instead; the fixed rate keeps the load the same from run to run.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from io import BytesIO
+from urllib.parse import urlencode
+
+from django.conf import settings
+
+_endpoint = contextvars.ContextVar('loadsim_endpoint', default=None)
+
+
+def _host():
+    allowed = [host for host in settings.ALLOWED_HOSTS if host not in ('*',) and not host.startswith('.')]
+    return allowed[0] if allowed else 'localhost'
+
+
+def _encode(data, json_body):
+    if json_body is not None:
+        return json.dumps(json_body).encode(), 'application/json'
+    if data is not None:
+        return urlencode(data).encode(), 'application/x-www-form-urlencoded'
+    return b'', ''
+
+
+class Session:
+    """Cookie jar, default headers and address of one simulated client."""
+
+    def __init__(self, address='127.0.0.1'):
+        self.cookies = {}
+        self.headers = {}
+        # Rate limits of logged-out requests go by address
+        self.address = address
+
+    def request_headers(self, content_type, length, extra):
+        headers = {**self.headers, **(extra or {})}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        if content_type:
+            headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(length)
+        return headers
+
+    def store_cookies(self, set_cookie_headers):
+        for header in set_cookie_headers:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+
+class WSGITransport:
+    def __init__(self, application, threads):
+        self.application = application
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi-worker')
+        self.host = _host()
+
+    def _call(self, session, method, path, body, content_type, headers):
+        path, _, query = path.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': session.address,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': BytesIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'HTTP_HOST': self.host,
+        }
+        for name, value in session.request_headers(content_type, len(body), headers).items():
+            key = name.upper().replace('-', '_')
+            environ[key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{key}'] = value
+
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = response_headers
+
+        result = self.application(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        session.store_cookies(v for k, v in response['headers'] if k.lower() == 'set-cookie')
+        return response['status'], content
+
+    async def request(self, session, method, path, data=None, json_body=None, headers=None):
+        body, content_type = _encode(data, json_body)
+        call = functools.partial(self._call, session, method, path, body, content_type, headers)
+        # Copy the context so the lock-error log handler can attribute errors
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.pool, context.run, call)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class ASGITransport:
+    def __init__(self, application):
+        self.application = application
+        self.host = _host()
+
+    async def request(self, session, method, path, data=None, json_body=None, headers=None):
+        body, content_type = _encode(data, json_body)
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': [(b'host', self.host.encode())] + [
+                (name.lower().encode(), value.encode())
+                for name, value in session.request_headers(content_type, len(body), headers).items()
+            ],
+            'client': (session.address, 0),
+            'server': (self.host, 80),
+        }
+        done = asyncio.Event()
+        sent_body = False
+        response = {'body': []}
+
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            # Only disconnect once the response is complete, like a patient client
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = message.get('headers', [])
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+                if not message.get('more_body'):
+                    done.set()
+
+        await self.application(scope, receive, send)
+        done.set()
+        session.store_cookies(v.decode() for k, v in response['headers'] if k.lower() == b'set-cookie')
+        return response['status'], b''.join(response['body'])
+
+    def close(self):
+        pass
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.locked = defaultdict(int)
+
+    def report(self, elapsed):
+        def percentile(values, q):
+            return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+        endpoints = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[name])
+            total = len(values) + self.errors[name]
+            failed = self.errors[name] + sum(n for status, n in self.statuses[name].items() if status >= 400)
+            endpoints[name] = {
+                'requests': total,
+                'per_second': round(total / elapsed, 2),
+                'p50_ms': round(percentile(values, 50), 2) if values else None,
+                'p95_ms': round(percentile(values, 95), 2) if values else None,
+                'p99_ms': round(percentile(values, 99), 2) if values else None,
+                'error_rate': round(failed / total, 4) if total else 0.0,
+                'lock_errors': self.locked[name],
+                'statuses': dict(self.statuses[name]),
+            }
+        total = sum(e['requests'] for e in endpoints.values())
+        return {'seconds': round(elapsed, 2), 'requests': total, 'per_second': round(total / elapsed, 2),
+                'endpoints': endpoints}
+
+
+class LockErrorHandler(logging.Handler):
+    """Counts 'database is locked' errors that Django logs for failed requests."""
+
+    def __init__(self, stats):
+        super().__init__(level=logging.ERROR)
+        self.stats = stats
+
+    def emit(self, record):
+        if record.exc_info and 'locked' in str(record.exc_info[1]):
+            self.stats.locked[_endpoint.get() or 'unknown'] += 1
+
+
+async def timed(stats, transport, session, name, method, path, **kwargs):
+    token = _endpoint.set(name)
+    started = time.perf_counter()
+    try:
+        status, body = await transport.request(session, method, path, **kwargs)
+    except Exception:
+        stats.errors[name] += 1
+        return None, b''
+    finally:
+        _endpoint.reset(token)
+    stats.latencies[name].append((time.perf_counter() - started) * 1000)
+    stats.statuses[name][status] += 1
+    return status, body
+
+
+async def log_in(index, username, password, transport, stats, options):
+    """Returns (session, REST API headers), or None if the login failed."""
+    session = Session(f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}')
+    await asyncio.sleep(random.Random(index).uniform(0, options['ramp_up']))
+
+    # JWT for the REST API
+    status, body = await timed(stats, transport, session, 'login_api', 'POST', '/chat/api/auth/login/',
+                               json_body={'username': username, 'password': password})
+    if status != 200:
+        return None
+    api_headers = {'Authorization': f"Bearer {json.loads(body)['access']}"}
+
+    # Session for the web page (the login form needs its CSRF cookie first)
+    await timed(stats, transport, session, 'login_form', 'GET', '/accounts/login/')
+    await timed(stats, transport, session, 'login_form', 'POST', '/accounts/login/', data={
+        'username': username, 'password': password,
+        'csrfmiddlewaretoken': session.cookies.get(settings.CSRF_COOKIE_NAME, ''),
+    })
+    return session, api_headers
+
+
+async def run_client(index, session, api_headers, conversation_id, transport, stats, options, deadline):
+    rng = random.Random(index)
+
+    def next_at(per_minute):
+        return time.monotonic() + rng.expovariate(per_minute / 60) if per_minute > 0 else float('inf')
+
+    next_poll = time.monotonic() + rng.uniform(0, options['poll_interval'])
+    next_send = next_at(options['send_rate'])
+    next_react = next_at(options['react_rate'])
+    next_read = next_at(options['read_rate'])
+    last_id = 0
+    seen_ids = []
+
+    while True:
+        wake = min(next_poll, next_send, next_react, next_read, deadline)
+        await asyncio.sleep(max(0.0, wake - time.monotonic()))
+        now = time.monotonic()
+        if now >= deadline:
+            return
+
+        if now >= next_poll:
+            next_poll += options['poll_interval']
+            status, body = await timed(stats, transport, session, 'get_messages', 'GET',
+                                       f'/chat/conversation/{conversation_id}/get-messages/?after={last_id}')
+            if status == 200:
+                seen_ids = [m['id'] for m in json.loads(body)] or seen_ids
+                last_id = seen_ids[-1] if seen_ids else last_id
+        if now >= next_send:
+            next_send = next_at(options['send_rate'])
+            await timed(stats, transport, session, 'send', 'POST', '/chat/api/messages/', headers=api_headers,
+                        json_body={'conversation': conversation_id, 'content': f'load test {index} {now:.3f}'})
+        if now >= next_react:
+            next_react = next_at(options['react_rate'])
+            if seen_ids:
+                await timed(stats, transport, session, 'react', 'POST',
+                            f'/chat/api/messages/{rng.choice(seen_ids)}/react/', headers=api_headers,
+                            json_body={'emoji': rng.choice(['👍', '❤️', '😂'])})
+        if now >= next_read:
+            next_read = next_at(options['read_rate'])
+            await timed(stats, transport, session, 'mark_as_read', 'POST',
+                        f'/chat/api/conversations/{conversation_id}/mark_as_read/', headers=api_headers)
+
+
+async def simulate(clients, transport, options):
+    """
+    clients: [(username, password, conversation_id)]. All clients log in
+    first (password hashing is slow by design), then the timed traffic phase
+    runs for options['duration'] seconds. Returns the report dict.
+    """
+    login_stats, stats = Stats(), Stats()
+    handler = LockErrorHandler(stats)
+    request_logger = logging.getLogger('django.request')
+    request_logger.addHandler(handler)
+    try:
+        started = time.monotonic()
+        logins = await asyncio.gather(*(
+            log_in(index, username, password, transport, login_stats, options)
+            for index, (username, password, _) in enumerate(clients)
+        ))
+        login_elapsed = time.monotonic() - started
+
+        started = time.monotonic()
+        deadline = started + options['duration']
+        await asyncio.gather(*(
+            run_client(index, *login, conversation_id, transport, stats, options, deadline)
+            for index, (login, (_, _, conversation_id)) in enumerate(zip(logins, clients))
+            if login is not None
+        ))
+        elapsed = time.monotonic() - started
+    finally:
+        request_logger.removeHandler(handler)
+        transport.close()
+
+    report = stats.report(elapsed)
+    report['clients'] = sum(login is not None for login in logins)
+    report['login'] = login_stats.report(login_elapsed)
+    return report
@@ -0,0 +1,162 @@
+import json
+import platform
+import statistics
+import subprocess
+import time
+from types import SimpleNamespace
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases
+from rest_framework.test import APIClient
+
+from chat.models import Conversation, Message
+from chat.serializers import ConversationSerializer, MessageSerializer
+from chat.synthetic import generate
+from chat.utils import decrypt_message, encrypt_message
+
+
+def measure(fn, repeat):
+    """Timing summary of `repeat` calls plus the query count of the last one."""
+    fn()  # warm-up
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - started) * 1000)
+    return {
+        'p50_ms': round(statistics.median(timings), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': len(queries),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark encryption, serializers and the polling/listing endpoints on a throwaway "
+        "test database filled with synthetic data. Prints JSON; --compare diffs against a previous run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--conversations', type=int, default=60)
+        parser.add_argument('--messages', type=int, default=500, help="Messages per conversation")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--output', help="Also write the JSON results to this file")
+        parser.add_argument('--compare', help="A previous JSON result file to compare against")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            # One user repeating a request would soon be rate limited; time the views, not 429s
+            with override_settings(THROTTLE_RATES={}):
+                results = self.run_benchmarks(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), results)
+
+    def run_benchmarks(self, options):
+        started = time.perf_counter()
+        data = generate(
+            users=options['users'], conversations=options['conversations'],
+            messages_per_conversation=options['messages'], seed=options['seed'],
+        )
+        seed_seconds = time.perf_counter() - started
+        hub = data['users'][0]
+        conversation = data['conversations'][0]
+        repeat = options['repeat']
+        results = {}
+
+        # Encryption throughput
+        text = "benchmark message " * 10
+        token = encrypt_message(text)
+        for name, fn in (('encrypt', lambda: encrypt_message(text)), ('decrypt', lambda: decrypt_message(token))):
+            count = 2000
+            started = time.perf_counter()
+            for _ in range(count):
+                fn()
+            results[f'crypto.{name}'] = {'ops_per_second': round(count / (time.perf_counter() - started))}
+
+        # Serializer rendering; querysets are re-evaluated per run like a real request
+        context = {'request': SimpleNamespace(user=hub)}
+        for size in (50, 500):
+            messages = Message.objects.filter(conversation__in=data['conversations']).order_by('-id')[:size]
+            results[f'serializer.message.{size}'] = measure(
+                lambda: MessageSerializer(list(messages.all()), many=True).data, repeat)
+            conversations = Conversation.objects.filter(participants=hub).order_by('id')[:size]
+            results[f'serializer.conversation.{size}'] = measure(
+                lambda: ConversationSerializer(list(conversations.all()), many=True, context=context).data, repeat)
+
+        # Endpoints, through the full middleware stack
+        client = Client()
+        client.force_login(hub)
+        api = APIClient()
+        api.force_authenticate(hub)
+        endpoints = {
+            'view.get_messages': lambda: client.get(f'/chat/conversation/{conversation.id}/get-messages/'),
+            # Warm: message bubbles come from the fragment cache; cold: every bubble is rendered
+            'view.conversation_detail': lambda: client.get(f'/chat/{conversation.id}/'),
+            'view.conversation_detail.cold': lambda: (cache.clear(), client.get(f'/chat/{conversation.id}/'))[1],
+            'api.conversations.list': lambda: api.get('/chat/api/conversations/'),
+            'api.conversations.messages': lambda: api.get(f'/chat/api/conversations/{conversation.id}/messages/'),
+        }
+        for name, fn in endpoints.items():
+            status = fn().status_code
+            if status != 200:
+                raise RuntimeError(f"{name} returned HTTP {status}")
+            results[name] = measure(fn, repeat)
+
+        return {
+            'meta': {
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'users': options['users'],
+                'conversations': options['conversations'],
+                'messages_per_conversation': options['messages'],
+                'seed': options['seed'],
+                'repeat': repeat,
+                'seed_seconds': round(seed_seconds, 3),
+            },
+            'results': results,
+        }
+
+    def compare(self, before, after):
+        self.stdout.write(f"\nvs {before['meta'].get('revision')}:")
+        for name, current in after['results'].items():
+            previous = before['results'].get(name)
+            if not previous:
+                continue
+            for metric in ('p50_ms', 'queries', 'ops_per_second'):
+                if metric in current and previous.get(metric):
+                    change = (current[metric] - previous[metric]) / previous[metric] * 100
+                    self.stdout.write(f"  {name:<34}{metric:<16}{previous[metric]:>10} -> {current[metric]:<10} {change:+.1f}%")
@@ -0,0 +1,98 @@
+import gzip
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from chat import compression, renderers
+from chat.synthetic import generate
+
+from .bench_hotpaths import git_revision
+
+
+def timed(fn, repeat):
+    """(p50 ms, result) of `repeat` calls of fn."""
+    fn()  # warm-up
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 3), result
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark payload size and encode time of a 50-message API page as JSON and MessagePack, "
+        "uncompressed, gzip and brotli, on a throwaway test database. Prints JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help="Messages in the benchmarked conversation")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--output', help="Also write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            results = self.run_benchmarks(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def run_benchmarks(self, options):
+        data = generate(users=2, conversations=1, messages_per_conversation=options['messages'], seed=options['seed'])
+        conversation = data['conversations'][0]
+        api = APIClient()
+        api.force_authenticate(data['users'][0])
+        response = api.get(f'/chat/api/conversations/{conversation.id}/messages/', HTTP_ACCEPT='application/json')
+        if response.status_code != 200:
+            raise CommandError(f"messages endpoint returned HTTP {response.status_code}")
+        page = response.data
+        repeat = options['repeat']
+
+        encoders = {'json': lambda: JSONRenderer().render(page)}
+        if renderers.available():
+            encoders['msgpack'] = lambda: renderers.packb(page)
+        compressors = {'identity': lambda body: body, 'gzip': lambda body: gzip.compress(body, 6)}
+        if compression.brotli_available():
+            import brotli
+
+            compressors['br'] = lambda body: brotli.compress(body, quality=4)
+
+        results = {}
+        for format_name, encode in encoders.items():
+            encode_ms, body = timed(encode, repeat)
+            for coding, compress in compressors.items():
+                compress_ms, compressed = timed(lambda: compress(body), repeat)
+                results[f'{format_name}.{coding}'] = {
+                    'bytes': len(compressed),
+                    'encode_ms': encode_ms,
+                    'compress_ms': compress_ms if coding != 'identity' else 0,
+                    'total_ms': round(encode_ms + (compress_ms if coding != 'identity' else 0), 3),
+                }
+        baseline = results['json.identity']['bytes']
+        for result in results.values():
+            result['vs_json'] = round(result['bytes'] / baseline, 3)
+
+        return {
+            'meta': {
+                'revision': git_revision(),
+                'messages_in_page': len(page),
+                'repeat': repeat,
+                'msgpack': renderers.available(),
+                'brotli': compression.brotli_available(),
+            },
+            'results': results,
+        }
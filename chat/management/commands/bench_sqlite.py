@@ -0,0 +1,141 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections
+
+from chat.models import Conversation, Message
+
+PROFILES = ('default', 'production')
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent SQLite benchmark: polling reads mixed with sends, read marks and "
+        "reactions, run once per SQLite profile on a throwaway database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--seconds', type=float, default=5.0)
+        parser.add_argument('--messages', type=int, default=2000, help="Messages seeded per conversation")
+        parser.add_argument('--profile', choices=PROFILES, help="Benchmark only this profile")
+        parser.add_argument('--worker', action='store_true', help="Internal: run inside the configured profile")
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            self.stdout.write(json.dumps(self.run_worker(options)))
+            return
+
+        results = []
+        for profile in [options['profile']] if options['profile'] else PROFILES:
+            with tempfile.TemporaryDirectory() as tmp:
+                env = {
+                    **os.environ,
+                    'PRIVATE_MESSAGING_DB_ENGINE': 'sqlite',
+                    'PRIVATE_MESSAGING_DB_NAME': os.path.join(tmp, 'bench.sqlite3'),
+                    'PRIVATE_MESSAGING_DB_REPLICAS': '',
+                    'PRIVATE_MESSAGING_SQLITE_PROFILE': profile,
+                }
+                output = subprocess.run(
+                    [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'bench_sqlite', '--worker',
+                     '--threads', str(options['threads']), '--seconds', str(options['seconds']),
+                     '--messages', str(options['messages'])],
+                    env=env, check=True, capture_output=True, text=True,
+                ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+        self.stdout.write(f"{'profile':<12}{'ops/s':>10}{'reads/s':>10}{'writes/s':>10}{'locked':>8}{'errors':>8}")
+        for r in results:
+            self.stdout.write(
+                f"{r['profile']:<12}{r['ops_per_second']:>10.0f}{r['reads_per_second']:>10.0f}"
+                f"{r['writes_per_second']:>10.0f}{r['locked']:>8}{r['errors']:>8}"
+            )
+        self.stdout.write(json.dumps(results))
+
+    def run_worker(self, options):
+        call_command('migrate', verbosity=0)
+        conversations = self.seed(options['threads'], options['messages'])
+
+        counts = {'reads': 0, 'writes': 0, 'locked': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['seconds']
+
+        def client(user, conversation):
+            local = dict.fromkeys(counts, 0)
+            try:
+                while time.monotonic() < deadline:
+                    op = random.random()
+                    try:
+                        if op < 0.7:
+                            # What get_messages does on every 3s poll
+                            list(conversation.messages.order_by('-timestamp')[:50])
+                            local['reads'] += 1
+                            continue
+                        if op < 0.8:
+                            Message.objects.create(conversation=conversation, sender=user, content="benchmark")
+                        elif op < 0.9:
+                            conversation.mark_as_read(user)
+                        else:
+                            message = conversation.messages.order_by('-id').first()
+                            message.toggle_reaction(user, random.choice(['👍', '❤️', '😂']))
+                        local['writes'] += 1
+                    except OperationalError as exc:
+                        local['locked' if 'locked' in str(exc) else 'errors'] += 1
+            finally:
+                close_old_connections()
+                with lock:
+                    for key, value in local.items():
+                        counts[key] += value
+
+        threads = [
+            threading.Thread(target=client, args=(user, conversation))
+            for user, conversation in conversations
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        return {
+            'profile': settings.SQLITE_PROFILE,
+            'threads': options['threads'],
+            'seconds': round(elapsed, 3),
+            'ops_per_second': (counts['reads'] + counts['writes']) / elapsed,
+            'reads_per_second': counts['reads'] / elapsed,
+            'writes_per_second': counts['writes'] / elapsed,
+            **counts,
+        }
+
+    def seed(self, threads, messages_per_conversation):
+        """One user per thread, paired up into conversations with history."""
+        User = get_user_model()
+        users = []
+        for i in range(max(threads, 2)):
+            user = User(username=f'bench{i}')
+            user.set_unusable_password()
+            users.append(user)
+        User.objects.bulk_create(users)
+        users = list(User.objects.order_by('id'))
+
+        pairs = []
+        for i in range(0, len(users) - 1, 2):
+            conversation = Conversation.objects.create()
+            conversation.participants.add(users[i], users[i + 1])
+            Message.objects.bulk_create([
+                Message(conversation=conversation, sender=users[i + n % 2], content=f"history {n}")
+                for n in range(messages_per_conversation)
+            ])
+            pairs += [(users[i], conversation), (users[i + 1], conversation)]
+        return pairs[:threads]
@@ -0,0 +1,167 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from .bench_hotpaths import git_revision
+
+# Optional or rarely needed packages that should only load on first use
+HEAVY_MODULES = ('cryptography', 'PIL', 'qrcode', 'msgpack', 'brotli', 'cProfile')
+
+# Runs in a fresh interpreter, so nothing measured is already imported. Only the
+# standard library is imported before the clock starts.
+PROBE = r'''
+import asyncio, io, json, sys, time
+
+started = time.perf_counter()
+interface, path, host = sys.argv[1:4]
+
+def ms():
+    return round((time.perf_counter() - started) * 1000, 3)
+
+import django
+django.setup()
+setup_ms = ms()
+
+if interface == 'wsgi':
+    from private_messaging.wsgi import application
+    app_ms = ms()
+    status = []
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+        'SERVER_NAME': host, 'SERVER_PORT': '80', 'HTTP_HOST': host, 'REMOTE_ADDR': '127.0.0.1',
+        'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.multithread': False,
+        'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    response = application(environ, lambda s, headers, exc_info=None: status.append(int(s.split()[0])))
+    b''.join(response)
+    response.close()
+else:
+    from private_messaging.asgi import application
+    app_ms = ms()
+    status = []
+
+    async def request():
+        done = asyncio.Event()
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            elif not message.get('more_body'):
+                done.set()
+
+        await application({
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+            'query_string': b'', 'headers': [(b'host', host.encode())],
+            'client': ('127.0.0.1', 0), 'server': (host, 80),
+        }, receive, send)
+
+    asyncio.run(request())
+
+print(json.dumps({
+    'setup_ms': setup_ms,
+    'app_ms': app_ms,
+    'first_response_ms': ms(),
+    'status': status[0] if status else None,
+    'modules': len(sys.modules),
+    'heavy_loaded': sorted(name for name in json.loads(sys.argv[4]) if name in sys.modules),
+}))
+'''
+
+
+def parse_importtime(stderr):
+    """{module: (self us, cumulative us)} from python -X importtime output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # the header line
+        modules[parts[2].strip()] = (int(parts[0]), int(parts[1]))
+    return modules
+
+
+def summarize(values):
+    return {
+        'p50_ms': round(statistics.median(values), 3),
+        'min_ms': round(min(values), 3),
+        'max_ms': round(max(values), 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark cold start: import time and time to first response of the WSGI and ASGI "
+        "applications, each measured in fresh interpreters. Prints JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="Fresh processes per interface")
+        parser.add_argument('--path', default='/accounts/login/', help="Path of the first request")
+        parser.add_argument('--host', default=(settings.ALLOWED_HOSTS or ['localhost'])[0])
+        parser.add_argument('--top', type=int, default=15, help="Slowest imports to list")
+        parser.add_argument('--output', help="Also write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        results = {
+            interface: self.run_interface(interface, options)
+            for interface in ('wsgi', 'asgi')
+        }
+        output = json.dumps({
+            'meta': {
+                'revision': git_revision(),
+                'python': sys.version.split()[0],
+                'repeat': options['repeat'],
+                'path': options['path'],
+            },
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def run_interface(self, interface, options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(settings.BASE_DIR), env.get('PYTHONPATH')]))
+        runs, imports = [], {}
+        for _ in range(options['repeat']):
+            process = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', PROBE, interface, options['path'], options['host'],
+                 json.dumps(HEAVY_MODULES)],
+                cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+            )
+            if process.returncode != 0:
+                raise CommandError(f"{interface} probe failed:\n{process.stderr[-2000:]}")
+            runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+            for module, (self_us, _) in parse_importtime(process.stderr).items():
+                imports.setdefault(module, []).append(self_us)
+
+        slowest = sorted(imports.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+        # Each time is counted from the start of the probe, so app_import includes setup
+        return {
+            'setup': summarize([run['setup_ms'] for run in runs]),
+            'app_import': summarize([run['app_ms'] for run in runs]),
+            'first_response': summarize([run['first_response_ms'] for run in runs]),
+            'status': runs[-1]['status'],
+            'modules_loaded': runs[-1]['modules'],
+            'heavy_modules_loaded': runs[-1]['heavy_loaded'],
+            'slowest_imports_ms': {
+                module: round(statistics.median(timings) / 1000, 3) for module, timings in slowest[:options['top']]
+            },
+        }
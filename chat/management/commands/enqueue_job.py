@@ -0,0 +1,32 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.jobs import enqueue, registry
+
+
+class Command(BaseCommand):
+    help = "Queue a background job for run_worker, e.g. `enqueue_job chat.purge_messages`"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', nargs='?', help="Job name; omit to list the registered jobs")
+        parser.add_argument('--kwargs', default='{}', help="Keyword arguments as a JSON object")
+        parser.add_argument('--priority', type=int, default=None)
+        parser.add_argument('--delay', type=float, default=0, help="Seconds before the job becomes due")
+        parser.add_argument('--dedupe-key', default=None)
+
+    def handle(self, *args, **options):
+        if not options['name']:
+            for name in sorted(registry):
+                self.stdout.write(name)
+            return
+        if options['name'] not in registry:
+            raise CommandError(f"Unknown job {options['name']!r}; run without a name to list them")
+        try:
+            kwargs = json.loads(options['kwargs'])
+        except ValueError as exc:
+            raise CommandError(f"--kwargs is not valid JSON: {exc}")
+
+        queued = enqueue(options['name'], priority=options['priority'], delay=options['delay'],
+                         dedupe_key=options['dedupe_key'], **kwargs)
+        self.stdout.write(self.style.SUCCESS(f"Queued {queued}"))
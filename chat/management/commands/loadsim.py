@@ -0,0 +1,105 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import get_internal_wsgi_application
+from django.utils.module_loading import import_string
+
+from chat.loadsim import ASGITransport, WSGITransport, simulate
+from chat.synthetic import generate
+
+PASSWORD = 'loadsim-password'
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate many concurrent chat clients against the WSGI or ASGI app in-process, on a "
+        "throwaway SQLite database, and report throughput, latency percentiles and error/lock "
+        "rates per endpoint"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--duration', type=float, default=30.0, help="Seconds of simulated traffic")
+        parser.add_argument('--mode', choices=('wsgi', 'asgi'), default='wsgi')
+        parser.add_argument('--threads', type=int, default=8, help="WSGI worker threads")
+        parser.add_argument('--poll-interval', type=float, default=3.0)
+        parser.add_argument('--send-rate', type=float, default=2.0, help="Messages per client per minute")
+        parser.add_argument('--react-rate', type=float, default=1.0, help="Reactions per client per minute")
+        parser.add_argument('--read-rate', type=float, default=2.0, help="mark_as_read calls per client per minute")
+        parser.add_argument('--ramp-up', type=float, default=2.0, help="Spread client logins over this many seconds")
+        parser.add_argument('--messages', type=int, default=200, help="History per conversation")
+        parser.add_argument('--sqlite-profile', choices=('default', 'production'), default=None,
+                            help="SQLite profile of the throwaway database (default: current setting)")
+        parser.add_argument('--no-throttle', action='store_true',
+                            help="Turn the rate limits off, to push past what they allow one client")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON only")
+        parser.add_argument('--worker', action='store_true', help="Internal: run inside the throwaway database")
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            self.stdout.write(json.dumps(self.run_worker(options)))
+            return
+
+        argv = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'loadsim', '--worker']
+        for name in ('clients', 'duration', 'mode', 'threads', 'poll_interval', 'send_rate',
+                     'react_rate', 'read_rate', 'ramp_up', 'messages'):
+            argv += [f"--{name.replace('_', '-')}", str(options[name])]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {
+                **os.environ,
+                'PRIVATE_MESSAGING_DB_ENGINE': 'sqlite',
+                'PRIVATE_MESSAGING_DB_NAME': os.path.join(tmp, 'loadsim.sqlite3'),
+                'PRIVATE_MESSAGING_DB_REPLICAS': '',
+                'PRIVATE_MESSAGING_SQLITE_PROFILE': options['sqlite_profile'] or settings.SQLITE_PROFILE,
+            }
+            if options['no_throttle']:
+                env['PRIVATE_MESSAGING_THROTTLE'] = '0'
+            completed = subprocess.run(argv, env=env, capture_output=True, text=True)
+        if completed.returncode:
+            self.stderr.write(completed.stderr)
+            raise SystemExit(completed.returncode)
+        report = json.loads(completed.stdout.strip().splitlines()[-1])
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            f"{report['mode']} mode, {report['clients']}/{options['clients']} clients logged in "
+            f"in {report['login']['seconds']}s; {report['seconds']}s of traffic: "
+            f"{report['requests']} requests, {report['per_second']} req/s"
+        )
+        self.stdout.write(f"{'endpoint':<16}{'req':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'err %':>8}{'locked':>8}")
+        for name, e in [*report['login']['endpoints'].items(), *report['endpoints'].items()]:
+            self.stdout.write(
+                f"{name:<16}{e['requests']:>7}{e['per_second']:>9}{e['p50_ms'] or '-':>9}{e['p95_ms'] or '-':>9}"
+                f"{e['p99_ms'] or '-':>9}{e['error_rate'] * 100:>8.2f}{e['lock_errors']:>8}"
+            )
+
+    def run_worker(self, options):
+        call_command('migrate', verbosity=0)
+        data = generate(
+            users=options['clients'] + 1, conversations=options['clients'],
+            messages_per_conversation=options['messages'], password=PASSWORD,
+        )
+        # Client i is the i-th non-hub user, chatting in the conversation paired with them
+        clients = [
+            (user.username, PASSWORD, conversation.id)
+            for user, conversation in zip(data['users'][1:], data['conversations'])
+        ]
+
+        if options['mode'] == 'asgi':
+            transport = ASGITransport(import_string('private_messaging.asgi.application'))
+        else:
+            transport = WSGITransport(get_internal_wsgi_application(), options['threads'])
+
+        report = asyncio.run(simulate(clients, transport, options))
+        report['mode'] = options['mode']
+        return report
@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.purge import purge_messages
+from chat.sync import prune_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Strip content, files, reactions and read/deleted marks from old deleted-for-everyone "
+        "messages, delete messages every participant deleted for themselves, prune old sync "
+        "events, then VACUUM/ANALYZE"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-days', type=int, default=settings.MESSAGE_PURGE_GRACE_DAYS,
+                            help="Only purge messages deleted more than this many days ago")
+        parser.add_argument('--batch-size', type=int, default=settings.MESSAGE_PURGE_BATCH_SIZE)
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help="Stop after this many batches (run again to continue)")
+        parser.add_argument('--pause', type=float, default=0.1, help="Seconds to sleep between batches")
+        parser.add_argument('--no-vacuum', action='store_true')
+
+    def handle(self, *args, **options):
+        pruned = prune_events(timedelta(days=settings.SYNC_EVENT_RETENTION_DAYS))
+        purged, deleted = purge_messages(
+            grace=timedelta(days=options['grace_days']),
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+            pause=options['pause'],
+            vacuum=not options['no_vacuum'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Purged {purged} deleted-for-everyone messages, removed {deleted} hidden messages, "
+            f"pruned {pruned} sync events"
+        ))
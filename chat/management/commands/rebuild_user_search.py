@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat.user_search import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the user search index (chat/user_search.py); run once after upgrading, it is kept current afterwards"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = rebuild(
+            batch_size=options['batch_size'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Indexed {total} users"))
@@ -0,0 +1,50 @@
+import os
+import signal
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = "Run background jobs (chat/jobs.py) until interrupted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help="Jobs run concurrently per process")
+        parser.add_argument('--processes', type=int, default=1,
+                            help="Start this many worker processes (for CPU-heavy jobs)")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds between polls when idle")
+        parser.add_argument('--once', action='store_true', help="Exit once no job is due")
+
+    def handle(self, *args, **options):
+        if options['processes'] > 1:
+            return self.run_processes(options)
+
+        worker = Worker(
+            threads=options['threads'], poll_interval=options['poll_interval'], once=options['once'],
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: worker.stop())
+        self.stdout.write(f"Worker {worker.worker_id} running with {options['threads']} threads")
+        worker.run()
+        self.stdout.write(self.style.SUCCESS(f"Processed {worker.processed} jobs ({worker.failed} failed)"))
+
+    def run_processes(self, options):
+        argv = [
+            sys.executable, str(settings.BASE_DIR / 'manage.py'), 'run_worker',
+            '--threads', str(options['threads']), '--poll-interval', str(options['poll_interval']),
+            '--verbosity', str(options['verbosity']),
+        ] + (['--once'] if options['once'] else [])
+        children = [subprocess.Popen(argv, env=os.environ.copy()) for _ in range(options['processes'])]
+        try:
+            for child in children:
+                child.wait()
+        except KeyboardInterrupt:
+            for child in children:
+                child.send_signal(signal.SIGTERM)
+            for child in children:
+                child.wait()
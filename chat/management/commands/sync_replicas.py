@@ -0,0 +1,31 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database onto every SQLite read replica (local replica testing)"
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES['default']
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError("sync_replicas only works with SQLite; use real replication for Postgres.")
+
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if not replicas:
+            self.stdout.write("No replicas configured (set PRIVATE_MESSAGING_DB_REPLICAS).")
+            return
+
+        source = sqlite3.connect(str(primary['NAME']))
+        try:
+            for alias in replicas:
+                target = sqlite3.connect(str(settings.DATABASES[alias]['NAME']))
+                try:
+                    # Online backup API: consistent snapshot even while the primary is in use
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(self.style.SUCCESS(f"{alias} synced from default"))
+        finally:
+            source.close()
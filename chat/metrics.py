@@ -0,0 +1,189 @@
+"""
+Per-request instrumentation.
+
+MetricsMiddleware records, for every resolved view name, request latency,
+number and time of DB queries and time spent encrypting/decrypting
+messages. The numbers go into in-process histograms which /metrics exposes
+in the Prometheus text format (one set per worker process).
+
+Requests slower than settings.METRICS_SLOW_REQUEST_SECONDS are logged to
+the 'chat.slow_requests' logger together with their most repeated queries,
+which is usually an N+1 pattern. Time a long poll spends waiting for a
+change (RequestStats.wait_seconds) counts towards neither.
+"""
+import functools
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+
+slow_request_logger = logging.getLogger('chat.slow_requests')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestStats:
+    """What one request spent its time on. Mutated in place, so sync_to_async threads can add to it."""
+
+    def __init__(self):
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.queries = []  # (sql, seconds)
+        self.crypto_seconds = {'encrypt': 0.0, 'decrypt': 0.0}
+        self.wait_seconds = 0.0
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets, labels):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                labels = ','.join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values))
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_LATENCY = Histogram(
+    'chat_request_latency_seconds', "Request latency by view", LATENCY_BUCKETS, ('view', 'method'))
+DB_QUERIES = Histogram(
+    'chat_db_queries_per_request', "Database queries per request by view", QUERY_COUNT_BUCKETS, ('view',))
+DB_SECONDS = Histogram(
+    'chat_db_seconds_per_request', "Database time per request by view", LATENCY_BUCKETS, ('view',))
+CRYPTO_SECONDS = Histogram(
+    'chat_crypto_seconds_per_request', "Message encryption/decryption time per request by view",
+    LATENCY_BUCKETS, ('view', 'operation'))
+
+HISTOGRAMS = [REQUEST_LATENCY, DB_QUERIES, DB_SECONDS, CRYPTO_SECONDS]
+
+
+def render_prometheus():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection by install_query_recorder()."""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.query_count += 1
+        stats.query_seconds += elapsed
+        stats.queries.append((sql, elapsed))
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """connection_created receiver (hooked up in ChatConfig.ready)."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def timed_crypto(operation):
+    """Adds the decorated function's run time to the current request's encrypt/decrypt total."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = _current.get()
+            if stats is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.crypto_seconds[operation] += time.perf_counter() - started
+        return wrapper
+    return decorator
+
+
+_NUMBERS = re.compile(r"\b\d+\b")
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_IN_LISTS = re.compile(r"\((?:\s*(?:%s|\?),?)+\)")
+
+
+def normalize_sql(sql):
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    return _IN_LISTS.sub('(...)', sql.replace('%s', '?'))
+
+
+def repeated_queries(queries, limit=5):
+    """The most frequent query shapes that ran more than once."""
+    counts = Counter(normalize_sql(sql) for sql, _ in queries)
+    return [(count, sql) for sql, count in counts.most_common(limit) if count > 1]
+
+
+def current_stats():
+    """Stats of the request being measured, or None outside MetricsMiddleware."""
+    return _current.get()
+
+
+def begin_request():
+    return _current.set(RequestStats())
+
+
+def end_request(token):
+    stats = _current.get()
+    _current.reset(token)
+    return stats
+
+
+def record_request(request, stats, elapsed):
+    match = getattr(request, 'resolver_match', None)
+    view = (match.view_name or match._func_path) if match else '<unresolved>'
+    elapsed -= stats.wait_seconds
+
+    REQUEST_LATENCY.observe(elapsed, view, request.method)
+    DB_QUERIES.observe(stats.query_count, view)
+    DB_SECONDS.observe(stats.query_seconds, view)
+    for operation, seconds in stats.crypto_seconds.items():
+        CRYPTO_SECONDS.observe(seconds, view, operation)
+
+    threshold = getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', None)
+    if threshold is not None and elapsed >= threshold:
+        repeated = ''.join(f"\n  {count}x {sql}" for count, sql in repeated_queries(stats.queries))
+        slow_request_logger.warning(
+            "Slow request %s %s (%s): %.3fs, %d queries in %.3fs, decrypt %.3fs, encrypt %.3fs%s",
+            request.method, request.path, view, elapsed, stats.query_count, stats.query_seconds,
+            stats.crypto_seconds['decrypt'], stats.crypto_seconds['encrypt'],
+            "\nRepeated queries:" + repeated if repeated else '',
+        )
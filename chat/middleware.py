@@ -0,0 +1,188 @@
+import hashlib
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIRequest
+
+from . import authentication, compression, db_router, metrics, profiling
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def _sticky_key(credential):
+    if not credential:
+        return None
+    return 'dbpin:' + hashlib.sha1(credential.encode()).hexdigest()
+
+
+def _request_sticky_key(request):
+    """Identify the client without touching the database (JWT or session cookie)."""
+    return _sticky_key(request.headers.get('Authorization') or request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+
+
+class HybridMiddleware:
+    """
+    Base for middleware that runs natively in both WSGI and ASGI stacks.
+
+    A sync-only middleware would force every async view behind it back onto a
+    worker thread, so subclasses implement both __call__ and __acall__.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+
+class ReplicaRoutingMiddleware(HybridMiddleware):
+    """
+    Lets read-only requests use the read replicas.
+
+    Unsafe requests (POST, PUT, ...) read from the primary. After a client
+    writes, its reads stay on the primary for REPLICA_STICKY_SECONDS so it
+    never sees a replica that hasn't caught up with its own write yet. The
+    pins are cache keys, so the next request finds them whichever worker
+    process serves it. That takes a cache all of them share: with replicas,
+    a per-process locmem cache refuses to start.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if db_router.get_replicas() and isinstance(caches['default'], LocMemCache):
+            raise ImproperlyConfigured(
+                "Read replicas need a cache shared by all worker processes for read-your-writes "
+                "(PRIVATE_MESSAGING_CACHE=db, or file on a single host), not the per-process locmem cache."
+            )
+
+    def handle(self, request):
+        if not db_router.get_replicas():
+            return self.get_response(request)
+
+        key = _request_sticky_key(request)
+        token = db_router.begin_request(request.method not in SAFE_METHODS or bool(key and cache.get(key)))
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = db_router.end_request(token)
+        if wrote:
+            cache.set_many(self.sticky_keys(key, response), getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+        return response
+
+    async def __acall__(self, request):
+        if not db_router.get_replicas():
+            return await self.get_response(request)
+
+        key = _request_sticky_key(request)
+        token = db_router.begin_request(request.method not in SAFE_METHODS or bool(key and await cache.aget(key)))
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrote = db_router.end_request(token)
+        if wrote:
+            await cache.aset_many(self.sticky_keys(key, response), getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+        return response
+
+    def sticky_keys(self, key, response):
+        keys = {key}
+        # A login hands out a new session; pin that one too so the very
+        # next request can find the session row on the primary.
+        session_cookie = response.cookies.get(settings.SESSION_COOKIE_NAME)
+        if session_cookie is not None:
+            keys.add(_sticky_key(session_cookie.value))
+        return {k: True for k in keys if k}
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """Records latency, DB queries and crypto time per view (see chat/metrics.py)."""
+
+    def handle(self, request):
+        token = metrics.begin_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = metrics.end_request(token)
+        metrics.record_request(request, stats, elapsed)
+        return response
+
+    async def __acall__(self, request):
+        token = metrics.begin_request()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = metrics.end_request(token)
+        metrics.record_request(request, stats, elapsed)
+        return response
+
+
+class CompressionMiddleware(HybridMiddleware):
+    """Compresses large API responses with brotli or gzip, as the client accepts (see chat/compression.py)."""
+
+    def handle(self, request):
+        return compression.compress_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return compression.compress_response(request, await self.get_response(request))
+
+
+class IdentityMapMiddleware(HybridMiddleware):
+    """Opens the request-scoped identity map (see chat/authentication.py)."""
+
+    def handle(self, request):
+        token = authentication.begin_request()
+        try:
+            return self.get_response(request)
+        finally:
+            authentication.end_request(token)
+
+    async def __acall__(self, request):
+        token = authentication.begin_request()
+        try:
+            return await self.get_response(request)
+        finally:
+            authentication.end_request(token)
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """Profiles requests that ask for it with a signed header or a staff-only flag (see chat/profiling.py)."""
+
+    def handle(self, request):
+        if profiling.should_profile(request, lambda: request.user):
+            return profiling.profile_request(request, self.get_response)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if profiling.should_profile(request, None) or (
+                profiling.staff_flag_set(request) and await profiling.aflag_allowed(request)):
+            return await profiling.aprofile_request(request, self.get_response)
+        return await self.get_response(request)
+
+
+class ASGIURLConfMiddleware(HybridMiddleware):
+    """Serves ASGI requests from settings.ASGI_ROOT_URLCONF, which swaps in the async views."""
+
+    async def __acall__(self, request):
+        if isinstance(request, ASGIRequest):
+            request.urlconf = settings.ASGI_ROOT_URLCONF
+        return await self.get_response(request)
@@ -0,0 +1,55 @@
+import json
+import zlib
+from pathlib import PurePosixPath
+
+from django.db import migrations, transaction
+
+
+def scrub_archived_tombstones(apps, schema_editor):
+    """
+    Segments written before archival skipped unpurged tombstones may hold
+    messages deleted for everyone with their ciphertext, file and reactions,
+    and replies quoting them. Drop all of that, and the files once committed.
+    """
+    ArchivedSegment = apps.get_model('chat', 'ArchivedSegment')
+    storage = apps.get_model('chat', 'Message')._meta.get_field('file').storage
+    files = []
+    conversation_id, tombstones = None, set()
+    segments = ArchivedSegment.objects.order_by('conversation_id', 'first_message_id')
+    for segment in segments.iterator(chunk_size=100):
+        if segment.conversation_id != conversation_id:
+            # A reply is newer than its parent, so it comes in the same or a later segment
+            conversation_id, tombstones = segment.conversation_id, set()
+        records = json.loads(zlib.decompress(bytes(segment.data)))
+        changed = False
+        for record in records:
+            if record['is_deleted']:
+                tombstones.add(record['id'])
+                if record['content'] or record['file'] or record['reactions'] or record['read_by'] or record['deleted_by']:
+                    files.append(record['file'])
+                    record.update(content=None, file=None, reactions=[], read_by=[], deleted_by=[])
+                    changed = True
+        for record in records:
+            if record['parent_id'] in tombstones and record['parent_content'] is not None:
+                record['parent_content'] = None
+                changed = True
+        if changed:
+            data = zlib.compress(json.dumps(records, separators=(',', ':')).encode(), 9)
+            ArchivedSegment.objects.filter(pk=segment.pk).update(data=data)
+    names = [name for name in files if name]
+    # And the thumbnails of images (chat.models.thumbnail_name)
+    names += [str(PurePosixPath(name).parent / 'thumbs' / f'{PurePosixPath(name).stem}.webp') for name in names
+              if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))]
+    if names:
+        transaction.on_commit(lambda: [storage.delete(name) for name in names])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_user_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(scrub_archived_tombstones, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+import unicodedata
+
+from django.conf import settings
+from django.db import migrations, transaction
+from django.db.models import Exists, OuterRef
+
+BATCH_SIZE = 1000
+TERM_MAX_LENGTH = 150  # UserSearchTerm.term as of 0013_user_search
+
+
+# Copies of chat.user_search's indexing, frozen here so later changes to it don't change this migration
+def normalize(text):
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in decomposed.casefold() if c.isalnum() and not unicodedata.combining(c))
+
+
+def terms_for(user):
+    names = (user.username, user.first_name, user.last_name, f'{user.first_name}{user.last_name}')
+    return {term[:TERM_MAX_LENGTH] for term in map(normalize, names) if term}
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def grams_for(terms):
+    return set().union(*(trigrams(f'^{term}$') for term in terms))
+
+
+def index_existing_users(apps, schema_editor):
+    """
+    Indexes the users that existed before 0013_user_search, whose accounts
+    the post_save handler never saw, one transaction per batch.
+    """
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    UserSearchTerm = apps.get_model('chat', 'UserSearchTerm')
+    UserSearchGram = apps.get_model('chat', 'UserSearchGram')
+    unindexed = User.objects.filter(~Exists(UserSearchTerm.objects.filter(user=OuterRef('pk'))))
+    last_id = 0
+    while True:
+        batch = list(unindexed.filter(id__gt=last_id).order_by('id')
+                     .only('id', 'username', 'first_name', 'last_name')[:BATCH_SIZE])
+        if not batch:
+            return
+        with transaction.atomic():
+            terms, grams = [], []
+            for user in batch:
+                user_terms = terms_for(user)
+                terms += [UserSearchTerm(user_id=user.id, term=term) for term in user_terms]
+                grams += [UserSearchGram(user_id=user.id, gram=gram) for gram in grams_for(user_terms)]
+            UserSearchGram.objects.filter(user_id__in=[user.id for user in batch]).delete()
+            UserSearchTerm.objects.bulk_create(terms, batch_size=1000)
+            UserSearchGram.objects.bulk_create(grams, batch_size=1000)
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # Batches commit on their own, so a large user table is not indexed in one transaction
+    atomic = False
+
+    dependencies = [
+        ('chat', '0014_scrub_archived_tombstones'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(index_existing_users, migrations.RunPython.noop),
+    ]
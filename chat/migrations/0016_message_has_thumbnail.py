@@ -0,0 +1,36 @@
+from pathlib import PurePosixPath
+
+from django.db import migrations, models
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+
+def mark_existing_thumbnails(apps, schema_editor):
+    """Flags the images whose thumbnail the job made before the field existed (once, instead of on every read)."""
+    Message = apps.get_model('chat', 'Message')
+    storage = Message._meta.get_field('file').storage
+    with_thumbnail = []
+    for message_id, name in Message.objects.exclude(file='').exclude(file__isnull=True).values_list('id', 'file').iterator():
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            # chat.models.thumbnail_name
+            path = PurePosixPath(name)
+            if storage.exists(str(path.parent / 'thumbs' / f'{path.stem}.webp')):
+                with_thumbnail.append(message_id)
+    for start in range(0, len(with_thumbnail), 1000):
+        Message.objects.filter(id__in=with_thumbnail[start:start + 1000]).update(has_thumbnail=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_backfill_user_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='has_thumbnail',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_existing_thumbnails, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,15 @@
+import json
+import zlib
+from datetime import timedelta
+from pathlib import PurePosixPath
+
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import models
+from django.utils import timezone
+from . import bubbles, events
 from .utils import encrypt_message, decrypt_message
+from .write_queue import run_write
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
@@ -10,10 +19,36 @@ User = settings.AUTH_USER_MODEL
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     image = models.ImageField(upload_to='profiles/', default='profiles/default.png', null=True, blank=True)
+    # {'source': image name, '<size>': storage name} of the resized WebP copies
+    # made by the chat.avatar_variants job (chat/tasks.py)
+    avatar_variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+    @property
+    def has_current_variants(self):
+        return bool(self.image) and self.avatar_variants.get('source') == self.image.name
+
+    def variant_urls(self):
+        """{size: URL} of the current image's variants; empty while they are being generated."""
+        if not self.has_current_variants:
+            return {}
+        return {
+            int(size): default_storage.url(name)
+            for size, name in self.avatar_variants.items() if size != 'source'
+        }
+
+    def avatar_url(self, size):
+        """URL of the smallest variant at least `size` pixels wide, else the largest one, else the original."""
+        if not self.image:
+            return None
+        urls = self.variant_urls()
+        if not urls:
+            return self.image.url
+        fitting = [s for s in urls if s >= size]
+        return urls[min(fitting) if fitting else max(urls)]
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
@@ -21,11 +56,19 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 
 class Conversation(models.Model):
+    # Disappearing messages: when the timer is set, each new message expires
+    # that many seconds after it is sent, or after it is first read
+    AFTER_SEND = 'sent'
+    AFTER_READ = 'read'
+    DISAPPEARING_AFTER_CHOICES = [(AFTER_SEND, 'after sending'), (AFTER_READ, 'after reading')]
+
     participants = models.ManyToManyField(
         User,
         related_name='conversations'
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    disappearing_seconds = models.PositiveIntegerField(null=True, blank=True)
+    disappearing_after = models.CharField(max_length=4, choices=DISAPPEARING_AFTER_CHOICES, default=AFTER_SEND)
 
     def __str__(self):
         return f"Conversation {self.id}"
@@ -35,7 +78,55 @@ class Conversation(models.Model):
 
     def get_last_visible_message(self, user):
         """Returns the latest message that isn't deleted for everyone and hasn't been deleted 'for me' by the user."""
-        return self.messages.filter(is_deleted=False).exclude(deleted_by=user).order_by('-timestamp').first()
+        return self.messages.unexpired().filter(is_deleted=False).exclude(deleted_by=user).order_by('-timestamp').first()
+
+    def set_disappearing(self, seconds, after=AFTER_SEND):
+        """Sets the disappearing timer (None turns it off). Only messages sent from now on follow it."""
+        def write():
+            self.disappearing_seconds = seconds or None
+            self.disappearing_after = after
+            self.save(update_fields=['disappearing_seconds', 'disappearing_after'])
+            SyncEvent.objects.create(conversation=self, kind=SyncEvent.CONVERSATION, data={
+                'disappearing_seconds': self.disappearing_seconds, 'disappearing_after': after,
+            })
+            events.notify(self.id, SyncEvent.CONVERSATION)
+        run_write(write)
+
+    def mark_as_read(self, user):
+        """Marks every message from the other participants as read by `user`. Returns the number of new read marks."""
+        def write():
+            ReadMark = Message.read_by.through
+            unread_ids = (
+                self.messages.filter(is_deleted=False).exclude(sender=user).exclude(read_by=user)
+                .values_list('id', flat=True)
+            )
+            marks = [ReadMark(message_id=message_id, user_id=user.id) for message_id in unread_ids]
+            ReadMark.objects.bulk_create(marks, ignore_conflicts=True)
+            if marks:
+                # bulk_create sends no m2m_changed, so record the read cursor here
+                SyncEvent.objects.create(conversation=self, kind=SyncEvent.READ, data={
+                    'user': user.id, 'message': max(mark.message_id for mark in marks),
+                })
+                events.notify(self.id, SyncEvent.READ)
+                Message.start_read_timers([mark.message_id for mark in marks])
+            return len(marks)
+        return run_write(write)
+
+
+def thumbnail_name(file_name):
+    """Storage name of the thumbnail of an uploaded image (made by the chat.thumbnail_message_image job)."""
+    path = PurePosixPath(file_name)
+    return str(path.parent / 'thumbs' / f'{path.stem}.webp')
+
+
+class MessageQuerySet(models.QuerySet):
+    def unexpired(self):
+        """
+        Leaves out disappearing messages past their expiry that the sweeper
+        (purge.expire_messages) hasn't deleted yet. A plain comparison on the
+        row, so it adds no join and keeps the (conversation, timestamp) index usable.
+        """
+        return self.filter(models.Q(expires_at__isnull=True) | models.Q(expires_at__gt=timezone.now()))
 
 
 class Message(models.Model):
@@ -51,19 +142,60 @@ class Message(models.Model):
     content = models.TextField(blank=True, null=True)
     file = models.FileField(upload_to='messages/', null=True, blank=True)
     is_audio = models.BooleanField(default=False)
+    # Set by the chat.thumbnail_message_image job once the image's thumbnail is stored
+    has_thumbnail = models.BooleanField(default=False)
     parent = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
     timestamp = models.DateTimeField(auto_now_add=True)
     
     # Deletion and Read fields
     is_deleted = models.BooleanField(default=False)  # Delete for everyone
+    deleted_at = models.DateTimeField(null=True, blank=True)  # Starts the purge grace period (chat/purge.py)
     deleted_by = models.ManyToManyField(User, related_name='deleted_messages', blank=True)  # Delete for me
     read_by = models.ManyToManyField(User, related_name='read_messages', blank=True)
 
+    # Disappearing messages (see Conversation.disappearing_seconds): deleted by
+    # the sweeper once expires_at passes. In read mode expires_at stays empty
+    # until the first read starts the expires_after_read timer.
+    expires_at = models.DateTimeField(null=True, blank=True)
+    expires_after_read = models.PositiveIntegerField(null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Every listing reads "latest N messages of one conversation"
+            models.Index(fields=['conversation', 'timestamp'], name='chat_msg_conv_ts_idx'),
+            models.Index(fields=['is_deleted', 'deleted_at'], name='chat_msg_tombstone_idx'),
+            # Partial: only disappearing messages are in it, so the sweeper's scan stays small
+            models.Index(fields=['expires_at'], name='chat_msg_expires_idx',
+                         condition=models.Q(expires_at__isnull=False)),
+        ]
+
     def save(self, *args, **kwargs):
         if self.content and not self.content.startswith('gAAAA'): # Simple check to avoid double encryption
             self.content = encrypt_message(self.content)
+        if self._state.adding and self.expires_at is None and self.expires_after_read is None:
+            seconds = self.conversation.disappearing_seconds
+            if seconds and self.conversation.disappearing_after == Conversation.AFTER_READ:
+                self.expires_after_read = seconds
+            elif seconds:
+                self.expires_at = timezone.now() + timedelta(seconds=seconds)
         super().save(*args, **kwargs)
 
+    @classmethod
+    def start_read_timers(cls, message_ids):
+        """Starts the expiry of read-mode disappearing messages among message_ids that just got their first read."""
+        waiting = cls.objects.filter(id__in=message_ids, expires_after_read__isnull=False, expires_at__isnull=True)
+        now = timezone.now()
+        first = None
+        for seconds in waiting.order_by().values_list('expires_after_read', flat=True).distinct():
+            if waiting.filter(expires_after_read=seconds).update(expires_at=now + timedelta(seconds=seconds)):
+                first = seconds if first is None else min(first, seconds)
+        if first is not None:
+            from .purge import schedule_expiry  # chat.purge imports this module
+
+            schedule_expiry(now + timedelta(seconds=first))
+
     @property
     def decrypted_content(self):
         if self.content:
@@ -76,6 +208,31 @@ class Message(models.Model):
             return self.file.name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))
         return False
 
+    @property
+    def thumbnail_url(self):
+        """URL of the image's WebP thumbnail; None for other files and until the job has made it."""
+        if not self.has_thumbnail or not self.is_image:
+            return None
+        return self.file.storage.url(thumbnail_name(self.file.name))
+
+    def delete_for_everyone(self):
+        self.is_deleted = True
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['is_deleted', 'deleted_at'])
+        bubbles.forget([self.id])
+
+    def toggle_reaction(self, user, emoji):
+        """Adds the reaction, or removes it if `user` already reacted with `emoji`. Returns (reaction, created)."""
+        def write():
+            reaction, created = MessageReaction.objects.get_or_create(message=self, user=user, emoji=emoji)
+            if not created:
+                reaction.delete()
+            SyncEvent.objects.create(conversation_id=self.conversation_id, kind=SyncEvent.REACTION, message_id=self.id,
+                                     data={'user': user.id, 'emoji': emoji, 'action': 'added' if created else 'removed'})
+            events.notify(self.conversation_id, SyncEvent.REACTION, self.id)
+            return reaction, created
+        return run_write(write)
+
     def __str__(self):
         return f"{self.sender}: {self.decrypted_content[:50]}"
 
@@ -120,3 +277,133 @@ class MessageReaction(models.Model):
 
     def __str__(self):
         return f"{self.user.username} reacted {self.emoji} to message {self.message.id}"
+
+
+class ArchivedSegment(models.Model):
+    """Cold storage: a zlib-compressed JSON batch of old messages from one conversation (see chat/archive.py)."""
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='archived_segments'
+    )
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', '-last_message_id'], name='chat_segment_conv_last_idx'),
+        ]
+
+    def __str__(self):
+        return f"Conversation {self.conversation_id} messages {self.first_message_id}-{self.last_message_id}"
+
+    @staticmethod
+    def pack(records):
+        return zlib.compress(json.dumps(records, separators=(',', ':')).encode(), 9)
+
+    def unpack(self):
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+
+class SyncEvent(models.Model):
+    """
+    Append-only change log behind the delta sync endpoint (see chat/sync.py).
+    The id doubles as the sync sequence number.
+    """
+    MESSAGE = 'message'  # created or changed (incl. deleted for everyone)
+    HIDDEN = 'hidden'  # deleted for `user` only
+    REACTION = 'reaction'
+    READ = 'read'
+    CONVERSATION = 'conversation'  # participants, their profiles or the conversation's settings changed
+    KIND_CHOICES = [(kind, kind) for kind in (MESSAGE, HIDDEN, REACTION, READ, CONVERSATION)]
+
+    id = models.BigAutoField(primary_key=True)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='sync_events')
+    # Set for events only one user may see
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    message_id = models.BigIntegerField(null=True, blank=True)
+    data = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'id'], name='chat_sync_conv_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.kind} in conversation {self.conversation_id}"
+
+
+class UserSearchTerm(models.Model):
+    """A user's username or name, normalized for prefix search (see chat/user_search.py)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    term = models.CharField(max_length=150)
+
+    class Meta:
+        indexes = [
+            # Covers the prefix range scan, user ids included
+            models.Index(fields=['term', 'user'], name='chat_usersearch_term_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.term} -> user {self.user_id}"
+
+
+class UserSearchGram(models.Model):
+    """A trigram of a user's normalized names, for typo-tolerant search (see chat/user_search.py)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['gram', 'user'], name='chat_usersearch_gram_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.gram} -> user {self.user_id}"
+
+
+class Job(models.Model):
+    """A unit of deferred work for `manage.py run_worker` (see chat/jobs.py)."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(status, status) for status in (QUEUED, RUNNING, DONE, FAILED)]
+
+    name = models.CharField(max_length=100)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0)  # higher runs first
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    # At most one queued job per key; enqueueing again while one waits can only move it up
+    dedupe_key = models.CharField(max_length=200, null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    # A running job whose worker died becomes claimable again after this
+    locked_until = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='chat_job_status_run_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'], condition=models.Q(status='queued'),
+                name='chat_job_pending_dedupe_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
@@ -0,0 +1,50 @@
+"""
+Server-directed polling intervals.
+
+Responses of the message polling endpoints, 304s included, carry
+X-Poll-Interval: how many milliseconds the client should wait before its
+next poll. The interval grows with the time since the conversation last
+changed (settings.POLL_INTERVALS). A lively chat is polled every couple of
+seconds and a dormant one twice a minute. A client whose tab is hidden
+sends X-Page-Visibility: hidden and is told to wait at least
+POLL_HIDDEN_INTERVAL_MS. Keep that below PRESENCE_ONLINE_SECONDS, because
+polls also keep the user online. Long polls (?wait on the async endpoints)
+already wait for changes on the server, so a visible client may ask again
+right away.
+
+Intervals are spread by up to POLL_JITTER, so clients that loaded together
+do not keep polling in step.
+"""
+import random
+
+from django.conf import settings
+from django.utils import timezone
+
+HEADER = 'X-Poll-Interval'
+VISIBILITY_HEADER = 'X-Page-Visibility'
+
+
+def is_visible(request):
+    return request.headers.get(VISIBILITY_HEADER, 'visible') != 'hidden'
+
+
+def next_poll_ms(last_change, visible=True, long_poll=False):
+    """Milliseconds until the next poll of a conversation last changed at last_change (None: never)."""
+    if long_poll and visible:
+        return 0
+    idle = (timezone.now() - last_change).total_seconds() if last_change else float('inf')
+    interval = getattr(settings, 'POLL_IDLE_INTERVAL_MS', 30000)
+    for seconds, ms in getattr(settings, 'POLL_INTERVALS', ()):
+        if idle <= seconds:
+            interval = ms
+            break
+    if not visible:
+        interval = max(interval, getattr(settings, 'POLL_HIDDEN_INTERVAL_MS', 30000))
+    jitter = getattr(settings, 'POLL_JITTER', 0.1)
+    return round(interval * random.uniform(1 - jitter, 1 + jitter))
+
+
+def hint(response, request, last_change, long_poll=False):
+    """Sets X-Poll-Interval on response and returns it."""
+    response[HEADER] = str(next_poll_ms(last_change, is_visible(request), long_poll))
+    return response
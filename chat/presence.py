@@ -0,0 +1,138 @@
+"""
+Online and typing indicators.
+
+Both live only in a TTL store, never in the database: a user counts as
+online for PRESENCE_ONLINE_SECONDS after their last poll or heartbeat, and
+as typing in a conversation for PRESENCE_TYPING_SECONDS after their last
+keystroke ping. settings.PRESENCE_BACKEND picks the store:
+
+- chat.presence.MemoryBackend (default): a dict in this process. Enough
+  for a single worker process (threads or ASGI).
+- chat.presence.CacheBackend: a Django cache alias shared by all workers
+  (PRESENCE_BACKEND_OPTIONS = {'alias': ...}). Use Redis or Memcached, not
+  the database cache.
+"""
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class MemoryBackend:
+    """Per-process TTL dict. Expired entries are dropped on read and swept every few hundred writes."""
+    in_process = True
+    SWEEP_EVERY = 500
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.writes += 1
+            if self.writes % self.SWEEP_EVERY == 0:
+                now = time.monotonic()
+                for stale in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+                    del self.entries[stale]
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                found[key] = entry[1]
+        return found
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class CacheBackend:
+    """Stores entries in a Django cache shared by every worker process."""
+    in_process = False
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def set(self, key, value, ttl):
+        self.cache.set(f'presence:{key}', value, ttl)
+
+    def get_many(self, keys):
+        found = self.cache.get_many([f'presence:{key}' for key in keys])
+        return {key[len('presence:'):]: value for key, value in found.items()}
+
+    def delete(self, key):
+        self.cache.delete(f'presence:{key}')
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_class = import_string(getattr(settings, 'PRESENCE_BACKEND', 'chat.presence.MemoryBackend'))
+                _backend = backend_class(**getattr(settings, 'PRESENCE_BACKEND_OPTIONS', {}))
+    return _backend
+
+
+def _online_key(user_id):
+    return f'online:{user_id}'
+
+
+def _typing_key(conversation_id, user_id):
+    return f'typing:{conversation_id}:{user_id}'
+
+
+def touch(user_id):
+    """Marks a user online (called on polls and heartbeats)."""
+    get_backend().set(_online_key(user_id), time.time(), getattr(settings, 'PRESENCE_ONLINE_SECONDS', 45))
+
+
+async def atouch(user_id):
+    """touch() for async views; shared backends do network I/O, so they run in a thread."""
+    if get_backend().in_process:
+        touch(user_id)
+    else:
+        await sync_to_async(touch)(user_id)
+
+
+def last_seen(user_ids):
+    """{user id: unix time of last activity} for the users that are online right now."""
+    found = get_backend().get_many([_online_key(user_id) for user_id in user_ids])
+    return {user_id: found[_online_key(user_id)] for user_id in user_ids if _online_key(user_id) in found}
+
+
+def set_typing(conversation_id, user_id, typing=True):
+    backend = get_backend()
+    if typing:
+        backend.set(_typing_key(conversation_id, user_id), 1, getattr(settings, 'PRESENCE_TYPING_SECONDS', 6))
+    else:
+        backend.delete(_typing_key(conversation_id, user_id))
+    touch(user_id)
+
+
+def typing(pairs):
+    """Of the given (conversation id, user id) pairs, those whose user is typing there."""
+    pairs = list(pairs)
+    found = get_backend().get_many([_typing_key(*pair) for pair in pairs])
+    return [pair for pair in pairs if _typing_key(*pair) in found]
+
+
+def conversation_state(conversation_id, participant_ids, viewer_id):
+    """Presence of the other participants of a conversation, as served to clients."""
+    others = [user_id for user_id in participant_ids if user_id != viewer_id]
+    return {
+        'online': last_seen(others),
+        'typing': [user_id for _, user_id in typing((conversation_id, user_id) for user_id in others)],
+    }
@@ -0,0 +1,202 @@
+"""
+On-demand request profiling.
+
+A request is profiled when it carries an `X-Profile` header holding a token
+from make_profile_token() (handed out on the staff captures page), or when
+a staff user adds `?_profile=1`. A token names the staff user it was made
+for and only profiles requests authenticated as them. The flag is only
+honoured once a staff user is identified: by session, or for API requests
+by authenticating their Bearer token up front (a cached lookup, see
+chat/authentication.py), so nobody else can make the server pay for
+cProfile. DRF and the async views authenticate JWT requests again inside
+the view, and keep_capture() decides afterwards, once the user is known,
+whether a capture is stored.
+
+A capture is written to settings.PROFILE_CAPTURE_DIR as two files sharing
+a name: `<name>.prof` (pstats, loadable with snakeviz or pstats) and
+`<name>.txt` (request summary, hottest functions and every SQL query with
+its duration). Only the newest settings.PROFILE_CAPTURE_KEEP captures are
+kept.
+"""
+import io
+import re
+import time
+from pathlib import Path
+
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.core import signing
+from rest_framework.exceptions import AuthenticationFailed
+
+from . import metrics
+from .authentication import CachedJWTAuthentication
+
+TOKEN_SALT = 'chat.profiling'
+
+
+def make_profile_token(user):
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(str(user.pk))
+
+
+def token_user_id(token):
+    """The id of the user a valid, unexpired token was made for, else None."""
+    try:
+        value = signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            token, max_age=getattr(settings, 'PROFILE_TOKEN_MAX_AGE', 3600))
+    except signing.BadSignature:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def staff_flag_set(request):
+    return request.GET.get('_profile') == '1'
+
+
+def is_staff(user):
+    return bool(user and user.is_authenticated and user.is_staff)
+
+
+def bearer_user(request):
+    """The user of the request's Bearer token; None without one or for a bad token."""
+    try:
+        result = CachedJWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def flag_allowed(request, session_user):
+    """Whether ?_profile=1 may profile: staff by session, or by Bearer token for API requests."""
+    if is_staff(session_user):
+        return True
+    return 'Authorization' in request.headers and is_staff(bearer_user(request))
+
+
+async def aflag_allowed(request):
+    if is_staff(await request.auser()):
+        return True
+    return 'Authorization' in request.headers and is_staff(await sync_to_async(bearer_user)(request))
+
+
+def should_profile(request, get_user):
+    """
+    get_user returns the request's session user; it is only called for the
+    staff flag. Async callers pass None and check the staff flag themselves
+    with aflag_allowed().
+    """
+    token = request.headers.get('X-Profile')
+    if token:
+        return token_user_id(token) is not None
+    if get_user is not None and staff_flag_set(request):
+        return flag_allowed(request, get_user())
+    return False
+
+
+def keep_capture(request, user):
+    """Whether the request, authenticated as user by the view, may be profiled after all."""
+    if not is_staff(user):
+        return False
+    token = request.headers.get('X-Profile')
+    return not token or token_user_id(token) == user.pk
+
+
+def capture_dir():
+    path = Path(getattr(settings, 'PROFILE_CAPTURE_DIR', settings.BASE_DIR / 'profile_captures'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def list_captures():
+    """Newest first: [(name, modified timestamp, .prof size in bytes)]"""
+    captures = [(p.stem, p.stat().st_mtime, p.stat().st_size) for p in capture_dir().glob('*.prof')]
+    return sorted(captures, key=lambda c: c[1], reverse=True)
+
+
+def capture_path(name, suffix):
+    """Path of one capture file, or None if the name isn't a capture."""
+    if not re.fullmatch(r'[\w.-]+', name) or suffix not in ('.prof', '.txt'):
+        return None
+    path = capture_dir() / f'{name}{suffix}'
+    return path if path.exists() else None
+
+
+def _rotate(directory):
+    keep = getattr(settings, 'PROFILE_CAPTURE_KEEP', 50)
+    for name, *_ in list_captures()[keep:]:
+        for suffix in ('.prof', '.txt'):
+            (directory / f'{name}{suffix}').unlink(missing_ok=True)
+
+
+def _start():
+    import cProfile  # only profiled requests need it
+
+    stats = metrics.current_stats()
+    profiler = cProfile.Profile()
+    state = (profiler, stats, len(stats.queries) if stats else 0, time.perf_counter())
+    profiler.enable()
+    return state
+
+
+def _finish(request, user, response, state):
+    profiler, stats, queries_before, started = state
+    elapsed = time.perf_counter() - started
+    if not keep_capture(request, user):
+        return response
+
+    match = getattr(request, 'resolver_match', None)
+    view = (match.view_name if match else '') or 'unresolved'
+    username = user.username if user is not None and user.is_authenticated else 'anonymous'
+    name = re.sub(r'[^\w.-]', '_', f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{view}-{username}")
+
+    directory = capture_dir()
+    profiler.dump_stats(directory / f'{name}.prof')
+
+    import pstats
+
+    hot = io.StringIO()
+    pstats.Stats(profiler, stream=hot).sort_stats('cumulative').print_stats(40)
+    queries = stats.queries[queries_before:] if stats else []
+    lines = [
+        f"{request.method} {request.get_full_path()}",
+        f"view: {view}",
+        f"user: {username}",
+        f"status: {response.status_code}",
+        f"time: {elapsed:.4f}s",
+        f"queries: {len(queries)} in {sum(seconds for _, seconds in queries):.4f}s",
+        "",
+        "== SQL ==",
+        *(f"[{seconds * 1000:8.2f} ms] {sql}" for sql, seconds in queries),
+        "",
+        "== Profile (cumulative) ==",
+        hot.getvalue(),
+    ]
+    (directory / f'{name}.txt').write_text('\n'.join(lines))
+    _rotate(directory)
+
+    response['X-Profile-Capture'] = name
+    return response
+
+
+def profile_request(request, get_response):
+    """Runs get_response(request) under cProfile and stores the capture."""
+    state = _start()
+    try:
+        response = get_response(request)
+    finally:
+        state[0].disable()
+    # DRF sets request.user when it authenticates
+    return _finish(request, getattr(request, 'user', None), response, state)
+
+
+async def aprofile_request(request, get_response):
+    """
+    Async variant. cProfile follows the event loop thread, so work of other
+    requests interleaved on the loop shows up in the capture as well.
+    """
+    state = _start()
+    try:
+        response = await get_response(request)
+    finally:
+        state[0].disable()
+    # The async views' JWT user (chat.async_views.jwt_user), else the session's
+    return _finish(request, getattr(request, 'api_user', None) or await request.auser(), response, state)
@@ -0,0 +1,202 @@
+"""
+Purge and compaction of deleted messages.
+
+"Delete for everyone" only leaves a tombstone (is_deleted=True). After
+settings.MESSAGE_PURGE_GRACE_DAYS the purge drops everything the tombstone
+no longer needs: ciphertext, attachment file, reactions and read_by /
+deleted_by rows. Messages that every participant deleted for themselves
+are removed outright. Archival leaves tombstones hot until then, and every
+path here also blanks the removed messages' quotes in archived replies.
+
+Disappearing messages are deleted outright once their expires_at passes
+(expire_messages, run by the chat.expire_messages job). Listings already
+hide them from that moment on with Message.objects.unexpired(). The job
+is queued for the earliest expires_at (schedule_expiry), so it only runs
+when there is something to delete.
+
+Each batch is its own transaction and the selection only matches work that
+is still left to do, so an interrupted run simply continues where it
+stopped on the next run.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from . import bubbles, events
+from .jobs import enqueue
+from .archive import forget_archived_parents
+from .models import Conversation, Message, MessageReaction, SyncEvent, thumbnail_name
+
+ReadMark = Message.read_by.through
+DeletedMark = Message.deleted_by.through
+Participant = Conversation.participants.through
+
+
+def _delete_files_on_commit(names):
+    """Deletes the attachments, and the thumbnails of images, once the transaction commits."""
+    storage = Message._meta.get_field('file').storage
+    names = [name for name in names if name]
+    names += [thumbnail_name(name) for name in names if Message(file=name).is_image]
+    if names:
+        transaction.on_commit(lambda: [storage.delete(name) for name in names])
+
+
+def tombstones_to_purge(cutoff):
+    # deleted_at is NULL for tombstones made before it existed: treat as old
+    return Message.objects.filter(
+        Q(deleted_at__lt=cutoff) | Q(deleted_at__isnull=True),
+        is_deleted=True,
+    ).filter(
+        Q(content__isnull=False)
+        | ~Q(file='')
+        | Exists(MessageReaction.objects.filter(message=OuterRef('pk')))
+        | Exists(ReadMark.objects.filter(message=OuterRef('pk')))
+        | Exists(DeletedMark.objects.filter(message=OuterRef('pk')))
+    )
+
+
+def deleted_by_everyone():
+    def count(queryset, field):
+        return Subquery(
+            queryset.order_by().values(field).annotate(n=Count('*')).values('n')
+        )
+
+    return Message.objects.filter(
+        Exists(DeletedMark.objects.filter(message=OuterRef('pk')))
+    ).annotate(
+        deleted_count=count(DeletedMark.objects.filter(message=OuterRef('pk')), 'message'),
+        participant_count=count(Participant.objects.filter(conversation=OuterRef('conversation_id')), 'conversation'),
+    ).filter(deleted_count__gte=F('participant_count'))
+
+
+def purge_tombstone_batch(cutoff, batch_size):
+    with transaction.atomic():
+        batch = list(tombstones_to_purge(cutoff).order_by('id').values_list('id', 'conversation_id', 'file')[:batch_size])
+        if not batch:
+            return 0
+        ids = [message_id for message_id, _, _ in batch]
+        MessageReaction.objects.filter(message_id__in=ids).delete()
+        ReadMark.objects.filter(message_id__in=ids).delete()
+        DeletedMark.objects.filter(message_id__in=ids).delete()
+        Message.objects.filter(id__in=ids).update(content=None, file='', has_thumbnail=False)
+        bubbles.forget(ids)
+        forget_archived_parents((message_id, conversation_id) for message_id, conversation_id, _ in batch)
+        _delete_files_on_commit(name for _, _, name in batch)
+        return len(ids)
+
+
+def delete_hidden_batch(batch_size):
+    with transaction.atomic():
+        batch = list(deleted_by_everyone().order_by('id').values_list('id', 'conversation_id', 'file')[:batch_size])
+        if not batch:
+            return 0
+        # Cascades to reactions and join rows; replies keep existing with parent=NULL
+        ids = [message_id for message_id, _, _ in batch]
+        Message.objects.filter(id__in=ids).delete()
+        bubbles.forget(ids)
+        forget_archived_parents((message_id, conversation_id) for message_id, conversation_id, _ in batch)
+        _delete_files_on_commit(name for _, _, name in batch)
+        return len(batch)
+
+
+def expired_messages(now):
+    return Message.objects.filter(expires_at__lte=now)
+
+
+def delete_expired_batch(now, batch_size):
+    """Deletes up to batch_size expired messages with their files, reactions and join rows."""
+    with transaction.atomic():
+        batch = list(expired_messages(now).order_by('expires_at').values_list('id', 'conversation_id', 'file')[:batch_size])
+        if not batch:
+            return 0
+        # Cascades to reactions and join rows; replies keep existing with parent=NULL
+        ids = [message_id for message_id, _, _ in batch]
+        Message.objects.filter(id__in=ids).delete()
+        bubbles.forget(ids)
+        forget_archived_parents((message_id, conversation_id) for message_id, conversation_id, _ in batch)
+        # Sync clients see the ids as deleted; pollers' ETags change
+        SyncEvent.objects.bulk_create([
+            SyncEvent(conversation_id=conversation_id, kind=SyncEvent.MESSAGE, message_id=message_id)
+            for message_id, conversation_id, _ in batch
+        ])
+        for message_id, conversation_id, _ in batch:
+            events.notify(conversation_id, SyncEvent.MESSAGE, message_id)
+        _delete_files_on_commit(name for _, _, name in batch)
+        return len(batch)
+
+
+def expire_messages(batch_size=None, max_batches=None, pause=0.0):
+    """Deletes the messages that expired so far, one transaction per batch. Returns the count."""
+    batch_size = batch_size or getattr(settings, 'MESSAGE_EXPIRY_BATCH_SIZE', 500)
+    now = timezone.now()
+    total = batches = 0
+    while not (max_batches and batches >= max_batches):
+        done = delete_expired_batch(now, batch_size)
+        total += done
+        batches += 1
+        if done < batch_size:
+            break
+        time.sleep(pause)
+    return total
+
+
+def schedule_expiry(expires_at=None):
+    """
+    Queues the chat.expire_messages job for expires_at, or for the next
+    expiry on record. It runs at most MESSAGE_EXPIRY_MAX_DELAY_SECONDS from
+    now, and a sweep already queued for later is moved up.
+    """
+    if expires_at is None:
+        expires_at = (Message.objects.filter(expires_at__isnull=False).order_by('expires_at')
+                      .values_list('expires_at', flat=True).first())
+        if expires_at is None:
+            return None
+    delay = min(max((expires_at - timezone.now()).total_seconds(), 0),
+                getattr(settings, 'MESSAGE_EXPIRY_MAX_DELAY_SECONDS', 3600))
+    return enqueue('chat.expire_messages', dedupe_key='expire-messages', delay=delay)
+
+
+def compact():
+    """Reclaim the freed space and refresh planner statistics."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute("VACUUM")
+            cursor.execute("ANALYZE")
+        elif connection.vendor == 'postgresql':
+            for model in (Message, MessageReaction, ReadMark, DeletedMark):
+                cursor.execute(f"VACUUM ANALYZE {connection.ops.quote_name(model._meta.db_table)}")
+
+
+def purge_messages(grace=None, batch_size=None, max_batches=None, pause=0.0, vacuum=True, log=None):
+    """
+    Runs both purges batch by batch, sleeping `pause` seconds between batches
+    to leave room for live traffic. Returns (tombstones purged, messages deleted).
+    """
+    if grace is None:
+        grace = timedelta(days=getattr(settings, 'MESSAGE_PURGE_GRACE_DAYS', 30))
+    batch_size = batch_size or getattr(settings, 'MESSAGE_PURGE_BATCH_SIZE', 500)
+    cutoff = timezone.now() - grace
+
+    totals = [0, 0]
+    batches = 0
+    for index, run_batch in enumerate((lambda: purge_tombstone_batch(cutoff, batch_size),
+                                       lambda: delete_hidden_batch(batch_size))):
+        while not (max_batches and batches >= max_batches):
+            done = run_batch()
+            if not done:
+                break
+            totals[index] += done
+            batches += 1
+            if log:
+                log(f"batch {batches}: {done} messages")
+            if done < batch_size:
+                break
+            time.sleep(pause)
+
+    if vacuum and any(totals):
+        compact()
+    return tuple(totals)
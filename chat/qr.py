@@ -0,0 +1,92 @@
+"""
+QR codes of a user's chat-request link (views.my_qr).
+
+A code depends only on the encoded URL, its size and its format. Each
+rendering is therefore kept in the Django cache (bounded by its
+MAX_ENTRIES), and the ETag is derived from those inputs, so conditional
+requests are answered without rendering or a cache lookup. A size too
+small to give every module of the code a pixel (min_size) is refused,
+since the image would be cropped.
+"""
+import hashlib
+import re
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+
+FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+# Bump when the rendering changes, so cached images and client ETags are replaced
+RENDER_VERSION = 1
+BORDER = 4  # modules of quiet zone, the minimum the QR spec allows
+# Version 40, the largest code, with its border: any url fits this many pixels
+LARGEST_MODULES = 177 + 2 * BORDER
+
+
+def size_limits():
+    return getattr(settings, 'QR_MIN_SIZE', 64), getattr(settings, 'QR_MAX_SIZE', 1024)
+
+
+def _fingerprint(url, size, fmt):
+    return hashlib.sha256(f'{RENDER_VERSION}:{fmt}:{size}:{url}'.encode()).hexdigest()[:32]
+
+
+def etag(url, size, fmt):
+    return f'"qr-{_fingerprint(url, size, fmt)}"'
+
+
+def _code(url):
+    import qrcode
+
+    code = qrcode.QRCode(border=BORDER)
+    code.add_data(url)
+    code.make(fit=True)
+    return code
+
+
+def min_size(url):
+    """The smallest size at which url's code gets a pixel per module; smaller ones would be cropped."""
+    return _code(url).modules_count + 2 * BORDER
+
+
+def fits(url, size):
+    # Sizes that fit any code need no encoding (nor the qrcode import)
+    return size >= LARGEST_MODULES or size >= min_size(url)
+
+
+def _make(url, size):
+    code = _code(url)
+    # Whole pixels per module keep the code crisp; the remainder becomes margin
+    code.box_size = size // (code.modules_count + 2 * BORDER)
+    return code
+
+
+def _render_png(url, size):
+    from PIL import Image
+
+    image = _make(url, size).make_image().get_image().convert('L')
+    canvas = Image.new('L', (size, size), 255)
+    canvas.paste(image, ((size - image.width) // 2, (size - image.height) // 2))
+    output = BytesIO()
+    canvas.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+
+def _render_svg(url, size):
+    from qrcode.image.svg import SvgPathImage
+
+    output = BytesIO()
+    _make(url, size).make_image(image_factory=SvgPathImage).save(output)
+    # The image is drawn in viewBox units; show it at `size` pixels instead of millimetres
+    return re.sub(rb'width="[^"]*" height="[^"]*"', f'width="{size}" height="{size}"'.encode(),
+                  output.getvalue(), count=1)
+
+
+def render(url, size, fmt):
+    """The image bytes, from the cache or freshly rendered."""
+    key = f'chat:qr:{_fingerprint(url, size, fmt)}'
+    data = cache.get(key)
+    if data is None:
+        data = _render_svg(url, size) if fmt == 'svg' else _render_png(url, size)
+        cache.set(key, data, getattr(settings, 'QR_CACHE_SECONDS', 7 * 86400))
+    return data
@@ -0,0 +1,63 @@
+"""
+MessagePack for the REST API, alongside JSON.
+
+Clients opt in per request: `Accept: application/msgpack` for responses,
+`Content-Type: application/msgpack` for request bodies. The payload has the
+same shape as the JSON one, but it is smaller and faster to decode on mobile.
+Needs the msgpack package (in requirements.txt); settings only registers
+these classes when it is installed.
+"""
+import importlib.util
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+MEDIA_TYPE = 'application/msgpack'
+
+_encoder = JSONEncoder()
+
+
+def available():
+    return importlib.util.find_spec('msgpack') is not None
+
+
+def _default(obj):
+    # Lazy strings, Decimals, UUIDs, ... become what the JSON renderer makes of them
+    return _encoder.default(obj)
+
+
+def packb(data):
+    import msgpack
+
+    return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+def accepts_msgpack(request):
+    """For views outside DRF: True if the client asks for MessagePack and it is installed."""
+    return MEDIA_TYPE in request.headers.get('Accept', '') and available()
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return packb(data)
+
+
+class MessagePackParser(BaseParser):
+    media_type = MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        import msgpack
+
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.UnpackException) as exc:
+            raise ParseError(f"MessagePack parse error - {exc}")
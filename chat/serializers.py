@@ -1,6 +1,10 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils.dateparse import parse_datetime
 from .models import Profile, Conversation, Message, ChatRequest, MessageReaction
+from .authentication import profile_for
+from .utils import decrypt_message
 
 User = get_user_model()
 
@@ -8,32 +12,47 @@ User = get_user_model()
 class UserSerializer(serializers.ModelSerializer):
     """Serializer for User model"""
     profile_image = serializers.SerializerMethodField()
+    profile_images = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ['id', 'username', 'email', 'first_name', 'last_name', 'date_joined', 'profile_image']
+        fields = ['id', 'username', 'email', 'first_name', 'last_name', 'date_joined', 'profile_image',
+                  'profile_images']
         read_only_fields = ['id', 'date_joined']
 
     def get_profile_image(self, obj):
+        """The largest avatar variant (the original until the variants are generated)"""
         try:
-            if obj.profile and obj.profile.image:
-                return obj.profile.image.url
+            profile = profile_for(obj)
+            if profile and profile.image:
+                return profile.avatar_url(max(getattr(settings, 'AVATAR_SIZES', (64, 128, 256))))
         except:
             pass
         return None
 
+    def get_profile_images(self, obj):
+        """{"<size>": URL} of the square avatar variants; empty until they are generated"""
+        profile = profile_for(obj)
+        if profile is None:
+            return {}
+        return {str(size): url for size, url in profile.variant_urls().items()}
+
 
 class ProfileSerializer(serializers.ModelSerializer):
     """Serializer for Profile model"""
     username = serializers.CharField(source='user.username', read_only=True)
     first_name = serializers.CharField(source='user.first_name', required=False)
     last_name = serializers.CharField(source='user.last_name', required=False)
+    image_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = Profile
-        fields = ['id', 'user', 'username', 'first_name', 'last_name', 'image']
+        fields = ['id', 'user', 'username', 'first_name', 'last_name', 'image', 'image_variants']
         read_only_fields = ['id', 'user']
 
+    def get_image_variants(self, obj):
+        return {str(size): url for size, url in obj.variant_urls().items()}
+
     def update(self, instance, validated_data):
         user_data = validated_data.pop('user', {})
         first_name = user_data.get('first_name')
@@ -64,16 +83,30 @@ class MessageSerializer(serializers.ModelSerializer):
     reactions = MessageReactionSerializer(many=True, read_only=True)
     decrypted_content = serializers.CharField(read_only=True)
     is_image = serializers.BooleanField(read_only=True)
+    thumbnail_url = serializers.CharField(read_only=True, allow_null=True)
     parent_content = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
         fields = [
             'id', 'conversation', 'sender', 'content', 'decrypted_content',
-            'file', 'is_audio', 'is_image', 'parent', 'timestamp', 'is_deleted',
-            'deleted_by', 'reactions', 'parent_content'
+            'file', 'is_audio', 'is_image', 'thumbnail_url', 'parent', 'timestamp', 'is_deleted',
+            'deleted_by', 'reactions', 'parent_content', 'expires_at'
         ]
-        read_only_fields = ['id', 'sender', 'timestamp', 'decrypted_content', 'is_image']
+        read_only_fields = ['id', 'sender', 'timestamp', 'decrypted_content', 'is_image', 'thumbnail_url',
+                            'expires_at']
+
+    def validate_conversation(self, conversation):
+        if not conversation.participants.filter(id=self.context['request'].user.id).exists():
+            raise serializers.ValidationError("You are not a participant of this conversation")
+        return conversation
+
+    def validate(self, attrs):
+        conversation = attrs.get('conversation', getattr(self.instance, 'conversation', None))
+        parent = attrs.get('parent')
+        if parent and conversation and parent.conversation_id != conversation.id:
+            raise serializers.ValidationError({'parent': "Can only reply to a message of the same conversation"})
+        return attrs
 
     def get_parent_content(self, obj):
         if obj.parent:
@@ -81,6 +114,48 @@ class MessageSerializer(serializers.ModelSerializer):
         return None
 
 
+def serialize_archived_messages(records, conversation_id):
+    """Renders archived message records (see chat/archive.py) in the same shape as MessageSerializer."""
+    user_ids = {r['sender_id'] for r in records}
+    user_ids.update(reaction['user_id'] for r in records for reaction in r['reactions'])
+    users = {
+        user.id: UserSerializer(user).data
+        for user in User.objects.filter(id__in=user_ids).select_related('profile')
+    }
+    timestamp_field = serializers.DateTimeField()
+
+    data = []
+    for r in records:
+        # Unsaved instance, only used for its file URL and decryption helpers
+        message = Message(content=r['content'], file=r['file'], has_thumbnail=r.get('has_thumbnail', False))
+        data.append({
+            'id': r['id'],
+            'conversation': conversation_id,
+            'sender': users.get(r['sender_id']),
+            'content': r['content'],
+            'decrypted_content': message.decrypted_content,
+            'file': message.file.url if message.file else None,
+            'is_audio': r['is_audio'],
+            'is_image': message.is_image,
+            'thumbnail_url': message.thumbnail_url,
+            'parent': r['parent_id'],
+            'timestamp': timestamp_field.to_representation(parse_datetime(r['timestamp'])),
+            'is_deleted': r['is_deleted'],
+            'deleted_by': r['deleted_by'],
+            'reactions': [{
+                'id': reaction['id'],
+                'message': r['id'],
+                'user': users.get(reaction['user_id']),
+                'emoji': reaction['emoji'],
+                'created_at': timestamp_field.to_representation(parse_datetime(reaction['created_at'])),
+            } for reaction in r['reactions']],
+            'parent_content': decrypt_message(r['parent_content']) if r['parent_id'] else None,
+            'expires_at': None,
+            'archived': True,
+        })
+    return data
+
+
 class ConversationSerializer(serializers.ModelSerializer):
     """Serializer for Conversation model"""
     participants = UserSerializer(many=True, read_only=True)
@@ -90,8 +165,10 @@ class ConversationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
-        fields = ['id', 'participants', 'created_at', 'last_message', 'other_user', 'unread_count']
-        read_only_fields = ['id', 'created_at']
+        fields = ['id', 'participants', 'created_at', 'last_message', 'other_user', 'unread_count',
+                  'disappearing_seconds', 'disappearing_after']
+        # Changed through the disappearing action (ConversationViewSet.disappearing)
+        read_only_fields = ['id', 'created_at', 'disappearing_seconds', 'disappearing_after']
     
     def get_last_message(self, obj):
         request = self.context.get('request')
@@ -114,7 +191,9 @@ class ConversationSerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         user = request.user if request else None
         if user:
-            return obj.messages.exclude(sender=user).exclude(read_by=user).count()
+            # Tombstones never get read marks (Conversation.mark_as_read)
+            return (obj.messages.unexpired().filter(is_deleted=False)
+                    .exclude(sender=user).exclude(read_by=user).count())
         return 0
 
 
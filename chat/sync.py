@@ -0,0 +1,289 @@
+"""
+Account-wide delta sync.
+
+Every change a client needs to replay is appended to SyncEvent: new and
+changed messages, deletions for one user, read marks, participant changes
+and participants' names and avatars by the signal handlers below; reactions
+and bulk read marks by Message.toggle_reaction and Conversation.mark_as_read.
+Each is also announced on the event bus (chat/events.py) to wake waiting
+pollers. The event id is the sync sequence. Clients hold it as an opaque
+signed token. changes_since() turns the events after a token into current
+message state plus deltas, one bounded page at a time. The newest event id
+of a conversation, with the last expiry that has passed there, also serves
+as its version stamp for ETags on the polling endpoints, and the time of
+that change sets how soon they ask clients to poll again (chat/polling.py).
+
+Under Postgres, concurrent transactions can commit out of id order. Events
+younger than settings.SYNC_SETTLE_SECONDS are therefore held back, so a page
+never skips an id that commits later. SQLite serializes writers and needs no
+delay.
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db.models import Min, OuterRef, Q, Subquery
+from django.db.models.signals import m2m_changed, post_save
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+
+from . import events
+from .models import Conversation, Message, Profile, SyncEvent
+
+TOKEN_SALT = 'chat.sync'
+ETAG_FORMAT = 'v2'
+
+
+class InvalidSyncToken(Exception):
+    pass
+
+
+def make_token(seq):
+    return signing.dumps(seq, salt=TOKEN_SALT)
+
+
+def read_token(token):
+    try:
+        seq = signing.loads(token, salt=TOKEN_SALT)
+    except signing.BadSignature:
+        raise InvalidSyncToken(token)
+    if not isinstance(seq, int) or seq < 0:
+        raise InvalidSyncToken(token)
+    return seq
+
+
+# Change capture
+
+def _message_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        SyncEvent.objects.create(conversation_id=instance.conversation_id, kind=SyncEvent.MESSAGE,
+                                 message_id=instance.id)
+        events.notify(instance.conversation_id, SyncEvent.MESSAGE, instance.id)
+
+
+def _message_users(sender, instance, action, reverse, pk_set, **kwargs):
+    """m2m_changed for Message.deleted_by / Message.read_by, from either side."""
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:  # user.deleted_messages.add(*messages)
+        pairs = [(message, instance.pk) for message in Message.objects.filter(pk__in=pk_set)]
+    else:  # message.deleted_by.add(*users)
+        pairs = [(instance, user_id) for user_id in pk_set]
+
+    if sender is Message.deleted_by.through:
+        SyncEvent.objects.bulk_create([
+            SyncEvent(conversation_id=message.conversation_id, user_id=user_id, kind=SyncEvent.HIDDEN,
+                      message_id=message.id)
+            for message, user_id in pairs
+        ])
+        for message, _ in pairs:
+            events.notify(message.conversation_id, SyncEvent.HIDDEN, message.id)
+    else:
+        cursors = {}
+        for message, user_id in pairs:
+            key = (message.conversation_id, user_id)
+            cursors[key] = max(cursors.get(key, 0), message.id)
+        SyncEvent.objects.bulk_create([
+            SyncEvent(conversation_id=conversation_id, kind=SyncEvent.READ, data={'user': user_id, 'message': message_id})
+            for (conversation_id, user_id), message_id in cursors.items()
+        ])
+        for conversation_id, _ in cursors:
+            events.notify(conversation_id, SyncEvent.READ)
+
+
+def _participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    conversation_ids = pk_set if reverse else [instance.pk]
+    SyncEvent.objects.bulk_create([
+        SyncEvent(conversation_id=conversation_id, kind=SyncEvent.CONVERSATION) for conversation_id in conversation_ids
+    ])
+    for conversation_id in conversation_ids:
+        events.notify(conversation_id, SyncEvent.CONVERSATION)
+
+
+def _user_changed(user_id):
+    """A participant's name and avatar show in every conversation they are in."""
+    conversation_ids = list(Conversation.participants.through.objects.filter(user_id=user_id)
+                            .values_list('conversation_id', flat=True))
+    SyncEvent.objects.bulk_create([
+        SyncEvent(conversation_id=conversation_id, kind=SyncEvent.CONVERSATION) for conversation_id in conversation_ids
+    ])
+    for conversation_id in conversation_ids:
+        events.notify(conversation_id, SyncEvent.CONVERSATION)
+
+
+def _user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logins only touch last_login, which no payload shows
+    if not raw and update_fields != frozenset({'last_login'}):
+        _user_changed(instance.pk)
+
+
+def _profile_saved(sender, instance, raw=False, **kwargs):
+    # Including the avatar job's save of the new variants
+    if not raw:
+        _user_changed(instance.user_id)
+
+
+def connect_signals():
+    """Hooked up in ChatConfig.ready"""
+    post_save.connect(_message_saved, sender=Message, dispatch_uid='chat.sync.message_saved')
+    for through in (Message.deleted_by.through, Message.read_by.through):
+        m2m_changed.connect(_message_users, sender=through, dispatch_uid=f'chat.sync.{through.__name__}')
+    m2m_changed.connect(_participants_changed, sender=Conversation.participants.through,
+                        dispatch_uid='chat.sync.participants_changed')
+    post_save.connect(_user_saved, sender=get_user_model(), dispatch_uid='chat.sync.user_saved')
+    post_save.connect(_profile_saved, sender=Profile, dispatch_uid='chat.sync.profile_saved')
+
+
+# Reading
+
+def settled(events):
+    settle = getattr(settings, 'SYNC_SETTLE_SECONDS', 0)
+    if settle:
+        events = events.filter(created_at__lte=timezone.now() - timedelta(seconds=settle))
+    return events
+
+
+def current_seq():
+    """Sequence number a fresh client starts from."""
+    latest = settled(SyncEvent.objects.all()).order_by('-id').values_list('id', flat=True).first()
+    return latest or 0
+
+
+def _visible_to(user, events):
+    return events.filter(Q(user__isnull=True) | Q(user=user))
+
+
+def visible_events(user):
+    return _visible_to(user, SyncEvent.objects.filter(
+        conversation__in=Conversation.objects.filter(participants=user).values('id'),
+    ))
+
+
+def conversation_version(conversation_id, user):
+    """Version stamp of a conversation for user: changes whenever what user sees there changes."""
+    return conversation_state(conversation_id, user)[0]
+
+
+def _state_query(conversation_id, user):
+    """
+    The newest event visible to user, and the newest expires_at that has
+    passed: an expired message drops out of listings before the sweep
+    deletes it (and writes its event), which has to move the version too.
+    """
+    newest = _visible_to(user, SyncEvent.objects.filter(conversation_id=OuterRef('pk'))).order_by('-id')
+    expired = (Message.objects.filter(conversation_id=OuterRef('pk'), expires_at__lte=timezone.now())
+               .order_by('-expires_at').values('expires_at')[:1])
+    return Conversation.objects.filter(pk=conversation_id).annotate(
+        version=Subquery(newest.values('id')[:1]),
+        changed_at=Subquery(newest.values('created_at')[:1]),
+        expired_at=Subquery(expired),
+    ).values_list('version', 'changed_at', 'expired_at')
+
+
+def _state(row):
+    version, changed_at, expired_at = row or (None, None, None)
+    if expired_at is None:
+        return version or 0, changed_at
+    return f'{version or 0}.{int(expired_at.timestamp())}', max(filter(None, (changed_at, expired_at)))
+
+
+def conversation_state(conversation_id, user):
+    """(version, time of the last change or None) of a conversation for user, in one query"""
+    return _state(_state_query(conversation_id, user).first())
+
+
+async def aconversation_state(conversation_id, user):
+    return _state(await _state_query(conversation_id, user).afirst())
+
+
+def etag(kind, version, user, request):
+    """
+    ETag of a polling response built from a version stamp. It covers the
+    viewer and the query string (paging, but not the long-poll `wait`); bump
+    ETAG_FORMAT when a response's shape changes.
+    """
+    params = request.GET.copy()
+    params.pop('wait', None)
+    query = hashlib.md5(params.urlencode().encode(), usedforsecurity=False).hexdigest()[:8]
+    return f'"{ETAG_FORMAT}-{kind}-{version}-u{user.id}-{query}"'
+
+
+def not_modified(request, etag):
+    """A 304 response if the request's If-None-Match matches etag, else None."""
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        response['ETag'] = etag
+    return response
+
+
+def is_expired(seq):
+    """
+    True if events after seq may have been pruned, so the client has to do a
+    full reload. prune_events() always keeps the newest event, so the oldest
+    remaining id bounds what was pruned. (A rolled back id right at the
+    boundary causes an unneeded, but harmless, reset.)
+    """
+    oldest = SyncEvent.objects.aggregate(oldest=Min('id'))['oldest']
+    return oldest is not None and seq < oldest - 1
+
+
+def changes_since(user, seq, limit):
+    """
+    One page of changes after seq: (changes dict, next seq, has_more). The
+    message ids in 'messages' and 'deleted' are those touched by the page's
+    events, in their current state; 'reactions' and 'read' are deltas in order.
+    """
+    events = list(settled(visible_events(user).filter(id__gt=seq)).order_by('id')[:limit + 1])
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    touched_messages, hidden, conversation_ids = set(), set(), set()
+    reactions, read = [], {}
+    for event in events:
+        conversation_ids.add(event.conversation_id)
+        if event.kind == SyncEvent.HIDDEN:
+            hidden.add(event.message_id)
+        elif event.kind in (SyncEvent.MESSAGE, SyncEvent.REACTION):
+            touched_messages.add(event.message_id)
+        if event.kind == SyncEvent.REACTION:
+            reactions.append({'message': event.message_id, **event.data})
+        elif event.kind == SyncEvent.READ:
+            key = (event.conversation_id, event.data['user'])
+            read[key] = max(read.get(key, 0), event.data['message'])
+
+    messages = list(
+        Message.objects.unexpired().filter(id__in=touched_messages - hidden, conversation_id__in=conversation_ids)
+        .exclude(deleted_by=user)
+        .select_related('sender__profile', 'parent')
+        .prefetch_related('reactions__user__profile', 'deleted_by')
+        .order_by('id')
+    )
+    found = {m.id for m in messages}
+    changes = {
+        'messages': messages,
+        # Hidden for this user, expired, or gone from hot storage (purged or archived)
+        'deleted': sorted(hidden | (touched_messages - found)),
+        'reactions': reactions,
+        'read': [
+            {'conversation': conversation_id, 'user': user_id, 'last_read_message': message_id}
+            for (conversation_id, user_id), message_id in sorted(read.items())
+        ],
+        'conversations': list(
+            Conversation.objects.filter(id__in=conversation_ids, participants=user)
+            .prefetch_related('participants__profile')
+        ),
+    }
+    return changes, (events[-1].id if events else seq), has_more
+
+
+def prune_events(older_than=None):
+    """Deletes events older than older_than (a timedelta). Clients behind them get reset. Returns the count."""
+    if older_than is None:
+        older_than = timedelta(days=getattr(settings, 'SYNC_EVENT_RETENTION_DAYS', 30))
+    newest = SyncEvent.objects.order_by('-id').values_list('id', flat=True).first()
+    old = SyncEvent.objects.filter(created_at__lt=timezone.now() - older_than).exclude(id=newest)
+    return old.delete()[0]
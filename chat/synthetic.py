@@ -0,0 +1,85 @@
+"""
+Synthetic data for benchmarks and load simulation.
+
+generate() fills the database with users, two-person conversations and
+encrypted messages including replies, reactions and read marks. The same
+seed always produces the same data set. The first user ("synthetic_hub")
+takes part in every conversation so that list endpoints have something
+sizeable to render.
+"""
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from . import user_search
+from .models import Conversation, Message, MessageReaction, Profile
+from .utils import encrypt_message
+
+EMOJIS = ['👍', '❤️', '😂', '😮', '🔥']
+WORDS = (
+    "hey sure later tomorrow meeting call lunch photo thanks ok great sounds good see you "
+    "when where why maybe tonight weekend project deadline coffee train home work"
+).split()
+
+
+def _sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))
+
+
+@transaction.atomic
+def generate(users=20, conversations=40, messages_per_conversation=200, seed=0,
+             reply_ratio=0.1, reaction_ratio=0.2, read_ratio=0.8, password=None):
+    """Creates the data set and returns {'users': [...], 'conversations': [...]}."""
+    rng = random.Random(seed)
+    User = get_user_model()
+
+    # Hash once: password hashing is deliberately slow. None gives an unusable password.
+    hashed_password = make_password(password)
+    new_users = [
+        User(username='synthetic_hub' if i == 0 else f'synthetic_{seed}_{i}', password=hashed_password)
+        for i in range(max(users, 2))
+    ]
+    User.objects.bulk_create(new_users)
+    user_list = list(User.objects.filter(username__in=[u.username for u in new_users]).order_by('id'))
+    # bulk_create skips the post_save signals that normally create profiles and search rows
+    Profile.objects.bulk_create([Profile(user=u) for u in user_list], ignore_conflicts=True)
+    user_search.index_users(user_list)
+
+    hub, others = user_list[0], user_list[1:]
+    conversation_list = []
+    for i in range(conversations):
+        conversation = Conversation.objects.create()
+        # Round-robin partners, so every user gets a conversation once there are enough
+        conversation.participants.add(hub, others[i % len(others)])
+        conversation_list.append(conversation)
+
+    # Encrypting is the expensive part of seeding; reuse a pool of ciphertexts
+    pool = [encrypt_message(_sentence(rng)) for _ in range(200)]
+    ReadMark = Message.read_by.through
+    for conversation in conversation_list:
+        participants = list(conversation.participants.all())
+        batch = Message.objects.bulk_create([
+            Message(conversation=conversation, sender=rng.choice(participants), content=rng.choice(pool))
+            for _ in range(messages_per_conversation)
+        ])
+
+        replies = []
+        for index, message in enumerate(batch[1:], start=1):
+            if rng.random() < reply_ratio:
+                message.parent = batch[rng.randrange(index)]
+                replies.append(message)
+        Message.objects.bulk_update(replies, ['parent'])
+
+        reactions, reads = [], []
+        for message in batch:
+            if rng.random() < reaction_ratio:
+                reactions.append(MessageReaction(message=message, user=rng.choice(participants), emoji=rng.choice(EMOJIS)))
+            for user in participants:
+                if user != message.sender and rng.random() < read_ratio:
+                    reads.append(ReadMark(message_id=message.id, user_id=user.id))
+        MessageReaction.objects.bulk_create(reactions, ignore_conflicts=True)
+        ReadMark.objects.bulk_create(reads, ignore_conflicts=True)
+
+    return {'users': user_list, 'conversations': conversation_list}
@@ -0,0 +1,173 @@
+"""
+Background jobs, run by `manage.py run_worker` (see chat/jobs.py).
+
+Enqueue one with jobs.enqueue('<name>', ...) from code or with
+`manage.py enqueue_job <name>` (e.g. from cron for the maintenance jobs).
+"""
+import hashlib
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import post_save
+
+from . import archive, purge, sync
+from .jobs import enqueue, job
+from .models import ArchivedSegment, Message, Profile, thumbnail_name
+from .utils import rotate_ciphertext
+
+THUMBNAIL_SIZE = (480, 480)
+
+
+@job('chat.thumbnail_message_image', priority=5)
+def thumbnail_message_image(message_id):
+    from PIL import Image
+
+    message = Message.objects.filter(id=message_id).first()
+    if message is None or message.is_deleted or not message.is_image:
+        return
+    with message.file.open('rb') as source:
+        image = Image.open(source)
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        output = BytesIO()
+        image.save(output, 'WEBP', quality=80)
+    name = thumbnail_name(message.file.name)
+    default_storage.delete(name)
+    default_storage.save(name, ContentFile(output.getvalue()))
+    # Saved, not updated: the sync event tells pollers the message changed
+    message.has_thumbnail = True
+    message.save(update_fields=['has_thumbnail'])
+
+
+def avatar_variant_name(data, size):
+    """Content-addressed storage name of an avatar variant, so its URL can be cached forever."""
+    return f'profiles/variants/{hashlib.sha256(data).hexdigest()[:20]}-{size}.webp'
+
+
+@job('chat.avatar_variants', priority=5)
+def avatar_variants(profile_id):
+    """Square WebP copies of a profile image at settings.AVATAR_SIZES, recorded in Profile.avatar_variants."""
+    from PIL import Image, ImageOps
+
+    profile = Profile.objects.filter(id=profile_id).first()
+    if profile is None or not profile.image or profile.has_current_variants:
+        return
+    source = profile.image.name
+    variants = {'source': source}
+    try:
+        with profile.image.open('rb') as f:
+            image = ImageOps.exif_transpose(Image.open(f))
+            image.load()
+    except (OSError, Image.DecompressionBombError):
+        # Missing or not an image: no variants, clients keep the original URL
+        image = None
+    if image is not None:
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        for size in getattr(settings, 'AVATAR_SIZES', (64, 128, 256)):
+            output = BytesIO()
+            ImageOps.fit(image, (size, size), Image.LANCZOS).save(output, 'WEBP', quality=80)
+            data = output.getvalue()
+            name = avatar_variant_name(data, size)
+            if not default_storage.exists(name):
+                name = default_storage.save(name, ContentFile(data))
+            variants[str(size)] = name
+
+    with transaction.atomic():
+        # The image may have been replaced meanwhile; its own job records that one
+        profile = Profile.objects.select_for_update().filter(id=profile_id, image=source).first()
+        if profile is not None:
+            profile.avatar_variants = variants
+            profile.save(update_fields=['avatar_variants'])
+
+
+@job('chat.backfill_avatar_variants', priority=-5, timeout=600)
+def backfill_avatar_variants():
+    """Queues chat.avatar_variants for every profile whose image has no current variants."""
+    for profile in Profile.objects.exclude(image='').exclude(image__isnull=True).only('id', 'image', 'avatar_variants'):
+        if not profile.has_current_variants:
+            enqueue('chat.avatar_variants', profile.id, dedupe_key=f'avatar:{profile.id}')
+
+
+@job('chat.purge_messages', timeout=3600)
+def purge_messages():
+    purge.purge_messages(pause=0.1)
+
+
+@job('chat.expire_messages', timeout=600)
+def expire_messages():
+    """Deletes expired disappearing messages, then queues itself for the next expiry."""
+    purge.expire_messages(pause=0.05)
+    purge.schedule_expiry()
+
+
+@job('chat.archive_messages', timeout=3600)
+def archive_messages():
+    archive.archive_messages()
+
+
+@job('chat.prune_sync_events', timeout=600)
+def prune_sync_events():
+    sync.prune_events()
+
+
+@job('chat.reencrypt_messages', priority=-5, timeout=600)
+def reencrypt_messages(after_id=0, batch_size=500):
+    """
+    Rewrites message ciphertexts with the current ENCRYPTION_KEY after a key
+    rotation (see ENCRYPTION_OLD_KEYS), one batch per job; each batch queues
+    the next. Archived segments follow once the hot messages are done.
+    """
+    with transaction.atomic():
+        batch = list(Message.objects.filter(id__gt=after_id).exclude(content__isnull=True).exclude(content='')
+                     .order_by('id').only('id', 'content')[:batch_size])
+        changed = []
+        for message in batch:
+            content = rotate_ciphertext(message.content)
+            if content != message.content:
+                message.content = content
+                changed.append(message)
+        # bulk_update skips save(), which would not re-encrypt anyway, and post_save
+        Message.objects.bulk_update(changed, ['content'])
+    if len(batch) == batch_size:
+        enqueue('chat.reencrypt_messages', after_id=batch[-1].id, batch_size=batch_size)
+    else:
+        enqueue('chat.reencrypt_archived_segments')
+
+
+@job('chat.reencrypt_archived_segments', priority=-5, timeout=600)
+def reencrypt_archived_segments(after_id=0, batch_size=50):
+    with transaction.atomic():
+        segments = list(ArchivedSegment.objects.filter(id__gt=after_id).order_by('id')[:batch_size])
+        for segment in segments:
+            records = segment.unpack()
+            for record in records:
+                record['content'] = rotate_ciphertext(record['content'])
+                record['parent_content'] = rotate_ciphertext(record['parent_content'])
+            segment.data = ArchivedSegment.pack(records)
+        ArchivedSegment.objects.bulk_update(segments, ['data'])
+    if len(segments) == batch_size:
+        enqueue('chat.reencrypt_archived_segments', after_id=segments[-1].id, batch_size=batch_size)
+
+
+def _message_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.is_image:
+        enqueue('chat.thumbnail_message_image', instance.id, dedupe_key=f'thumbnail:{instance.id}')
+    if created and not raw and instance.expires_at:
+        purge.schedule_expiry(instance.expires_at)
+
+
+def _profile_saved(sender, instance, raw=False, **kwargs):
+    # Also fires for the job's own save, which finds the variants current
+    if not raw and instance.image and not instance.has_current_variants:
+        enqueue('chat.avatar_variants', instance.id, dedupe_key=f'avatar:{instance.id}')
+
+
+def connect_signals():
+    """Hooked up in ChatConfig.ready"""
+    post_save.connect(_message_saved, sender=Message, dispatch_uid='chat.tasks.message_saved')
+    post_save.connect(_profile_saved, sender=Profile, dispatch_uid='chat.tasks.profile_saved')
@@ -1,5 +1,7 @@
 from django import template
 
+from chat import bubbles
+
 register = template.Library()
 
 @register.filter
@@ -9,3 +11,13 @@ def get_partner(conversation, current_user):
 @register.filter
 def get_last_message(conversation, user):
     return conversation.get_last_visible_message(user)
+
+@register.filter
+def avatar_url(profile, size):
+    """{{ user.profile|avatar_url:128 }}: the smallest avatar variant that covers `size` pixels"""
+    return profile.avatar_url(int(size))
+
+@register.simple_tag
+def message_bubble(message):
+    """{% message_bubble message %}: one bubble of conversation_detail.html (see chat/bubbles.py)"""
+    return bubbles.render(message)
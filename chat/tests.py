@@ -1,3 +1,1598 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import json
+import os
+import pickle
+import re
+import socket
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import brotli
+import msgpack
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (archive, authentication, db_router, events, jobs, list_cache, polling, presence, profiling, purge, sync,
+               synthetic, tasks, throttling, user_search)
+from .management.commands import bench_hotpaths, bench_startup
+from .middleware import ReplicaRoutingMiddleware
+from .models import ArchivedSegment, Conversation, Job, Message, UserSearchGram, UserSearchTerm, thumbnail_name
+from .profiling import TOKEN_SALT, list_captures, make_profile_token
+from .utils import decrypt_message, encrypt_message
+from .write_queue import WriteQueue, run_write
+
+User = get_user_model()
+
+
+def make_user(username, **kwargs):
+    return User.objects.create_user(username=username, password='pw', **kwargs)
+
+
+def make_conversation(*users):
+    conversation = Conversation.objects.create()
+    conversation.participants.add(*users)
+    return conversation
+
+
+def api_client(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+class UnreadCountTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+
+    def unread_count(self):
+        response = api_client(self.alice).get('/chat/api/conversations/')
+        return response.json()['results'][0]['unread_count']
+
+    def test_tombstones_are_not_unread(self):
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='oops').delete_for_everyone()
+        self.assertEqual(self.unread_count(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):  # bumps the conversation list cache
+            self.conversation.mark_as_read(self.alice)
+        self.assertEqual(self.unread_count(), 0)
+
+
+class ArchivedTombstoneTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+    def archive(self):
+        return archive.archive_messages(older_than=timedelta(seconds=-1))
+
+    def purge(self):
+        with self.captureOnCommitCallbacks(execute=True):  # file deletion
+            return purge.purge_messages(grace=timedelta(seconds=-1), vacuum=False)
+
+    def archived(self):
+        return {r['id']: r for r in archive.load_archived_messages(self.conversation, self.alice)}
+
+    def test_tombstones_stay_hot_until_purged(self):
+        message = Message.objects.create(conversation=self.conversation, sender=self.bob, content='secret',
+                                         file=ContentFile(b'data', name='secret.txt'))
+        path = message.file.path
+        message.delete_for_everyone()
+
+        self.assertEqual(self.archive(), 0)
+        self.purge()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.archive(), 1)
+        record = self.archived()[message.id]
+        self.assertTrue(record['is_deleted'])
+        self.assertIsNone(record['content'])
+        self.assertIsNone(record['file'])
+
+    def test_purge_blanks_quotes_in_archived_replies(self):
+        parent = Message.objects.create(conversation=self.conversation, sender=self.bob, content='secret')
+        reply = Message.objects.create(conversation=self.conversation, sender=self.alice, content='re', parent=parent)
+        # The parent has a hot reply, so only the reply moves to cold storage
+        self.assertEqual(self.archive(), 1)
+        self.assertIsNotNone(self.archived()[reply.id]['parent_content'])
+
+        parent.delete_for_everyone()
+        self.purge()
+        self.assertIsNone(self.archived()[reply.id]['parent_content'])
+
+    def test_migration_scrubs_legacy_segments(self):
+        storage = Message._meta.get_field('file').storage
+        name = storage.save('messages/old.txt', ContentFile(b'data'))
+        record = {
+            'id': 1, 'sender_id': self.bob.id, 'content': encrypt_message('secret'), 'file': name, 'is_audio': False,
+            'parent_id': None, 'parent_content': None, 'timestamp': '2020-01-01T00:00:00+00:00', 'is_deleted': True,
+            'deleted_by': [self.alice.id], 'read_by': [self.alice.id], 'reactions': [],
+        }
+        reply = {**record, 'id': 2, 'content': encrypt_message('re'), 'file': None, 'is_deleted': False,
+                 'parent_id': 1, 'parent_content': record['content'], 'deleted_by': []}
+        ArchivedSegment.objects.create(
+            conversation=self.conversation, first_message_id=1, last_message_id=2, message_count=2,
+            first_timestamp=timezone.now(), last_timestamp=timezone.now(), data=ArchivedSegment.pack([record, reply]),
+        )
+
+        migration = importlib.import_module('chat.migrations.0014_scrub_archived_tombstones')
+        with self.captureOnCommitCallbacks(execute=True):
+            migration.scrub_archived_tombstones(apps, None)
+
+        records = ArchivedSegment.objects.get().unpack()
+        self.assertEqual([records[0]['content'], records[0]['file'], records[0]['read_by']], [None, None, []])
+        self.assertIsNone(records[1]['parent_content'])
+        self.assertEqual(decrypt_message(records[1]['content']), 're')
+        self.assertFalse(storage.exists(name))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'bubble-tests'}})
+class BubbleCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        self.client.force_login(self.alice)
+
+    def page(self):
+        return self.client.get(f'/chat/{self.conversation.id}/').content.decode()
+
+    def cached_bubbles(self):
+        return {key: value for key, value in cache._cache.items() if 'chat:bubble:' in key}
+
+    def test_cache_holds_markup_without_text(self):
+        parent = Message.objects.create(conversation=self.conversation, sender=self.bob, content='<b>secret</b>')
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='see you', parent=parent)
+        for _ in range(2):  # cold, then from the cache
+            page = self.page()
+            self.assertIn('&lt;b&gt;secret&lt;/b&gt;', page)
+            self.assertNotIn('<b>secret</b>', page)
+            self.assertIn('see you', page)
+        bubbles = self.cached_bubbles()
+        self.assertEqual(len(bubbles), 2)
+        for value in bubbles.values():
+            markup = pickle.loads(value)[1]
+            self.assertNotIn('secret', markup)
+            self.assertNotIn('see you', markup)
+
+    def test_delete_for_everyone_drops_cached_bubble(self):
+        message = Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        self.page()
+        self.assertEqual(len(self.cached_bubbles()), 1)
+        message.delete_for_everyone()
+        self.assertEqual(self.cached_bubbles(), {})
+
+
+class MessagePollQueryTests(TestCase):
+    """The message polling endpoints cost the same number of queries however full the page is."""
+
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        self.client.force_login(self.alice)
+
+    def add_messages(self, count):
+        for i in range(count):
+            parent = Message.objects.create(conversation=self.conversation, sender=self.bob, content=f'm{i}')
+            reply = Message.objects.create(conversation=self.conversation, sender=self.alice, content=f'r{i}',
+                                           parent=parent)
+            reply.reactions.create(user=self.bob, emoji='👍')
+            reply.deleted_by.add(self.bob)
+
+    def count_queries(self, get):
+        with CaptureQueriesContext(connection) as queries:
+            response = get()
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def assert_constant(self, get):
+        self.add_messages(2)
+        few, _ = self.count_queries(get)
+        self.add_messages(20)
+        many, data = self.count_queries(get)
+        self.assertEqual(many, few)
+        return data
+
+    def test_get_messages(self):
+        data = self.assert_constant(lambda: self.client.get(f'/chat/conversation/{self.conversation.id}/get-messages/'))
+        self.assertEqual(len(data), 44)
+        self.assertEqual(data[-1]['parent_content'], 'm19')
+
+    def test_api_messages(self):
+        client = api_client(self.alice)
+        data = self.assert_constant(lambda: client.get(f'/chat/api/conversations/{self.conversation.id}/messages/'))
+        self.assertEqual(len(data), 44)
+        self.assertEqual(data[-1]['parent_content'], 'm19')
+
+    def test_messages_deleted_for_me_are_skipped(self):
+        self.add_messages(1)
+        data = self.client.get(f'/chat/conversation/{self.conversation.id}/get-messages/').json()
+        self.assertEqual([m['content'] for m in data], ['m0', 'r0'])
+        Message.objects.get(sender=self.bob).deleted_by.add(self.alice)
+        data = self.client.get(f'/chat/conversation/{self.conversation.id}/get-messages/').json()
+        self.assertEqual([m['content'] for m in data], ['r0'])
+
+
+class ReplyParentTests(TestCase):
+    """A reply's parent must come from the same conversation, on every send path."""
+
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.conversation = make_conversation(self.alice, self.bob)
+        elsewhere = make_conversation(self.bob, self.carol)
+        self.foreign = Message.objects.create(conversation=elsewhere, sender=self.carol, content='private')
+
+    def payload(self, parent):
+        return {'conversation': self.conversation.id, 'content': 'hi', 'parent': parent.id}
+
+    def test_api_rejects_parent_of_another_conversation(self):
+        response = api_client(self.alice).post('/chat/api/messages/', self.payload(self.foreign), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('parent', response.json())
+        self.assertFalse(self.conversation.messages.exists())
+
+    def test_api_rejects_conversation_of_others(self):
+        response = api_client(self.alice).post('/chat/api/messages/', {**self.payload(self.foreign),
+                                               'conversation': self.foreign.conversation_id}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('conversation', response.json())
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_batch_rejects_parent_of_another_conversation(self):
+        response = api_client(self.alice).post('/chat/api/batch/', {'operations': [
+            {'op': 'send', 'conversation': self.conversation.id, 'content': 'hi', 'parent': self.foreign.id},
+        ]}, format='json')
+        self.assertEqual(response.json()['results'][0]['status'], 400)
+        self.assertFalse(self.conversation.messages.exists())
+
+    def test_api_accepts_parent_of_same_conversation(self):
+        parent = Message.objects.create(conversation=self.conversation, sender=self.bob, content='q')
+        response = api_client(self.alice).post('/chat/api/messages/', self.payload(parent), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['parent_content'], 'q')
+
+    def test_page_rejects_parent_of_another_conversation(self):
+        self.client.force_login(self.alice)
+        response = self.client.post(f'/chat/{self.conversation.id}/', {'content': 'hi', 'parent_id': self.foreign.id})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(self.conversation.messages.exists())
+
+    @override_settings(ROOT_URLCONF='private_messaging.asgi_urls')
+    async def test_async_send_rejects_parent_of_another_conversation(self):
+        token = await sync_to_async(lambda: str(AccessToken.for_user(self.alice)))()
+        response = await self.async_client.post('/chat/api/messages/', self.payload(self.foreign),
+                                                content_type='application/json',
+                                                headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(await self.conversation.messages.aexists())
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.storage = Message._meta.get_field('file').storage
+
+    def send_image(self, thumbnail=True):
+        output = BytesIO()
+        Image.new('RGB', (1200, 800), 'red').save(output, 'PNG')
+        message = Message.objects.create(conversation=self.conversation, sender=self.bob,
+                                         file=ContentFile(output.getvalue(), name='photo.png'))
+        if thumbnail:
+            tasks.thumbnail_message_image(message.id)
+        return message
+
+    def test_thumbnail_url_in_payloads(self):
+        message = self.send_image()
+        name = thumbnail_name(message.file.name)
+        with self.storage.open(name) as f:
+            self.assertEqual(max(Image.open(f).size), 480)
+        url = self.storage.url(name)
+
+        data = api_client(self.alice).get(f'/chat/api/conversations/{self.conversation.id}/messages/').json()
+        self.assertEqual(data[0]['thumbnail_url'], url)
+        self.client.force_login(self.alice)
+        data = self.client.get(f'/chat/conversation/{self.conversation.id}/get-messages/').json()
+        self.assertEqual(data[0]['thumbnail_url'], url)
+        self.assertIn(f'src="{url}"', self.client.get(f'/chat/{self.conversation.id}/').content.decode())
+
+    def no_storage_lookups(self):
+        return mock.patch('django.core.files.storage.FileSystemStorage.exists',
+                          side_effect=AssertionError('storage round trip'))
+
+    def test_reads_do_not_ask_the_storage(self):
+        message = self.send_image(thumbnail=False)
+        path = f'/chat/api/conversations/{self.conversation.id}/messages/'
+        client = api_client(self.alice)
+        with self.no_storage_lookups():
+            before = client.get(path)
+            self.assertIsNone(before.json()[0]['thumbnail_url'])
+        tasks.thumbnail_message_image(message.id)
+        with self.no_storage_lookups():
+            # The job's save is a sync event, so the poller's ETag moves
+            after = client.get(path, HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(after.json()[0]['thumbnail_url'], self.storage.url(thumbnail_name(message.file.name)))
+
+    def test_purging_tombstones_deletes_thumbnails(self):
+        message = self.send_image()
+        message.delete_for_everyone()
+        with self.captureOnCommitCallbacks(execute=True):
+            purge.purge_tombstone_batch(timezone.now() + timedelta(seconds=1), 10)
+        self.assertFalse(self.storage.exists(message.file.name))
+        self.assertFalse(self.storage.exists(thumbnail_name(message.file.name)))
+
+    def test_deleting_hidden_messages_deletes_thumbnails(self):
+        message = self.send_image()
+        message.deleted_by.add(self.alice, self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            purge.delete_hidden_batch(10)
+        self.assertFalse(self.storage.exists(message.file.name))
+        self.assertFalse(self.storage.exists(thumbnail_name(message.file.name)))
+
+
+class ProfileTokenTests(TestCase):
+    def setUp(self):
+        self.staff = make_user('staff', is_staff=True)
+        self.other_staff = make_user('other', is_staff=True)
+        self.alice = make_user('alice')
+        captures = tempfile.TemporaryDirectory()
+        self.addCleanup(captures.cleanup)
+        self.enterContext(override_settings(PROFILE_CAPTURE_DIR=captures.name))
+
+    def api_get(self, user, path='/chat/api/auth/me/', **headers):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return client.get(path, headers=headers)
+
+    def test_token_profiles_api_requests_of_its_user(self):
+        response = self.api_get(self.staff, **{'X-Profile': make_profile_token(self.staff)})
+        self.assertIn('X-Profile-Capture', response)
+        self.assertEqual([name for name, *_ in list_captures()], [response['X-Profile-Capture']])
+
+    def test_token_does_not_profile_other_users(self):
+        token = make_profile_token(self.staff)
+        for user in (self.alice, self.other_staff):
+            self.assertNotIn('X-Profile-Capture', self.api_get(user, **{'X-Profile': token}))
+        self.client.force_login(self.alice)
+        self.assertNotIn('X-Profile-Capture', self.client.get('/chat/', headers={'X-Profile': token}))
+        self.assertEqual(list_captures(), [])
+
+    def test_token_needs_a_user(self):
+        token = signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+        self.assertNotIn('X-Profile-Capture', self.api_get(self.staff, **{'X-Profile': token}))
+
+    def test_staff_flag_applies_to_api_requests(self):
+        self.assertIn('X-Profile-Capture', self.api_get(self.staff, '/chat/api/auth/me/?_profile=1'))
+        self.assertNotIn('X-Profile-Capture', self.api_get(self.alice, '/chat/api/auth/me/?_profile=1'))
+
+    def test_staff_flag_on_pages(self):
+        self.client.force_login(self.staff)
+        self.assertIn('X-Profile-Capture', self.client.get('/chat/?_profile=1'))
+        self.client.force_login(self.alice)
+        self.assertNotIn('X-Profile-Capture', self.client.get('/chat/?_profile=1'))
+
+    def test_staff_flag_needs_a_staff_user_before_profiling(self):
+        with mock.patch('chat.profiling._start', wraps=profiling._start) as start:
+            self.client.get('/chat/api/auth/me/?_profile=1', headers={'Authorization': 'Bearer junk'})
+            self.api_get(self.alice, '/chat/api/auth/me/?_profile=1')
+            start.assert_not_called()
+            self.api_get(self.staff, '/chat/api/auth/me/?_profile=1')
+            start.assert_called_once()
+
+    async def test_staff_flag_needs_a_staff_user_before_async_profiling(self):
+        conversation = await sync_to_async(make_conversation)(self.staff, self.alice)
+        path = f'/chat/api/conversations/{conversation.id}/messages/?_profile=1'
+        access = await sync_to_async(lambda: str(AccessToken.for_user(self.alice)))()
+        with mock.patch('chat.profiling._start', wraps=profiling._start) as start:
+            await self.async_client.get(path, headers={'Authorization': 'Bearer junk'})
+            await self.async_client.get(path, headers={'Authorization': f'Bearer {access}'})
+            start.assert_not_called()
+
+    async def test_token_profiles_async_api_requests_of_its_user(self):
+        conversation = await sync_to_async(make_conversation)(self.staff, self.alice)
+        path = f'/chat/api/conversations/{conversation.id}/messages/'
+        token = await sync_to_async(make_profile_token)(self.staff)
+        for user, profiled in ((self.staff, True), (self.other_staff, False)):
+            access = await sync_to_async(lambda: str(AccessToken.for_user(user)))()
+            response = await self.async_client.get(path, headers={'Authorization': f'Bearer {access}',
+                                                                  'X-Profile': token})
+            self.assertEqual('X-Profile-Capture' in response, profiled)
+
+
+@override_settings(USER_SEARCH_CACHE_SECONDS=0)
+class UserSearchTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.zoe = make_user('zoe_ann', first_name='Zoë', last_name="O'Neil")
+
+    def search(self, query):
+        return [user.username for user in user_search.search_users(self.alice, query)]
+
+    def test_prefix_accents_and_typos(self):
+        self.assertEqual(self.search('ZOE'), ['zoe_ann'])
+        self.assertEqual(self.search('oneil'), ['zoe_ann'])
+        self.assertEqual(self.search('zoeanm'), ['zoe_ann'])
+        self.assertEqual(self.search('alice'), [])  # not oneself
+
+    def test_migration_indexes_existing_users(self):
+        UserSearchTerm.objects.all().delete()
+        UserSearchGram.objects.filter(user=self.zoe).delete()
+        self.assertEqual(self.search('zoe'), [])
+
+        migration = importlib.import_module('chat.migrations.0015_backfill_user_search')
+        migration.index_existing_users(apps, None)
+        self.assertEqual(self.search('zoe'), ['zoe_ann'])
+        self.assertEqual(self.search('zoeanm'), ['zoe_ann'])
+        # Indexed once
+        self.assertEqual(UserSearchTerm.objects.filter(user=self.zoe).count(), 4)
+        migration.index_existing_users(apps, None)
+        self.assertEqual(UserSearchTerm.objects.filter(user=self.zoe).count(), 4)
+
+    def test_renames_are_reindexed(self):
+        self.zoe.username = 'zed'
+        self.zoe.save()
+        self.assertEqual(self.search('zed'), ['zed'])
+        self.assertEqual(set(UserSearchTerm.objects.filter(user=self.zoe).values_list('term', flat=True)),
+                         {'zed', 'zoe', 'oneil', 'zoeoneil'})
+
+    def test_endpoints_skip_existing_contacts(self):
+        bob = make_user('zoe_bob')
+        make_conversation(self.alice, bob)
+        self.assertEqual(self.search('zoe'), ['zoe_ann'])
+        self.assertEqual(self.search('z'), [])  # too short
+
+        data = api_client(self.alice).get('/chat/api/users/search/', {'q': 'zoe'}).json()
+        self.assertEqual([user['username'] for user in data], ['zoe_ann'])
+        self.client.force_login(self.alice)
+        data = self.client.get('/chat/users/search/', {'q': 'zoe'}).json()
+        self.assertEqual(data['results'], [{'username': 'zoe_ann', 'name': "Zoë O'Neil"}])
+
+
+class ApiEncodingTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.conversation = make_conversation(self.alice, make_user('bob'))
+        for i in range(20):
+            Message.objects.create(conversation=self.conversation, sender=self.alice, content=f'message {i}')
+        self.path = f'/chat/api/conversations/{self.conversation.id}/messages/'
+
+    def test_msgpack_when_asked(self):
+        client = api_client(self.alice)
+        response = client.get(self.path, headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), client.get(self.path).json())
+
+    def test_brotli_then_gzip(self):
+        client = api_client(self.alice)
+        plain = client.get(self.path).content
+        response = client.get(self.path, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), plain)
+        response = client.get(self.path, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain)
+
+
+class ExpirySchedulingTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+
+    def sweep(self):
+        return Job.objects.get(name='chat.expire_messages', status=Job.QUEUED)
+
+    def assert_runs_in(self, seconds):
+        self.assertAlmostEqual((self.sweep().run_after - timezone.now()).total_seconds(), seconds, delta=5)
+
+    def send(self, seconds, after=Conversation.AFTER_SEND):
+        self.conversation.set_disappearing(seconds, after)
+        return Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+
+    def test_sweep_waits_for_the_first_expiry(self):
+        self.send(86400)
+        self.assert_runs_in(3600)  # capped
+        self.send(300)
+        self.assert_runs_in(300)  # moved up
+        self.send(3600)
+        self.assert_runs_in(300)
+
+    def test_read_timer_schedules_sweep(self):
+        self.send(300, after=Conversation.AFTER_READ)
+        self.assertFalse(Job.objects.filter(name='chat.expire_messages').exists())
+        self.conversation.mark_as_read(self.alice)
+        self.assert_runs_in(300)
+
+    def test_opening_the_page_starts_read_timers(self):
+        message = self.send(300, after=Conversation.AFTER_READ)
+        self.client.force_login(self.alice)
+        self.client.get(f'/chat/{self.conversation.id}/')
+        message.refresh_from_db()
+        self.assertIsNotNone(message.expires_at)
+
+    def test_visible_polls_start_read_timers(self):
+        message = self.send(300, after=Conversation.AFTER_READ)
+        self.client.force_login(self.alice)
+        path = f'/chat/conversation/{self.conversation.id}/get-messages/'
+        self.client.get(path, headers={'X-Page-Visibility': 'hidden'})
+        message.refresh_from_db()
+        self.assertIsNone(message.expires_at)
+
+        response = self.client.get(path)
+        message.refresh_from_db()
+        self.assertIsNotNone(message.expires_at)
+        # The answer carries the version after the read marks
+        self.assertEqual(self.client.get(path, headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+    async def test_visible_async_polls_start_read_timers(self):
+        message = await sync_to_async(self.send)(300, after=Conversation.AFTER_READ)
+        await self.async_client.aforce_login(self.alice)
+        path = f'/chat/conversation/{self.conversation.id}/get-messages/'
+        response = await self.async_client.get(path)
+        await message.arefresh_from_db()
+        self.assertIsNotNone(message.expires_at)
+        self.assertEqual((await self.async_client.get(path, headers={'If-None-Match': response['ETag']})).status_code, 304)
+
+    def test_sweep_deletes_expired_and_requeues_for_the_next(self):
+        expired = self.send(300)
+        later = self.send(3600)
+        Message.objects.filter(id=expired.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        Job.objects.filter(name='chat.expire_messages').delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.expire_messages()
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [later.id])
+        self.assert_runs_in(3600)
+
+        Message.objects.all().delete()
+        Job.objects.filter(name='chat.expire_messages').delete()
+        tasks.expire_messages()
+        self.assertFalse(Job.objects.filter(name='chat.expire_messages').exists())
+
+    def test_expired_messages_are_hidden_before_the_sweep(self):
+        message = self.send(300)
+        Message.objects.filter(id=message.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        data = api_client(self.alice).get(f'/chat/api/conversations/{self.conversation.id}/messages/').json()
+        self.assertEqual(data, [])
+
+
+class ReplicaRoutingTests(TestCase):
+    """Routing decisions only: 'replica1' is never queried."""
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.enterContext(override_settings(DATABASE_REPLICAS=['replica1'], CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir.name,
+        }}))
+        self.router = db_router.PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+
+    def route(self, request, write=False):
+        """(database of the view's reads, response) for request going through the middleware"""
+        seen = []
+
+        def view(request):
+            if write:
+                self.router.db_for_write(Message)
+            seen.append(self.router.db_for_read(Message))
+            return HttpResponse()
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return seen[0], response
+
+    def test_reads_use_replicas_until_the_client_writes(self):
+        headers = {'Authorization': 'Bearer abc'}
+        self.assertEqual(self.route(self.factory.get('/', headers=headers))[0], 'replica1')
+        self.assertEqual(self.route(self.factory.post('/', headers=headers), write=True)[0], 'default')
+        self.assertEqual(self.route(self.factory.get('/', headers=headers))[0], 'default')
+        # Other clients are not pinned
+        self.assertEqual(self.route(self.factory.get('/', headers={'Authorization': 'Bearer xyz'}))[0], 'replica1')
+
+    def test_a_request_reads_from_one_replica(self):
+        with override_settings(DATABASE_REPLICAS=['replica1', 'replica2', 'replica3']):
+            chosen = set()
+            for _ in range(20):
+                token = db_router.begin_request(False)
+                try:
+                    reads = {self.router.db_for_read(Message) for _ in range(10)}
+                finally:
+                    db_router.end_request(token)
+                self.assertEqual(len(reads), 1)
+                chosen |= reads
+        self.assertGreater(len(chosen), 1)
+
+    def test_outside_requests_read_the_primary(self):
+        self.assertEqual(self.router.db_for_read(Message), 'default')
+
+    def test_locmem_cache_refused_with_replicas(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaises(ImproperlyConfigured):
+                ReplicaRoutingMiddleware(lambda request: HttpResponse())
+            with override_settings(DATABASE_REPLICAS=[]):
+                ReplicaRoutingMiddleware(lambda request: HttpResponse())
+
+
+class QrCodeTests(TestCase):
+    def setUp(self):
+        self.user = make_user('alice')
+        self.client.force_login(self.user)
+
+    def test_png_at_requested_size_with_etag(self):
+        response = self.client.get('/chat/profile/qr/?size=200')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(Image.open(BytesIO(response.content)).size, (200, 200))
+        again = self.client.get('/chat/profile/qr/?size=200', headers={'If-None-Match': response['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertNotEqual(self.client.get('/chat/profile/qr/?size=300')['ETag'], response['ETag'])
+
+    def test_svg(self):
+        response = self.client.get('/chat/profile/qr/?size=200&format=svg')
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'width="200" height="200"', response.content)
+
+    def test_size_limits(self):
+        for query in ('size=10', 'size=5000', 'size=x', 'format=gif'):
+            self.assertEqual(self.client.get(f'/chat/profile/qr/?{query}').status_code, 400)
+
+    def test_size_too_small_for_the_code(self):
+        self.client.force_login(make_user('a' * 150))
+        response = self.client.get('/chat/profile/qr/?size=64')
+        self.assertEqual(response.status_code, 400)
+        minimum = int(re.search(rb'at least (\d+)', response.content)[1])
+        response = self.client.get(f'/chat/profile/qr/?size={minimum}')
+        self.assertEqual(Image.open(BytesIO(response.content)).size, (minimum, minimum))
+
+
+class WriteQueueTests(TestCase):
+    def test_writes_run_in_one_batch_on_the_writer_thread(self):
+        write_queue = WriteQueue(max_wait=0.5)
+        threads, batches = [], []
+        run_batch = write_queue._run_batch
+        write_queue._run_batch = lambda batch: (batches.append(len(batch)), run_batch(batch))
+
+        def write(n):
+            threads.append(threading.current_thread().name)
+            if n == 3:
+                raise ValueError(n)
+            return n * 2
+
+        futures = [write_queue.submit(write, n) for n in range(5)]
+        self.assertEqual([f.result(timeout=5) for f in futures if f is not futures[3]], [0, 2, 4, 8])
+        with self.assertRaises(ValueError):
+            futures[3].result()
+        self.assertEqual(set(threads), {'chat-write-queue'})
+        self.assertEqual(batches, [5])
+
+    def test_queued_writes_reach_the_request_state(self):
+        token = db_router.begin_request(use_primary=False)
+        WriteQueue().submit(db_router.PrimaryReplicaRouter().db_for_write, Message).result(timeout=5)
+        # The request reads from the primary after it wrote, and pins its client there
+        self.assertEqual(db_router.PrimaryReplicaRouter().db_for_read(Message), 'default')
+        self.assertTrue(db_router.end_request(token))
+
+    @override_settings(SQLITE_WRITE_QUEUE=True)
+    def test_run_write_stays_inline_inside_a_transaction(self):
+        self.assertEqual(run_write(lambda: threading.current_thread().name), threading.current_thread().name)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        self.messages = [Message.objects.create(conversation=self.conversation, sender=self.bob, content=f'm{i}')
+                         for i in range(6)]
+
+    def archive_first(self, count):
+        Message.objects.filter(id__in=[m.id for m in self.messages[:count]]).update(
+            timestamp=timezone.now() - timedelta(days=400))
+        return archive.archive_messages()
+
+    def page(self, user, before=None):
+        query = f'?before={before}' if before else ''
+        response = api_client(user).get(f'/chat/api/conversations/{self.conversation.id}/messages/{query}')
+        return [(m['id'], m['decrypted_content']) for m in response.json()]
+
+    def test_old_messages_move_to_segments_and_page_back_in(self):
+        first = self.messages[0]
+        first.reactions.create(user=self.alice, emoji='🔥')
+        first.read_by.add(self.alice)
+        self.assertEqual(self.archive_first(4), 4)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(ArchivedSegment.objects.get().message_count, 4)
+
+        everything = [(m.id, f'm{i}') for i, m in enumerate(self.messages)]
+        self.assertEqual(self.page(self.alice), everything)
+        self.assertEqual(self.page(self.alice, before=self.messages[3].id), everything[:3])
+        record = archive.load_archived_messages(self.conversation, self.alice)[-1]  # newest first
+        self.assertEqual(record['read_by'], [self.alice.id])
+        self.assertEqual([r['emoji'] for r in record['reactions']], ['🔥'])
+
+    def test_deleted_for_me_stays_hidden_in_the_archive(self):
+        self.messages[0].deleted_by.add(self.alice)
+        self.archive_first(2)
+        self.assertEqual([i for i, _ in self.page(self.alice)], [m.id for m in self.messages[1:]])
+        self.assertEqual(len(self.page(self.bob)), 6)
+
+    def test_parents_of_hot_replies_stay_hot(self):
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='re',
+                               parent=self.messages[0])
+        self.assertEqual(self.archive_first(2), 1)
+        self.assertTrue(Message.objects.filter(id=self.messages[0].id).exists())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.conversation = make_conversation(self.alice, make_user('bob'))
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='hi')
+        self.client.force_login(self.alice)
+
+    def poll(self):
+        return self.client.get(f'/chat/conversation/{self.conversation.id}/get-messages/')
+
+    def test_requests_are_recorded_per_view(self):
+        self.poll()
+        self.client.force_login(make_user('admin', is_staff=True))
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('chat_request_latency_seconds_count{view="get_messages",method="GET"}', text)
+        self.assertRegex(text, r'chat_db_queries_per_request_count\{view="get_messages"\} [1-9]')
+        self.assertRegex(text, r'chat_crypto_seconds_per_request_count\{view="get_messages",operation="decrypt"\} [1-9]')
+
+    def test_endpoint_needs_staff_or_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer nope'}).status_code, 403)
+            self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer s3cret'}).status_code, 200)
+
+    @override_settings(METRICS_SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('chat.slow_requests', 'WARNING') as logs:
+            self.poll()
+        self.assertIn('get_messages', logs.output[0])
+
+
+class BenchHotpathsTests(TestCase):
+    def test_synthetic_data_is_reproducible(self):
+        first = synthetic.generate(users=3, conversations=2, messages_per_conversation=5, seed=7)
+        contents = [m.decrypted_content for m in Message.objects.order_by('id')]
+        self.assertEqual(len(first['conversations']), 2)
+        Message.objects.all().delete()
+        Conversation.objects.all().delete()
+        User.objects.all().delete()
+        synthetic.generate(users=3, conversations=2, messages_per_conversation=5, seed=7)
+        self.assertEqual([m.decrypted_content for m in Message.objects.order_by('id')], contents)
+
+    def test_benchmarks_report_timings_and_query_counts(self):
+        command = bench_hotpaths.Command(stdout=StringIO())
+        with override_settings(THROTTLE_RATES={}):
+            report = command.run_benchmarks({'users': 3, 'conversations': 2, 'messages': 5, 'seed': 0, 'repeat': 1})
+        results = report['results']
+        self.assertGreater(results['crypto.decrypt']['ops_per_second'], 0)
+        for name in ('view.get_messages', 'view.conversation_detail', 'api.conversations.list',
+                     'api.conversations.messages'):
+            self.assertIn('p50_ms', results[name])
+        # Polling is a fixed handful of queries, not one per message
+        self.assertLess(results['view.get_messages']['queries'], 20)
+        self.assertLess(results['api.conversations.messages']['queries'], 30)
+
+        command.compare(report, report)
+        self.assertIn('+0.0%', command.stdout.getvalue())
+
+
+class LoadSimulatorTests(SimpleTestCase):
+    def run_loadsim(self, mode):
+        out = StringIO()
+        call_command('loadsim', mode=mode, clients=2, duration=1.0, messages=5, ramp_up=0.1, poll_interval=0.2,
+                     json=True, stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_wsgi_and_asgi_runs_report_per_endpoint(self):
+        for mode in ('wsgi', 'asgi'):
+            with self.subTest(mode=mode):
+                report = self.run_loadsim(mode)
+                self.assertEqual(report['mode'], mode)
+                self.assertEqual(report['clients'], 2)
+                self.assertGreater(report['endpoints']['get_messages']['requests'], 2)
+                for endpoint in [*report['login']['endpoints'].values(), *report['endpoints'].values()]:
+                    self.assertEqual(endpoint['lock_errors'], 0)
+                    self.assertTrue(all(int(status) < 500 for status in endpoint['statuses']), endpoint)
+
+
+class AsyncViewTests(TestCase):
+    """The async endpoints (asgi_urls.py) answer like their sync twins."""
+
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        parent = Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        Message.objects.create(conversation=self.conversation, sender=self.alice, content='hey', parent=parent)
+        self.token = str(AccessToken.for_user(self.alice))
+        self.auth = {'Authorization': f'Bearer {self.token}'}
+
+    async def test_get_messages_matches_sync(self):
+        path = f'/chat/conversation/{self.conversation.id}/get-messages/'
+        await self.async_client.aforce_login(self.alice)
+        await sync_to_async(self.client.force_login)(self.alice)
+        sync_response = await sync_to_async(self.client.get)(path)
+        response = await self.async_client.get(path)
+        self.assertEqual(response.json(), sync_response.json())
+        self.assertEqual(response['ETag'], sync_response['ETag'])
+
+    async def test_conversation_messages_matches_sync(self):
+        path = f'/chat/api/conversations/{self.conversation.id}/messages/'
+        sync_response = await sync_to_async(lambda: api_client(self.alice).get(path))()
+        response = await self.async_client.get(path, headers=self.auth)
+        self.assertEqual(response.json(), sync_response.json())
+        self.assertEqual((await self.async_client.get(path)).status_code, 401)
+        outsider = await sync_to_async(lambda: str(AccessToken.for_user(make_user('carol'))))()
+        response = await self.async_client.get(path, headers={'Authorization': f'Bearer {outsider}'})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_send(self):
+        response = await self.async_client.post('/chat/api/messages/', {
+            'conversation': self.conversation.id, 'content': 'async hello',
+        }, content_type='application/json', headers=self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['decrypted_content'], 'async hello')
+        message = await Message.objects.aget(id=response.json()['id'])
+        self.assertNotEqual(message.content, 'async hello')
+        self.assertEqual(message.decrypted_content, 'async hello')
+
+    async def test_uploads_go_to_drf(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        with override_settings(MEDIA_ROOT=media.name):
+            response = await self.async_client.post('/chat/api/messages/', {
+                'conversation': self.conversation.id, 'file': ContentFile(b'data', name='notes.txt'),
+            }, headers=self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()['file'].endswith('.txt'))
+
+
+class CachedJWTUserTests(TestCase):
+    def setUp(self):
+        authentication._users.clear()
+        self.alice = make_user('alice')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.alice)}')
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chat/api/auth/me/')
+        self.assertEqual(response.status_code, 200)
+        return [q['sql'] for q in queries if 'FROM "auth_user"' in q['sql']]
+
+    def test_user_is_loaded_once(self):
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(self.user_queries(), [])
+
+    def test_saving_the_user_invalidates(self):
+        self.user_queries()
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.client.get('/chat/api/auth/me/').status_code, 401)
+
+    def test_each_lookup_gets_its_own_instance(self):
+        first = authentication.cached_user(self.alice.id)
+        first.first_name = 'changed'
+        self.assertEqual(authentication.cached_user(self.alice.id).first_name, '')
+
+    def test_identity_map_loads_a_profile_once_per_request(self):
+        bob = make_user('bob')
+        token = authentication.begin_request()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(3):
+                    authentication.profile_for(User.objects.get(pk=bob.pk))
+        finally:
+            authentication.end_request(token)
+        self.assertEqual(len([q for q in queries if 'chat_profile' in q['sql']]), 1)
+
+
+class BatchApiTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        self.incoming = Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+
+    def batch(self, *operations):
+        response = api_client(self.alice).post('/chat/api/batch/', {'operations': list(operations)}, format='json')
+        return response.json()['results']
+
+    def test_operations_run_in_order(self):
+        results = self.batch(
+            {'op': 'send', 'conversation': self.conversation.id, 'content': 'hello'},
+            {'op': 'react', 'message': self.incoming.id, 'emoji': '🔥'},
+            {'op': 'mark_as_read', 'conversation': self.conversation.id},
+            {'op': 'delete_message', 'message': self.incoming.id, 'delete_type': 'for_me'},
+        )
+        self.assertEqual([r['status'] for r in results], [201, 200, 200, 200])
+        self.assertEqual(results[0]['data']['decrypted_content'], 'hello')
+        self.assertTrue(self.incoming.reactions.filter(user=self.alice, emoji='🔥').exists())
+        self.assertTrue(self.incoming.read_by.filter(id=self.alice.id).exists())
+        self.assertTrue(self.incoming.deleted_by.filter(id=self.alice.id).exists())
+
+    def test_failures_roll_back_alone(self):
+        elsewhere = make_conversation(self.bob, make_user('carol'))
+        results = self.batch(
+            {'op': 'send', 'conversation': elsewhere.id, 'content': 'sneaky'},
+            {'op': 'delete_message', 'message': self.incoming.id, 'delete_type': 'for_everyone'},
+            {'op': 'fly'},
+            {'op': 'send', 'conversation': self.conversation.id, 'content': 'fine'},
+        )
+        self.assertEqual([r['status'] for r in results], [404, 403, 400, 201])
+        self.assertFalse(elsewhere.messages.exists())
+        self.incoming.refresh_from_db()
+        self.assertFalse(self.incoming.is_deleted)
+
+    @override_settings(THROTTLE_RATES={'send': (1, 2), 'api': (1, 10)})
+    def test_each_send_spends_a_send_token(self):
+        cache.clear()
+        results = self.batch(*[{'op': 'send', 'conversation': self.conversation.id, 'content': 'spam'}] * 4,
+                             {'op': 'mark_as_read', 'conversation': self.conversation.id})
+        self.assertEqual([r['status'] for r in results], [201, 201, 429, 429, 200])
+        self.assertIn('throttled', results[2]['data']['detail'])
+        self.assertEqual(self.conversation.messages.filter(sender=self.alice).count(), 2)
+
+    def test_batch_size_is_limited(self):
+        client = api_client(self.alice)
+        self.assertEqual(client.post('/chat/api/batch/', {'operations': []}, format='json').status_code, 400)
+        with override_settings(BATCH_MAX_OPERATIONS=2):
+            operations = [{'op': 'mark_as_read', 'conversation': self.conversation.id}] * 3
+            self.assertEqual(client.post('/chat/api/batch/', {'operations': operations}, format='json').status_code,
+                             400)
+
+
+class DeltaSyncTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        self.client = api_client(self.alice)
+
+    def sync(self, token, **params):
+        response = self.client.get('/chat/api/sync/', {'since': token, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def reset_token(self):
+        body = self.client.get('/chat/api/sync/').json()
+        self.assertTrue(body['reset'])
+        return body['token']
+
+    def test_changes_across_conversations(self):
+        token = self.reset_token()
+        incoming = Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        hidden = Message.objects.create(conversation=self.conversation, sender=self.bob, content='oops')
+        hidden.deleted_by.add(self.alice)
+        incoming.toggle_reaction(self.bob, '👍')
+        self.conversation.mark_as_read(self.alice)
+        Message.objects.create(conversation=make_conversation(self.bob, make_user('carol')), sender=self.bob,
+                               content='not yours')
+
+        body = self.sync(token)
+        self.assertFalse(body['reset'])
+        self.assertEqual([m['id'] for m in body['messages']], [incoming.id])
+        self.assertEqual(body['messages'][0]['decrypted_content'], 'hi')
+        self.assertEqual(body['deleted'], [hidden.id])
+        self.assertEqual(body['reactions'], [{'message': incoming.id, 'user': self.bob.id, 'emoji': '👍',
+                                              'action': 'added'}])
+        self.assertEqual(body['read'], [{'conversation': self.conversation.id, 'user': self.alice.id,
+                                         'last_read_message': hidden.id}])
+        self.assertEqual([c['id'] for c in body['conversations']], [self.conversation.id])
+
+        again = self.sync(body['token'])
+        self.assertEqual((again['messages'], again['deleted'], again['has_more']), ([], [], False))
+
+    def test_paging(self):
+        token = self.reset_token()
+        for text in ('one', 'two', 'three'):
+            Message.objects.create(conversation=self.conversation, sender=self.bob, content=text)
+        seen = []
+        while True:
+            body = self.sync(token, limit=2)
+            seen += [m['decrypted_content'] for m in body['messages']]
+            token = body['token']
+            if not body['has_more']:
+                break
+        self.assertEqual(seen, ['one', 'two', 'three'])
+
+    def test_bad_and_expired_tokens(self):
+        response = self.client.get('/chat/api/sync/', {'since': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/chat/api/sync/', {'since': sync.make_token(-1)}).status_code, 400)
+
+        token = self.reset_token()
+        for _ in range(3):
+            Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        sync.prune_events(older_than=timedelta(0))
+        self.assertTrue(self.sync(token)['reset'])
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        presence._backend = None
+        self.addCleanup(setattr, presence, '_backend', None)
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+
+    def test_memory_backend_expires_entries(self):
+        backend = presence.MemoryBackend()
+        backend.set('fresh', 1, 60)
+        backend.set('stale', 1, -1)
+        self.assertEqual(backend.get_many(['fresh', 'stale', 'missing']), {'fresh': 1})
+        for i in range(backend.SWEEP_EVERY - 2):
+            backend.set(f'k{i}', 1, 60)
+        self.assertNotIn('stale', backend.entries)
+
+    def test_typing_and_online(self):
+        path = f'/chat/conversation/{self.conversation.id}/presence/'
+        self.client.force_login(self.bob)
+        self.client.post(path, {'typing': '1'})
+        self.client.force_login(self.alice)
+        state = self.client.get(path).json()
+        self.assertEqual(state['typing'], [self.bob.id])
+        self.assertEqual(list(state['online']), [str(self.bob.id)])
+
+        self.client.force_login(self.bob)
+        self.client.post(path, {'typing': '0'})
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(path).json()['typing'], [])
+
+        self.client.force_login(make_user('carol'))
+        self.assertEqual(self.client.get(path).status_code, 404)
+
+    def test_api_reports_only_contacts(self):
+        carol = make_user('carol')
+        presence.touch(self.bob.id)
+        presence.touch(carol.id)
+        response = api_client(self.alice).get('/chat/api/presence/', {'users': f'{self.bob.id},{carol.id}'})
+        self.assertEqual(list(response.json()['online']), [str(self.bob.id)])
+        self.assertEqual(api_client(self.alice).get('/chat/api/presence/', {'users': 'x'}).status_code, 400)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        Job.objects.all().delete()
+        self.calls = []
+        for name, fn in (('test.record', self.calls.append), ('test.fail', lambda: 1 / 0)):
+            jobs.job(name, max_attempts=2)(fn)
+            self.addCleanup(jobs.registry.pop, name)
+
+    def test_claims_by_priority_and_runs(self):
+        jobs.enqueue('test.record', 'low')
+        jobs.enqueue('test.record', 'high', priority=5)
+        jobs.enqueue('test.record', 'later', delay=60)
+        claimed = jobs.claim('w1', 10)
+        self.assertEqual([j.args for j in claimed], [['high'], ['low']])
+        self.assertEqual(jobs.claim('w2', 10), [])
+        for claimed_job in claimed:
+            self.assertTrue(jobs.run(claimed_job))
+        self.assertEqual(self.calls, ['high', 'low'])
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 2)
+
+    def test_failures_retry_with_backoff_then_fail(self):
+        queued = jobs.enqueue('test.fail')
+        with self.assertLogs('chat.jobs', 'WARNING'):
+            self.assertFalse(jobs.run(jobs.claim('w1', 1)[0]))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.QUEUED, 1))
+        self.assertGreater(queued.run_after, timezone.now())
+        self.assertIn('ZeroDivisionError', queued.last_error)
+
+        Job.objects.filter(id=queued.id).update(run_after=timezone.now())
+        with self.assertLogs('chat.jobs', 'WARNING'):
+            self.assertFalse(jobs.run(jobs.claim('w1', 1)[0]))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.FAILED, 2))
+
+    def test_dedupe_only_moves_a_job_up(self):
+        first = jobs.enqueue('test.record', 'x', dedupe_key='k', delay=600)
+        self.assertEqual(jobs.enqueue('test.record', 'x', dedupe_key='k', delay=900).id, first.id)
+        first.refresh_from_db()
+        self.assertGreater(first.run_after, timezone.now() + timedelta(seconds=500))
+        self.assertEqual(jobs.enqueue('test.record', 'x', dedupe_key='k', delay=0).id, first.id)
+        first.refresh_from_db()
+        self.assertLessEqual(first.run_after, timezone.now())
+        self.assertEqual(Job.objects.count(), 1)
+
+        self.assertTrue(jobs.run(jobs.claim('w1', 1)[0]))
+        self.assertNotEqual(jobs.enqueue('test.record', 'x', dedupe_key='k').id, first.id)
+
+    def test_expired_lock_is_reclaimed(self):
+        jobs.enqueue('test.record', 'once')
+        stale = jobs.claim('dead', 1)[0]
+        self.assertEqual(jobs.claim('w2', 1), [])
+        Job.objects.filter(id=stale.id).update(locked_until=timezone.now() - timedelta(seconds=1))
+        reclaimed = jobs.claim('w2', 1)[0]
+        self.assertEqual((reclaimed.id, reclaimed.attempts), (stale.id, 2))
+        self.assertTrue(jobs.run(reclaimed))
+        # The dead worker's late result does not overwrite the new claim's
+        Job.objects.filter(id=stale.id).update(status=Job.RUNNING)
+        jobs.run(stale)
+        self.assertEqual(Job.objects.get(id=stale.id).locked_by, 'w2')
+
+    def test_prune_finished(self):
+        done = jobs.enqueue('test.record', 'x')
+        Job.objects.filter(id=done.id).update(status=Job.DONE, finished_at=timezone.now() - timedelta(days=30))
+        jobs.enqueue('test.record', 'y')
+        self.assertEqual(jobs.prune_finished(), 1)
+        self.assertEqual(Job.objects.count(), 1)
+
+
+class ConditionalPollingTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        self.message = Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        self.client.force_login(self.alice)
+        self.page_path = f'/chat/conversation/{self.conversation.id}/get-messages/'
+        self.api_path = f'/chat/api/conversations/{self.conversation.id}/messages/'
+
+    def test_page_poll_revalidates(self):
+        first = self.client.get(self.page_path)
+        etag = first['ETag']
+        again = self.client.get(self.page_path, headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], etag)
+        self.assertIn('X-Poll-Interval', again)
+
+        # Bob hiding a message for himself changes nothing Alice sees
+        self.message.deleted_by.add(self.bob)
+        self.assertEqual(self.client.get(self.page_path, headers={'If-None-Match': etag}).status_code, 304)
+
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='news')
+        changed = self.client.get(self.page_path, headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+        self.assertEqual(len(changed.json()), 2)
+
+    def test_api_poll_revalidates(self):
+        client = api_client(self.alice)
+        etag = client.get(self.api_path)['ETag']
+        self.assertEqual(client.get(self.api_path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.message.toggle_reaction(self.bob, '👍')
+        self.assertEqual(client.get(self.api_path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_avatar_changes_move_the_etag(self):
+        client = api_client(self.alice)
+        etag = client.get(self.api_path)['ETag']
+        self.bob.last_login = timezone.now()
+        self.bob.save(update_fields=['last_login'])
+        self.assertEqual(client.get(self.api_path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.bob.profile.avatar_variants = {'source': 'profiles/default.png', '64': 'profiles/variants/x-64.webp'}
+        self.bob.profile.save()
+        self.assertEqual(client.get(self.api_path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_expiry_moves_the_etag_before_the_sweep(self):
+        client = api_client(self.alice)
+        etag = client.get(self.api_path)['ETag']
+        Message.objects.filter(id=self.message.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        response = client.get(self.api_path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+        self.assertEqual(client.get(self.api_path, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_etag_covers_viewer_and_paging(self):
+        etag = self.client.get(self.page_path)['ETag']
+        self.assertEqual(self.client.get(self.page_path, {'wait': 5})['ETag'], etag)
+        self.assertNotEqual(self.client.get(self.page_path, {'after': self.message.id})['ETag'], etag)
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(self.page_path, headers={'If-None-Match': etag}).status_code, 200)
+
+
+class ConversationListCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol')
+        self.conversation = make_conversation(self.alice, self.bob)
+        make_conversation(self.carol, make_user('dave'))
+        self.client = api_client(self.alice)
+
+    def versions(self):
+        return [list_cache.version(user) for user in (self.alice, self.bob, self.carol)]
+
+    def test_cached_list_and_304(self):
+        parent = Message.objects.create(conversation=self.conversation, sender=self.alice, content='the question')
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='secret answer', parent=parent)
+        with CaptureQueriesContext(connection) as first_queries:
+            first = self.client.get('/chat/api/conversations/')
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get('/chat/api/conversations/')
+        self.assertEqual(second.json(), first.json())
+        last_message = second.json()['results'][0]['last_message']
+        self.assertEqual((last_message['decrypted_content'], last_message['parent_content']),
+                         ('secret answer', 'the question'))
+        self.assertLess(len(queries), len(first_queries))
+        response = self.client.get('/chat/api/conversations/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Only ciphertext goes into the cache
+        entries = b''.join(caches['default']._cache.values())
+        self.assertNotIn(b'secret answer', entries)
+        self.assertNotIn(b'the question', entries)
+
+    def test_changes_move_the_participants_versions(self):
+        alice, bob, carol = self.versions()
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        new_alice, new_bob, new_carol = self.versions()
+        self.assertNotEqual(new_alice, alice)
+        self.assertNotEqual(new_bob, bob)
+        self.assertEqual(new_carol, carol)
+
+        self.conversation.participants.remove(self.bob)
+        self.assertNotEqual(list_cache.version(self.bob), new_bob)
+
+        before = self.versions()
+        self.alice.last_login = timezone.now()
+        self.alice.save(update_fields=['last_login'])
+        self.assertEqual(self.versions(), before)
+        self.carol.profile.save()
+        self.assertNotEqual(list_cache.version(self.carol), before[2])
+
+    def test_version_lives_in_the_database(self):
+        # Another process has its own cache, and must still see the same version
+        version = list_cache.version(self.alice)
+        cache.clear()
+        self.assertEqual(list_cache.version(self.alice), version)
+        message = Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        version = list_cache.version(self.alice)
+        Message.objects.filter(id=message.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertNotEqual(list_cache.version(self.alice), version)
+
+    def test_list_shows_the_change(self):
+        etag = self.client.get('/chat/api/conversations/')['ETag']
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        response = self.client.get('/chat/api/conversations/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['results'][0]['last_message']['decrypted_content'], 'hi')
+
+
+class AvatarVariantTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.profile = make_user('alice').profile
+
+    def upload(self, data, name='me.png'):
+        self.profile.image = ContentFile(data, name=name)
+        self.profile.save()
+
+    def png(self, color='red'):
+        output = BytesIO()
+        Image.new('RGB', (600, 400), color).save(output, 'PNG')
+        return output.getvalue()
+
+    def test_variants_are_made_and_picked_by_size(self):
+        self.upload(self.png())
+        self.assertTrue(Job.objects.filter(name='chat.avatar_variants', args=[self.profile.id]).exists())
+        self.assertEqual(self.profile.avatar_url(128), self.profile.image.url)
+
+        tasks.avatar_variants(self.profile.id)
+        self.profile.refresh_from_db()
+        urls = self.profile.variant_urls()
+        self.assertEqual(sorted(urls), [64, 128, 256])
+        for size in urls:
+            with default_storage.open(self.profile.avatar_variants[str(size)]) as f:
+                self.assertEqual(Image.open(f).size, (size, size))
+        self.assertEqual(self.profile.avatar_url(100), urls[128])
+        self.assertEqual(self.profile.avatar_url(1000), urls[256])
+
+    def test_new_image_gets_new_urls(self):
+        self.upload(self.png('red'))
+        tasks.avatar_variants(self.profile.id)
+        self.profile.refresh_from_db()
+        old = self.profile.variant_urls()
+
+        self.upload(self.png('blue'), 'other.png')
+        self.assertEqual(self.profile.variant_urls(), {})
+        self.assertEqual(self.profile.avatar_url(64), self.profile.image.url)
+        tasks.avatar_variants(self.profile.id)
+        self.profile.refresh_from_db()
+        self.assertNotEqual(self.profile.variant_urls()[64], old[64])
+
+    def test_broken_image_keeps_the_original(self):
+        self.upload(b'not an image')
+        tasks.avatar_variants(self.profile.id)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.avatar_variants, {'source': self.profile.image.name})
+        self.assertEqual(self.profile.avatar_url(64), self.profile.image.url)
+
+
+class BenchStartupTests(SimpleTestCase):
+    def test_parse_importtime(self):
+        stderr = ('import time: self [us] | cumulative | imported package\n'
+                  'import time:       120 |        120 |   json.decoder\n'
+                  'import time:       300 |        420 | json\n'
+                  'something else\n')
+        self.assertEqual(bench_startup.parse_importtime(stderr), {'json.decoder': (120, 120), 'json': (300, 420)})
+
+    def test_cold_start_skips_heavy_modules(self):
+        out = StringIO()
+        # The test runner adds 'testserver' to ALLOWED_HOSTS; the fresh interpreters don't have it
+        host = next((host for host in settings.ALLOWED_HOSTS if host != 'testserver'), 'localhost')
+        call_command('bench_startup', repeat=1, top=3, host=host, stdout=out)
+        results = json.loads(out.getvalue())['results']
+        for interface in ('wsgi', 'asgi'):
+            with self.subTest(interface=interface):
+                self.assertEqual(results[interface]['status'], 200)
+                self.assertEqual(results[interface]['heavy_modules_loaded'], [])
+                self.assertLessEqual(results[interface]['setup']['p50_ms'],
+                                     results[interface]['first_response']['p50_ms'])
+
+
+class EventBusTests(TestCase):
+    def test_in_process_delivery(self):
+        bus = events.InProcessBus()
+        received = []
+
+        def broken(channel, payload):
+            raise RuntimeError
+
+        unsubscribe = bus.subscribe('c', lambda channel, payload: received.append(payload))
+        bus.subscribe('c', broken)
+        with self.assertLogs('chat.events', 'ERROR'):
+            bus.publish('c', 1)
+        bus.publish('other', 2)
+        unsubscribe()
+        with self.assertLogs('chat.events', 'ERROR'):
+            bus.publish('c', 3)
+        self.assertEqual(received, [1])
+
+    def test_unix_sockets_fan_out(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        listener = events.UnixSocketBus(directory.name)
+        self.addCleanup(listener.close)
+        got = threading.Event()
+        received = []
+        listener.subscribe('c', lambda channel, payload: (received.append(payload), got.set()))
+
+        # A socket left by a process that is gone
+        gone = os.path.join(directory.name, '999999.sock')
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        dead.bind(gone)
+        dead.close()
+
+        publisher = events.UnixSocketBus(directory.name)
+        publisher.publish('c', {'kind': 'message'})
+        self.assertTrue(got.wait(5))
+        self.assertEqual(received, [{'kind': 'message'}])
+        self.assertFalse(os.path.exists(gone))
+
+    def test_notify_waits_for_commit(self):
+        bus = events.InProcessBus()
+        received = []
+        bus.subscribe(events.conversation_channel(7), lambda channel, payload: received.append(payload))
+        events._bus, events._bus_pid = bus, os.getpid()
+        self.addCleanup(setattr, events, '_bus', None)
+        with self.captureOnCommitCallbacks(execute=True):
+            events.notify(7, 'message', 3)
+            self.assertEqual(received, [])
+        self.assertEqual(received, [{'conversation': 7, 'kind': 'message', 'message': 3}])
+
+
+@override_settings(EVENT_BUS='inprocess')
+class LongPollTests(TestCase):
+    def setUp(self):
+        events._bus = None
+        self.addCleanup(setattr, events, '_bus', None)
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+        self.path = f'/chat/api/conversations/{self.conversation.id}/messages/'
+        self.auth = {'Authorization': f'Bearer {AccessToken.for_user(self.alice)}'}
+
+    async def poll(self, wait):
+        etag = (await self.async_client.get(self.path, headers=self.auth))['ETag']
+        return await self.async_client.get(self.path, {'wait': wait},
+                                           headers={**self.auth, 'If-None-Match': etag})
+
+    async def test_times_out_with_304(self):
+        started = time.monotonic()
+        response = await self.poll(0.3)
+        self.assertEqual(response.status_code, 304)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(response['X-Poll-Interval'], '0')
+
+    async def test_wakes_on_a_change(self):
+        async def change():
+            await asyncio.sleep(0.2)
+            message = await Message.objects.acreate(conversation=self.conversation, sender=self.bob, content='news')
+            # notify() waits for a commit that never comes in a TestCase
+            events.publish(events.conversation_channel(self.conversation.id),
+                           {'conversation': self.conversation.id, 'kind': 'message', 'message': message.id})
+
+        started = time.monotonic()
+        response, _ = await asyncio.gather(self.poll(10), change())
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([m['decrypted_content'] for m in response.json()], ['hi', 'news'])
+
+
+@override_settings(POLL_JITTER=0)
+class PollIntervalTests(SimpleTestCase):
+    def test_interval_grows_with_idle_time(self):
+        now = timezone.now()
+        self.assertEqual(polling.next_poll_ms(now), 2000)
+        self.assertEqual(polling.next_poll_ms(now - timedelta(minutes=5)), 5000)
+        self.assertEqual(polling.next_poll_ms(now - timedelta(minutes=30)), 15000)
+        self.assertEqual(polling.next_poll_ms(now - timedelta(hours=2)), 30000)
+        self.assertEqual(polling.next_poll_ms(None), 30000)
+
+    def test_hidden_tabs_and_long_polls(self):
+        now = timezone.now()
+        self.assertEqual(polling.next_poll_ms(now, visible=False), 30000)
+        self.assertEqual(polling.next_poll_ms(now, long_poll=True), 0)
+        self.assertEqual(polling.next_poll_ms(now, visible=False, long_poll=True), 30000)
+
+    @override_settings(POLL_JITTER=0.1)
+    def test_jitter(self):
+        intervals = {polling.next_poll_ms(timezone.now()) for _ in range(50)}
+        self.assertTrue(all(1800 <= interval <= 2200 for interval in intervals))
+        self.assertGreater(len(intervals), 1)
+
+
+@override_settings(THROTTLE_RATES={'poll': (1, 2), 'send': (1, 1)}, POLL_JITTER=0)
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+        Message.objects.create(conversation=self.conversation, sender=self.bob, content='hi')
+
+    def test_token_bucket(self):
+        self.assertEqual(throttling.take('poll', 'u1'), 0)
+        self.assertEqual(throttling.take('poll', 'u1'), 0)
+        self.assertAlmostEqual(throttling.take('poll', 'u1'), 1, delta=0.1)
+        self.assertEqual(throttling.take('poll', 'u2'), 0)
+        self.assertEqual(throttling.take('unlimited', 'u1'), 0)
+
+    def test_page_poll_is_limited_per_user(self):
+        path = f'/chat/conversation/{self.conversation.id}/get-messages/'
+        self.client.force_login(self.alice)
+        response = self.client.get(path, headers={'X-Page-Visibility': 'hidden'})
+        self.assertEqual(response['X-Poll-Interval'], '30000')
+        self.assertEqual(self.client.get(path)['X-Poll-Interval'], '2000')
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+    def test_api_is_limited(self):
+        client = api_client(self.alice)
+        data = {'conversation': self.conversation.id, 'content': 'hello'}
+        self.assertEqual(client.post('/chat/api/messages/', data, format='json').status_code, 201)
+        response = client.post('/chat/api/messages/', data, format='json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        # Reads are on other buckets
+        self.assertEqual(client.get(f'/chat/api/conversations/{self.conversation.id}/messages/').status_code, 200)
+
+    @override_settings(THROTTLE_RATES={'auth': (0.01, 1)}, TRUSTED_PROXIES=1)
+    def test_logins_behind_a_proxy_are_limited_per_client(self):
+        def login(forwarded_for):
+            return self.client.post('/chat/api/auth/login/', {'username': 'alice', 'password': 'nope'},
+                                    headers={'X-Forwarded-For': forwarded_for}, REMOTE_ADDR='10.0.0.1')
+
+        self.assertEqual(login('203.0.113.5').status_code, 401)
+        self.assertEqual(login('203.0.113.5').status_code, 429)
+        # Another client behind the same balancer, and a forged leftmost entry is ignored
+        self.assertEqual(login('203.0.113.6').status_code, 401)
+        self.assertEqual(login('198.51.100.1, 203.0.113.5').status_code, 429)
+        with override_settings(TRUSTED_PROXIES=0):
+            self.assertEqual(login('203.0.113.7').status_code, 401)
+            self.assertEqual(login('203.0.113.8').status_code, 429)
+
+    async def test_async_views_are_limited(self):
+        path = f'/chat/api/conversations/{self.conversation.id}/messages/'
+        auth = {'Authorization': f'Bearer {await sync_to_async(AccessToken.for_user)(self.alice)}'}
+        statuses = [(await self.async_client.get(path, headers=auth)).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+
+class PurgeTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.storage = Message._meta.get_field('file').storage
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        self.conversation = make_conversation(self.alice, self.bob)
+
+    def deleted_for_everyone(self, days_ago):
+        message = Message.objects.create(conversation=self.conversation, sender=self.bob, content='secret',
+                                         file=ContentFile(b'data', name='notes.txt'))
+        message.toggle_reaction(self.alice, '👍')
+        message.read_by.add(self.alice)
+        message.delete_for_everyone()
+        Message.objects.filter(id=message.id).update(deleted_at=timezone.now() - timedelta(days=days_ago))
+        return message
+
+    def test_tombstones_are_stripped_after_the_grace_period(self):
+        old = self.deleted_for_everyone(40)
+        recent = self.deleted_for_everyone(1)
+        file_name = old.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(purge.purge_messages(grace=timedelta(days=30), vacuum=False), (1, 0))
+        old.refresh_from_db()
+        self.assertTrue(old.is_deleted)
+        self.assertEqual((old.content, old.file.name), (None, ''))
+        self.assertFalse(old.reactions.exists() or old.read_by.exists())
+        self.assertFalse(self.storage.exists(file_name))
+        recent.refresh_from_db()
+        self.assertIsNotNone(recent.content)
+        self.assertEqual(purge.purge_messages(grace=timedelta(days=30), vacuum=False), (0, 0))
+
+    def test_messages_hidden_by_everyone_are_deleted(self):
+        hidden = Message.objects.create(conversation=self.conversation, sender=self.bob, content='gone')
+        reply = Message.objects.create(conversation=self.conversation, sender=self.alice, content='re', parent=hidden)
+        hidden.deleted_by.add(self.alice)
+        self.assertEqual(purge.purge_messages(vacuum=False), (0, 0))
+        hidden.deleted_by.add(self.bob)
+        self.assertEqual(purge.purge_messages(vacuum=False), (0, 1))
+        self.assertFalse(Message.objects.filter(id=hidden.id).exists())
+        reply.refresh_from_db()
+        self.assertIsNone(reply.parent_id)
+
+    def test_interrupted_run_continues(self):
+        for _ in range(3):
+            self.deleted_for_everyone(40)
+        self.assertEqual(purge.purge_messages(batch_size=1, max_batches=2, vacuum=False), (2, 0))
+        self.assertEqual(purge.purge_messages(batch_size=1, vacuum=False), (1, 0))
+
+    def test_command(self):
+        self.deleted_for_everyone(40)
+        out = StringIO()
+        call_command('purge_messages', grace_days=30, no_vacuum=True, pause=0, stdout=out)
+        self.assertIn('Purged 1 deleted-for-everyone messages', out.getvalue())
@@ -0,0 +1,137 @@
+"""
+Per-user rate limits: one token bucket per scope and user (per client
+address for anonymous requests; set TRUSTED_PROXIES behind a load balancer,
+or every logged-out client shares the balancer's address and bucket).
+
+settings.THROTTLE_RATES maps each scope to (tokens per second, burst). A
+bucket holds up to `burst` requests and refills at the given rate, so short
+bursts pass and a client that keeps flooding gets 429 with Retry-After. A
+scope missing from THROTTLE_RATES is not limited.
+
+A bucket is a single float in the THROTTLE_CACHE cache: the time at which
+it would be full again (the "theoretical arrival time" of the generic cell
+rate algorithm). A check costs one get and one set. With the default
+per-process locmem cache each worker process keeps its own buckets, and
+PRIVATE_MESSAGING_CACHE=file or db shares them between the processes of a
+host. Concurrent requests of one user can race on the read-modify-write and
+let a request or two more through. The limits guard the workers against
+floods; they are not exact quotas.
+
+TokenBucketThrottle plugs the buckets into DRF. ViewSets and actions choose
+the scope with throttle_scope, and @api_view functions with
+@throttle_scope(...). Plain Django views use @throttle(scope), and async
+views call athrottled() once they know the user.
+"""
+import functools
+import math
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import JsonResponse
+from rest_framework.throttling import BaseThrottle
+
+DEFAULT_SCOPE = 'api'
+
+
+def client_address(request):
+    """
+    The address of the client, as seen by the first of the TRUSTED_PROXIES.
+
+    Behind a load balancer REMOTE_ADDR is the balancer's. Each proxy appends
+    the address it got the request from to X-Forwarded-For, so with n proxies
+    the client's is the n-th entry from the right; entries left of it come
+    from the client and may be forged.
+    """
+    proxies = getattr(settings, 'TRUSTED_PROXIES', 0)
+    forwarded = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+    if proxies and forwarded:
+        return forwarded[-min(proxies, len(forwarded))]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def client_id(request, user=None):
+    user = user or request.user
+    if user is not None and user.is_authenticated:
+        return f'u{user.pk}'
+    return f'a{client_address(request)}'
+
+
+def take(scope, ident):
+    """Spends a token of ident's bucket for scope: 0 if there was one, else the seconds until there is."""
+    rate = getattr(settings, 'THROTTLE_RATES', {}).get(scope)
+    if rate is None:
+        return 0
+    per_second, burst = rate
+    interval = 1 / per_second
+    cache = caches[getattr(settings, 'THROTTLE_CACHE', 'default')]
+    key = f'throttle:{scope}:{ident}'
+    now = time.time()
+    full_at = max(cache.get(key, now), now) + interval
+    if full_at - now > burst * interval:
+        return full_at - now - burst * interval
+    cache.set(key, full_at, math.ceil(full_at - now))
+    return 0
+
+
+async def atake(scope, ident):
+    if isinstance(caches[getattr(settings, 'THROTTLE_CACHE', 'default')], LocMemCache):
+        return take(scope, ident)  # in process, nothing to wait for
+    return await sync_to_async(take)(scope, ident)
+
+
+def throttled_detail(wait):
+    """The message DRF answers a throttled request with"""
+    seconds = math.ceil(wait)
+    unit = 'second' if seconds == 1 else 'seconds'
+    return f'Request was throttled. Expected available in {seconds} {unit}.'
+
+
+def too_many_requests(wait):
+    return JsonResponse({'detail': throttled_detail(wait)}, status=429, headers={'Retry-After': str(math.ceil(wait))})
+
+
+def throttled(scope, request, user=None):
+    """A 429 response if the client's bucket for scope is empty, else None."""
+    wait = take(scope, client_id(request, user))
+    return too_many_requests(wait) if wait else None
+
+
+async def athrottled(scope, request, user):
+    wait = await atake(scope, client_id(request, user))
+    return too_many_requests(wait) if wait else None
+
+
+def throttle(scope, methods=None):
+    """Decorator for Django views; with methods, only requests of those methods spend tokens."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if methods is None or request.method in methods:
+                response = throttled(scope, request)
+                if response is not None:
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def throttle_scope(scope):
+    """Sets the scope of an @api_view function; place it above @api_view."""
+    def decorator(view):
+        view.cls.throttle_scope = scope
+        return view
+    return decorator
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """DRF throttle on the view's throttle_scope bucket ('api' by default)"""
+
+    def allow_request(self, request, view):
+        self.delay = take(getattr(view, 'throttle_scope', None) or DEFAULT_SCOPE, client_id(request))
+        return not self.delay
+
+    def wait(self):
+        return self.delay
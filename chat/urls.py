@@ -14,22 +14,34 @@ urlpatterns = [
     path('', views.conversation_list, name='conversation_list'),
     path('register/', views.register, name='register'),
     path('profile/', views.profile, name='profile'),
+    path('profile/qr/', views.my_qr, name='my_qr'),
     path('sent-requests/', views.sent_requests, name='sent_requests'),
 
     path('send-request/', views.send_request, name='send_request'),
+    path('users/search/', views.search_users, name='search_users'),
     path('inbox/', views.inbox, name='inbox'),
     path('accept/<int:request_id>/', views.accept_request, name='accept_request'),
 
     path('<int:pk>/', views.conversation_detail, name='conversation_detail'),
     path('conversation/<int:pk>/get-messages/', views.get_messages, name='get_messages'),
+    path('conversation/<int:pk>/presence/', views.conversation_presence, name='conversation_presence'),
+    path('conversation/<int:pk>/disappearing/', views.set_disappearing, name='set_disappearing'),
     
     # Message actions
     path('message/<int:message_id>/delete/', views.delete_message, name='delete_message'),
     path('message/<int:message_id>/react/', views.add_reaction, name='add_reaction'),
     
+    # Profiling captures (staff)
+    path('profiling/', views.profile_captures, name='profile_captures'),
+    path('profiling/<str:name>.<str:suffix>', views.download_profile_capture, name='download_profile_capture'),
+
     # API URLs
     path('api/', include(router.urls)),
     path('api/auth/register/', api_views.register_api, name='api-register'),
     path('api/auth/login/', api_views.login_api, name='api-login'),
     path('api/auth/me/', api_views.current_user_api, name='api-me'),
+    path('api/batch/', api_views.batch_api, name='api-batch'),
+    path('api/sync/', api_views.sync_api, name='api-sync'),
+    path('api/users/search/', api_views.user_search_api, name='api-user-search'),
+    path('api/presence/', api_views.presence_api, name='api-presence'),
 ]
@@ -0,0 +1,165 @@
+"""
+User search for chat requests (the /chat/api/users/search/ endpoint and the
+web autocomplete).
+
+Every user's username, first and last name, and full name are stored
+normalized in UserSearchTerm: accents are stripped, case is folded, and only
+letters and digits are kept. The User post_save handler below keeps these
+rows current, migration 0015 indexes the users that predate them, and
+`manage.py rebuild_user_search` rebuilds them all. A prefix
+query is a range scan on the term index (term >= q AND term < q + U+10FFFF).
+Every backend can serve that from a b-tree, whereas SQLite's
+case-insensitive LIKE 'q%' cannot use one.
+
+When prefixes find too few users, the query's trigrams are looked up in
+UserSearchGram, which makes the search tolerant of typos. Trigrams shared by
+more than USER_SEARCH_GRAM_MAX_USERS users are skipped, because they are too
+common to tell users apart. Candidates are ranked by the number of shared
+trigrams, then by similarity.
+
+The candidate ids for a normalized query are cached for
+USER_SEARCH_CACHE_SECONDS and shared by all users. The searcher, inactive
+users, and users who already share a conversation with the searcher are
+removed on each request.
+"""
+import hashlib
+import unicodedata
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_save
+
+from .models import Conversation, UserSearchGram, UserSearchTerm
+
+TERM_MAX_LENGTH = UserSearchTerm._meta.get_field('term').max_length
+
+
+def normalize(text):
+    """'Zoë-Ann O'Neil' -> 'zoeannoneil'"""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in decomposed.casefold() if c.isalnum() and not unicodedata.combining(c))
+
+
+def terms_for(user):
+    names = (user.username, user.first_name, user.last_name, f'{user.first_name}{user.last_name}')
+    return {term[:TERM_MAX_LENGTH] for term in map(normalize, names) if term}
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def grams_for(terms):
+    # Anchored at the start of each term, so leading characters weigh more
+    return set().union(*(trigrams(f'^{term}$') for term in terms))
+
+
+def index_users(users):
+    """(Re)writes the search rows of users."""
+    users = list(users)
+    with transaction.atomic():
+        user_ids = [user.id for user in users]
+        UserSearchTerm.objects.filter(user_id__in=user_ids).delete()
+        UserSearchGram.objects.filter(user_id__in=user_ids).delete()
+        terms, grams = [], []
+        for user in users:
+            user_terms = terms_for(user)
+            terms += [UserSearchTerm(user_id=user.id, term=term) for term in user_terms]
+            grams += [UserSearchGram(user_id=user.id, gram=gram) for gram in grams_for(user_terms)]
+        UserSearchTerm.objects.bulk_create(terms, batch_size=1000)
+        UserSearchGram.objects.bulk_create(grams, batch_size=1000)
+
+
+def rebuild(batch_size=1000, log=None):
+    """Indexes every user, batch by batch. Returns the number of users."""
+    User = get_user_model()
+    total = last_id = 0
+    while True:
+        batch = list(User.objects.filter(id__gt=last_id).order_by('id')
+                     .only('id', 'username', 'first_name', 'last_name')[:batch_size])
+        if not batch:
+            return total
+        index_users(batch)
+        total += len(batch)
+        last_id = batch[-1].id
+        if log:
+            log(f"indexed {total} users")
+
+
+# Searching
+
+def _prefix_matches(query, limit):
+    # A user matches through up to four terms; read enough rows for `limit` distinct users
+    rows = (UserSearchTerm.objects.filter(term__gte=query, term__lt=query + '\U0010ffff')
+            .order_by('term', 'user_id').values_list('user_id', flat=True)[:limit * 4])
+    return list(dict.fromkeys(rows))[:limit]
+
+
+def _fuzzy_matches(query, limit, exclude):
+    max_users = getattr(settings, 'USER_SEARCH_GRAM_MAX_USERS', 5000)
+    query_grams = trigrams(f'^{query}')
+    grams = [
+        gram for gram in query_grams
+        if UserSearchGram.objects.filter(gram=gram).values('id')[max_users:max_users + 1].count() == 0
+    ]
+    if not grams:
+        return []
+    # A match shares half of the query's trigrams; the skipped common ones are assumed shared
+    min_hits = max(1, (len(query_grams) + 1) // 2 - (len(query_grams) - len(grams)))
+    hits = dict(
+        UserSearchGram.objects.filter(gram__in=grams).exclude(user_id__in=exclude)
+        .values('user_id').annotate(hits=Count('id'))
+        .filter(hits__gte=min_hits)
+        .order_by('-hits', 'user_id').values_list('user_id', 'hits')[:limit * 2]
+    )
+    best = {}
+    for user_id, term in UserSearchTerm.objects.filter(user_id__in=hits).values_list('user_id', 'term'):
+        similarity = SequenceMatcher(None, query, term[:len(query) + 2]).ratio()
+        best[user_id] = max(best.get(user_id, 0), similarity)
+    return sorted(hits, key=lambda user_id: (-hits[user_id], -best.get(user_id, 0), user_id))[:limit]
+
+
+def candidates(query):
+    """Ids of the users best matching a normalized query, cached briefly and shared by all searchers."""
+    key = 'chat:user-search:' + hashlib.md5(query.encode(), usedforsecurity=False).hexdigest()
+    ids = cache.get(key)
+    if ids is None:
+        limit = getattr(settings, 'USER_SEARCH_CANDIDATES', 50)
+        ids = _prefix_matches(query, limit)
+        if len(ids) < limit and len(query) >= 3:
+            ids += _fuzzy_matches(query, limit - len(ids), exclude=ids)
+        cache.set(key, ids, getattr(settings, 'USER_SEARCH_CACHE_SECONDS', 30))
+    return ids
+
+
+def search_users(user, query, limit=None):
+    """Users matching query by prefix or closely, best first, minus user and the users they already chat with."""
+    query = normalize(query)[:TERM_MAX_LENGTH]
+    if len(query) < getattr(settings, 'USER_SEARCH_MIN_LENGTH', 2):
+        return []
+    limit = limit or getattr(settings, 'USER_SEARCH_LIMIT', 10)
+    ids = [user_id for user_id in candidates(query) if user_id != user.id]
+    connected = set(
+        Conversation.participants.through.objects
+        .filter(conversation__participants=user, user_id__in=ids).values_list('user_id', flat=True)
+    )
+    ids = [user_id for user_id in ids if user_id not in connected]
+    users = get_user_model().objects.filter(id__in=ids, is_active=True).select_related('profile').in_bulk()
+    return [users[user_id] for user_id in ids if user_id in users][:limit]
+
+
+# Index maintenance
+
+def _user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logins only touch last_login
+    if not raw and update_fields != frozenset({'last_login'}):
+        index_users([instance])
+
+
+def connect_signals():
+    """Hooked up in ChatConfig.ready"""
+    post_save.connect(_user_saved, sender=get_user_model(), dispatch_uid='chat.user_search.user_saved')
@@ -1,25 +1,35 @@
-from cryptography.fernet import Fernet
 from django.conf import settings
 import base64
+from .metrics import timed_crypto
 
 def get_fernet():
+    # cryptography loads on the first encrypt/decrypt, not at startup
+    from cryptography.fernet import Fernet, MultiFernet
+
     key = getattr(settings, 'ENCRYPTION_KEY', None)
     if not key:
         # Emergency fallback to a static key if settings is broken
         # This prevents the app from crashing but might lead to data loss if swapped
         return Fernet(b'L3A9X-V08Y-A6v4K_X-dGVzdC1rZXktZm9yLWRldmVsb3BtZW50Cg==')
     try:
-        return Fernet(key)
+        fernet = Fernet(key)
     except:
         # If the key provided in settings is invalid (e.g. wrong format)
         return Fernet(b'L3A9X-V08Y-A6v4K_X-dGVzdC1rZXktZm9yLWRldmVsb3BtZW50Cg==')
+    old_keys = getattr(settings, 'ENCRYPTION_OLD_KEYS', [])
+    if old_keys:
+        # Encrypts with the current key, still decrypts what older keys wrote
+        return MultiFernet([fernet] + [Fernet(old_key) for old_key in old_keys])
+    return fernet
 
+@timed_crypto('encrypt')
 def encrypt_message(text):
     if not text:
         return ""
     f = get_fernet()
     return f.encrypt(text.encode()).decode()
 
+@timed_crypto('decrypt')
 def decrypt_message(token):
     if not token:
         return ""
@@ -39,3 +49,17 @@ def decrypt_message(token):
 
 def is_encrypted(text):
     return text.startswith('gAAAA') if text else False
+
+def rotate_ciphertext(token):
+    """Re-encrypts a token with the current key; returns it unchanged if it isn't one we can read."""
+    if not is_encrypted(token):
+        return token
+    from cryptography.fernet import InvalidToken, MultiFernet
+
+    f = get_fernet()
+    if not isinstance(f, MultiFernet):
+        return token
+    try:
+        return f.rotate(token.encode()).decode()
+    except InvalidToken:
+        return token
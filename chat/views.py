@@ -5,9 +5,18 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, get_user_model
 from django.contrib import messages
 from django.db import models
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from django.utils.timesince import timesince
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404
+from datetime import datetime, timedelta, timezone
 from .models import Conversation, Message, ChatRequest, Profile
 from .forms import ProfileForm
+from . import polling, presence, sync, user_search
+from .throttling import throttle
 
+@throttle('auth', methods=['POST'])
 def register(request):
     if request.method == 'POST':
         form = UserCreationForm(request.POST)
@@ -19,20 +28,41 @@ def register(request):
         form = UserCreationForm()
     return render(request, 'registration/register.html', {'form': form})
 
-import qrcode
-from django.http import HttpResponse
-from io import BytesIO
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from urllib.parse import urlencode
+from . import qr
+
+def _qr_headers(response, etag):
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'QR_MAX_AGE', 86400))
+    # Private to the logged-in user, who may change on the same browser
+    patch_vary_headers(response, ['Cookie'])
+    return response
 
-@never_cache
 @login_required
 def my_qr(request):
+    """QR code of the user's chat-request link (?size=<pixels>&format=png|svg)"""
+    fmt = request.GET.get('format', 'png')
+    min_size, max_size = qr.size_limits()
+    try:
+        size = int(request.GET.get('size', getattr(settings, 'QR_DEFAULT_SIZE', 320)))
+    except ValueError:
+        size = None
+    if fmt not in qr.FORMATS or size is None or not min_size <= size <= max_size:
+        return HttpResponseBadRequest(f"format must be png or svg, size {min_size}-{max_size}")
+
     url = request.build_absolute_uri(
-        f"/chat/send-request/?username={request.user.username}"
+        reverse('send_request') + '?' + urlencode({'username': request.user.username})
     )
-    qr = qrcode.make(url)
-    buffer = BytesIO()
-    qr.save(buffer, format="PNG")
-    return HttpResponse(buffer.getvalue(), content_type="image/png")
+    if not qr.fits(url, size):
+        return HttpResponseBadRequest(f"size must be at least {qr.min_size(url)} for this code")
+    etag = qr.etag(url, size, fmt)
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified:
+        return _qr_headers(not_modified, etag)
+    return _qr_headers(HttpResponse(qr.render(url, size, fmt), content_type=qr.FORMATS[fmt]), etag)
 
 @never_cache
 @login_required
@@ -48,6 +78,17 @@ def profile(request):
         form = ProfileForm(instance=request.user.profile)
     return render(request, 'chat/profile.html', {'form': form})
 
+@never_cache
+@login_required
+@throttle('search')
+def search_users(request):
+    """Autocomplete for the chat-request box: ?q=<part of a username or name>"""
+    users = user_search.search_users(request.user, request.GET.get('q', ''))
+    return JsonResponse({'results': [{
+        'username': u.username,
+        'name': f'{u.first_name} {u.last_name}'.strip(),
+    } for u in users]})
+
 @never_cache
 @login_required
 def sent_requests(request):
@@ -65,8 +106,10 @@ def conversation_list(request):
 from django.http import JsonResponse, HttpResponse
 from django.template.loader import render_to_string
 
+
 @never_cache
 @login_required
+@throttle('send', methods=['POST'])
 def conversation_detail(request, pk):
     conversation = get_object_or_404(
         Conversation,
@@ -83,7 +126,7 @@ def conversation_detail(request, pk):
         if content or file:
             parent = None
             if parent_id:
-                parent = get_object_or_404(Message, id=parent_id)
+                parent = get_object_or_404(Message, id=parent_id, conversation=conversation)
 
             msg = Message.objects.create(
                 conversation=conversation,
@@ -101,20 +144,79 @@ def conversation_detail(request, pk):
                 })
         return redirect('conversation_detail', pk=pk)
 
-    msgs = conversation.messages.order_by('timestamp')
+    # Opening the chat reads it, which also starts read-mode disappearing timers
+    conversation.mark_as_read(request.user)
+    msgs = list(
+        conversation.messages.unexpired().exclude(deleted_by=request.user)
+        .select_related('sender', 'parent__sender').prefetch_related('reactions').order_by('timestamp')
+    )
+    for m in msgs:
+        m.is_mine = m.sender_id == request.user.id
+        m.parent_is_mine = m.parent is not None and m.parent.sender_id == request.user.id
     other_user = conversation.get_other_user(request.user)
 
     return render(request, 'chat/conversation_detail.html', {
         'conversation': conversation,
         'chat_messages': msgs,
-        'other_user': other_user
+        'other_user': other_user,
+        'presence': presence.conversation_state(conversation.id, [other_user.id], request.user.id),
+        'disappearing_timers': disappearing_timers(),
     })
 
+
+def disappearing_timers():
+    """[(seconds, label)] of settings.DISAPPEARING_MESSAGE_TIMERS"""
+    now = datetime.now(timezone.utc)
+    return [(seconds, timesince(now - timedelta(seconds=seconds), now))
+            for seconds in getattr(settings, 'DISAPPEARING_MESSAGE_TIMERS', ())]
+
+
+def parse_disappearing(seconds, after):
+    """Validated (seconds or None, after) for Conversation.set_disappearing; raises ValueError."""
+    timers = getattr(settings, 'DISAPPEARING_MESSAGE_TIMERS', ())
+    try:
+        seconds = int(seconds or 0) or None  # empty or 0 turns the timer off
+    except (TypeError, ValueError):
+        seconds = -1
+    if seconds is not None and seconds not in timers:
+        raise ValueError(f"seconds must be one of {list(timers)} or empty")
+    if after not in (Conversation.AFTER_SEND, Conversation.AFTER_READ):
+        raise ValueError(f"after must be {Conversation.AFTER_SEND!r} or {Conversation.AFTER_READ!r}")
+    return seconds, after
+
+
+@never_cache
+@login_required
+def set_disappearing(request, pk):
+    """POST seconds=<timer or empty>&after=sent|read: the conversation's disappearing-message timer"""
+    conversation = get_object_or_404(Conversation, pk=pk, participants=request.user)
+    if request.method == 'POST':
+        try:
+            seconds, after = parse_disappearing(request.POST.get('seconds'),
+                                                request.POST.get('after', Conversation.AFTER_SEND))
+        except ValueError as exc:
+            messages.error(request, str(exc))
+        else:
+            conversation.set_disappearing(seconds, after)
+    return redirect('conversation_detail', pk=pk)
+
 @never_cache
 @login_required
+@throttle('poll')
 def get_messages(request, pk):
-    """API for AJAX message polling"""
+    """API for AJAX message polling; X-Poll-Interval says when to poll next (chat/polling.py)"""
     conversation = get_object_or_404(Conversation, pk=pk, participants=request.user)
+    presence.touch(request.user.id)
+    version, changed_at = sync.conversation_state(conversation.id, request.user)
+    etag = sync.etag('messages', version, request.user, request)
+    not_modified = sync.not_modified(request, etag)
+    if not_modified:
+        return polling.hint(not_modified, request, changed_at)
+    # A visible page shows what it fetched: mark it read (the page drops its ETag when it comes back into view)
+    if polling.is_visible(request) and conversation.mark_as_read(request.user):
+        # The read marks moved the version; answer with the new one so the next poll can get a 304
+        version, changed_at = sync.conversation_state(conversation.id, request.user)
+        etag = sync.etag('messages', version, request.user, request)
     after_id = request.GET.get('after', 0)
     
     try:
@@ -125,31 +227,52 @@ def get_messages(request, pk):
     # We fetch ALL messages modified after a certain point or just the last 50 for status sync
     # For simplicity and to catch deletions of OLD messages, let's just return the last 50 messages
     # and let the frontend decide what to add or update.
-    msgs = conversation.messages.order_by('-timestamp')[:50]
-    msgs = reversed(msgs) # Back to chronological
-        
-    data = []
-    for m in msgs:
-        # If user deleted for themselves, skip
-        if request.user in m.deleted_by.all():
-            continue
-            
-        data.append({
-            'id': m.id,
-            'sender': m.sender.username,
-            'content': m.decrypted_content if not m.is_deleted else None,
-            'timestamp': m.timestamp.strftime('%H:%M'),
-            'is_me': m.sender == request.user,
-            'is_deleted': m.is_deleted,
-            'file_url': m.file.url if m.file and not m.is_deleted else None,
-            'is_image': m.is_image,
-            'is_audio': m.is_audio,
-            'parent_id': m.parent.id if m.parent and not m.parent.is_deleted else None,
-            'parent_sender': m.parent.sender.username if m.parent and not m.parent.is_deleted else None,
-            'parent_content': (m.parent.decrypted_content or m.parent.content) if m.parent and not m.parent.is_deleted else None,
-        })
-    
-    return JsonResponse(data, safe=False)
+    # Messages the user deleted for themselves are skipped
+    msgs = (
+        conversation.messages.unexpired().exclude(deleted_by=request.user)
+        .select_related('sender', 'parent__sender').order_by('-timestamp')[:50]
+    )
+    data = [message_json(m, request.user) for m in reversed(msgs)]  # Back to chronological
+
+    response = JsonResponse(data, safe=False)
+    response['ETag'] = etag
+    return polling.hint(response, request, changed_at)
+
+
+@never_cache
+@login_required
+@throttle('poll')
+def conversation_presence(request, pk):
+    """Online/typing state of the other participants; POST typing=1|0 reports the user's own typing"""
+    participant_ids = list(Conversation.participants.through.objects.filter(conversation_id=pk).values_list('user_id', flat=True))
+    if request.user.id not in participant_ids:
+        raise Http404
+    if request.method == 'POST':
+        presence.set_typing(pk, request.user.id, request.POST.get('typing') == '1')
+    else:
+        presence.touch(request.user.id)
+    return JsonResponse(presence.conversation_state(pk, participant_ids, request.user.id))
+
+
+def message_json(m, user):
+    """One message as the conversation page's poller expects it (shared with chat.async_views)"""
+    parent = m.parent if m.parent and not m.parent.is_deleted else None
+    return {
+        'id': m.id,
+        'sender': m.sender.username,
+        'content': m.decrypted_content if not m.is_deleted else None,
+        'timestamp': m.timestamp.strftime('%H:%M'),
+        'is_me': m.sender_id == user.id,
+        'is_deleted': m.is_deleted,
+        'file_url': m.file.url if m.file and not m.is_deleted else None,
+        'is_image': m.is_image,
+        'thumbnail_url': m.thumbnail_url if not m.is_deleted else None,
+        'is_audio': m.is_audio,
+        'parent_id': parent.id if parent else None,
+        'parent_sender': parent.sender.username if parent else None,
+        'parent_content': (parent.decrypted_content or parent.content) if parent else None,
+        'expires_at': int(m.expires_at.timestamp()) if m.expires_at else None,
+    }
 
 @never_cache
 @login_required
@@ -176,6 +299,7 @@ def accept_request(request, request_id):
 
 @never_cache
 @login_required
+@throttle('send', methods=['POST'])
 def send_request(request):
     if request.method == 'POST':
         username = request.POST.get('username')
@@ -216,7 +340,7 @@ def send_request(request):
 @login_required
 def delete_message(request, message_id):
     """Handle message deletion - both 'for me' and 'for everyone'"""
-    message = get_object_or_404(Message, id=message_id)
+    message = get_object_or_404(Message.objects.unexpired(), id=message_id)
     conversation = message.conversation
     
     # Check if user is part of the conversation
@@ -229,8 +353,7 @@ def delete_message(request, message_id):
     if delete_type == 'for_everyone':
         # Only sender can delete for everyone
         if message.sender == request.user:
-            message.is_deleted = True
-            message.save()
+            message.delete_for_everyone()
             messages.success(request, "Message deleted for everyone.")
         else:
             messages.error(request, "You can only delete your own messages for everyone.")
@@ -245,9 +368,7 @@ def delete_message(request, message_id):
 @login_required
 def add_reaction(request, message_id):
     """Add emoji reaction to a message"""
-    from .models import MessageReaction
-    
-    message = get_object_or_404(Message, id=message_id)
+    message = get_object_or_404(Message.objects.unexpired(), id=message_id)
     conversation = message.conversation
     
     # Check if user is part of the conversation
@@ -258,16 +379,51 @@ def add_reaction(request, message_id):
     emoji = request.POST.get('emoji', '👍')
     
     # Toggle reaction - if exists, remove it; if not, add it
-    reaction, created = MessageReaction.objects.get_or_create(
-        message=message,
-        user=request.user,
-        emoji=emoji
-    )
+    reaction, created = message.toggle_reaction(request.user, emoji)
     
     if not created:
-        reaction.delete()
         messages.success(request, "Reaction removed.")
     else:
         messages.success(request, "Reaction added.")
     
     return redirect('conversation_detail', pk=conversation.pk)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint: staff users, or `Authorization: Bearer <METRICS_TOKEN>`"""
+    from .metrics import render_prometheus
+
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        authorized = True
+    if not authorized:
+        return HttpResponse(status=403)
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@never_cache
+@staff_member_required
+def profile_captures(request):
+    """Staff list of profiling captures, plus a fresh X-Profile token to hand out"""
+    from .profiling import list_captures, make_profile_token
+
+    captures = [
+        {'name': name, 'created': datetime.fromtimestamp(modified, tz=timezone.utc), 'size': size}
+        for name, modified, size in list_captures()
+    ]
+    return render(request, 'chat/profile_captures.html', {
+        'captures': captures,
+        'token': make_profile_token(request.user),
+    })
+
+
+@never_cache
+@staff_member_required
+def download_profile_capture(request, name, suffix):
+    from .profiling import capture_path
+
+    path = capture_path(name, f'.{suffix}')
+    if path is None:
+        raise Http404("No such capture")
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=path.name)
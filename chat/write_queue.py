@@ -0,0 +1,114 @@
+"""
+In-process write queue for small writes (read marks, reactions).
+
+SQLite allows one writer at a time and every transaction pays for its own
+commit. Funnelling small writes from all request threads through a single
+writer thread turns many competing transactions into one batch, which
+removes most "database is locked" errors and commit overhead.
+
+Enabled by settings.SQLITE_WRITE_QUEUE; otherwise writes run inline. Queued
+writes run in a copy of the submitting thread's context, so request state
+held in ContextVars (the database router's read-your-writes flag, the
+identity map) sees them as it would an inline write.
+"""
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    def __init__(self, max_batch=200, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); the returned Future resolves after commit."""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((future, contextvars.copy_context(), fn, args, kwargs))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='chat-write-queue', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        results = []
+        try:
+            with transaction.atomic():
+                for future, context, fn, args, kwargs in batch:
+                    try:
+                        # Savepoint per write: one failing write doesn't sink the batch
+                        with transaction.atomic():
+                            results.append((future, context.run(fn, *args, **kwargs), None))
+                    except Exception as exc:
+                        results.append((future, None, exc))
+        except Exception as exc:
+            logger.exception("Write batch of %d failed to commit", len(batch))
+            connection.close()
+            for future, *_ in batch:
+                future.set_exception(exc)
+            return
+
+        for future, result, exc in results:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+_write_queue = None
+_write_queue_lock = threading.Lock()
+
+
+def get_write_queue():
+    global _write_queue
+    if _write_queue is None:
+        with _write_queue_lock:
+            if _write_queue is None:
+                _write_queue = WriteQueue(
+                    max_batch=getattr(settings, 'SQLITE_WRITE_QUEUE_MAX_BATCH', 200),
+                    max_wait=getattr(settings, 'SQLITE_WRITE_QUEUE_MAX_WAIT', 0.005),
+                )
+    return _write_queue
+
+
+def run_write(fn, *args, **kwargs):
+    """
+    Run a small write through the queue and return its result once committed.
+
+    Runs inline when the queue is disabled, or when the caller already holds a
+    transaction (waiting on the writer thread there could deadlock SQLite).
+    """
+    if not getattr(settings, 'SQLITE_WRITE_QUEUE', False) or connection.in_atomic_block:
+        return fn(*args, **kwargs)
+    return get_write_queue().submit(fn, *args, **kwargs).result()
@@ -2,6 +2,8 @@
 ASGI config for private_messaging project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests coming through here are routed with ``private_messaging.asgi_urls``,
+which serves the polling and messaging endpoints from async views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
@@ -9,8 +11,13 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
+from django.urls import get_resolver
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'private_messaging.settings')
 
 application = get_asgi_application()
+
+# Import the views now, at boot, rather than on the first request
+get_resolver(settings.ASGI_ROOT_URLCONF).url_patterns
@@ -0,0 +1,18 @@
+"""
+URLconf for requests served through asgi.py.
+
+Same URLs and names as private_messaging.urls, with the hot polling and
+messaging endpoints swapped for their async versions (chat/async_views.py).
+chat.middleware.ASGIURLConfMiddleware selects it for ASGI requests.
+"""
+from django.urls import path
+
+from chat import async_views
+from private_messaging.urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('chat/conversation/<int:pk>/get-messages/', async_views.get_messages, name='get_messages'),
+    path('chat/api/conversations/<int:pk>/messages/', async_views.conversation_messages,
+         name='api-conversation-messages'),
+    path('chat/api/messages/', async_views.message_list, name='api-message-list'),
+] + sync_urlpatterns
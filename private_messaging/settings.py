@@ -2,6 +2,7 @@
 Django settings for private_messaging project.
 """
 
+import importlib.util
 import os
 from pathlib import Path
 from datetime import timedelta
@@ -36,17 +37,27 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.MetricsMiddleware',
+    'chat.middleware.CompressionMiddleware',
+    'chat.middleware.ASGIURLConfMiddleware',
+    'chat.middleware.IdentityMapMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'chat.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'chat.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
 ROOT_URLCONF = 'private_messaging.urls'
+# Under ASGI the polling/messaging endpoints are served by async views
+ASGI_ROOT_URLCONF = 'private_messaging.asgi_urls'
+# Threads for decryption/serialization behind the async views
+ASYNC_CPU_WORKERS = int(os.environ.get('PRIVATE_MESSAGING_ASYNC_CPU_WORKERS', 4))
 
 TEMPLATES = [
     {
@@ -67,13 +78,97 @@ TEMPLATES = [
 WSGI_APPLICATION = 'private_messaging.wsgi.application'
 
 # Database
-DATABASES = {
-    'default': {
+# PRIVATE_MESSAGING_DB_ENGINE=postgres switches every alias to PostgreSQL
+# (psycopg2); the default is SQLite files next to manage.py.
+DB_ENGINE = os.environ.get("PRIVATE_MESSAGING_DB_ENGINE", "sqlite")
+
+# PRIVATE_MESSAGING_SQLITE_PROFILE=production opts into WAL, relaxed fsync,
+# bigger caches, a busy timeout and the in-process write queue
+# (chat/write_queue.py). Compare with `manage.py bench_sqlite`.
+SQLITE_PROFILE = os.environ.get("PRIVATE_MESSAGING_SQLITE_PROFILE", "default")
+SQLITE_WRITE_QUEUE = DB_ENGINE != "postgres" and SQLITE_PROFILE == "production"
+SQLITE_WRITE_QUEUE_MAX_BATCH = 200
+SQLITE_WRITE_QUEUE_MAX_WAIT = 0.005  # seconds to wait for more writes to join a batch
+
+
+def _database(name):
+    if DB_ENGINE == "postgres":
+        return {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': name,
+            'USER': os.environ.get("PRIVATE_MESSAGING_DB_USER", ""),
+            'PASSWORD': os.environ.get("PRIVATE_MESSAGING_DB_PASSWORD", ""),
+            'HOST': os.environ.get("PRIVATE_MESSAGING_DB_HOST", "localhost"),
+            'PORT': os.environ.get("PRIVATE_MESSAGING_DB_PORT", "5432"),
+        }
+    database = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': name,
     }
+    if SQLITE_PROFILE == "production":
+        database['OPTIONS'] = {
+            # Seconds a connection waits on a locked database before
+            # raising "database is locked"
+            'timeout': 20,
+            # Take the write lock at BEGIN instead of failing on upgrade
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                "PRAGMA journal_mode=WAL;"
+                "PRAGMA synchronous=NORMAL;"
+                "PRAGMA cache_size=-65536;"  # 64 MiB page cache
+                "PRAGMA mmap_size=268435456;"  # 256 MiB memory-mapped I/O
+                "PRAGMA temp_store=MEMORY;"
+            ),
+        }
+    return database
+
+
+DATABASES = {
+    'default': _database(os.environ.get("PRIVATE_MESSAGING_DB_NAME", BASE_DIR / 'db.sqlite3')),
 }
 
+# Read replicas: comma separated SQLite files or Postgres database names,
+# e.g. PRIVATE_MESSAGING_DB_REPLICAS="db_replica.sqlite3". Each one becomes a
+# 'replicaN' alias. With SQLite, refresh them with `manage.py sync_replicas`.
+for _index, _name in enumerate(
+    [n.strip() for n in os.environ.get("PRIVATE_MESSAGING_DB_REPLICAS", "").split(",") if n.strip()],
+    start=1,
+):
+    if DB_ENGINE != "postgres" and not os.path.isabs(_name):
+        _name = BASE_DIR / _name
+    DATABASES[f'replica{_index}'] = {**_database(_name), 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['chat.db_router.PrimaryReplicaRouter']
+
+# After a client writes, its reads stay on the primary for this many seconds.
+# The pins live in the cache, so replicas need PRIVATE_MESSAGING_CACHE=db (or
+# file if every worker runs on one host); with locmem the server won't start.
+REPLICA_STICKY_SECONDS = int(os.environ.get("PRIVATE_MESSAGING_REPLICA_STICKY_SECONDS", "5"))
+
+# Cache backend: PRIVATE_MESSAGING_CACHE=locmem (default, per process), or one
+# shared by all worker processes on a host: 'file' (a directory,
+# PRIVATE_MESSAGING_CACHE_LOCATION) or 'db' (a table in the primary database,
+# created with `manage.py createcachetable`).
+CACHE_BACKEND = os.environ.get("PRIVATE_MESSAGING_CACHE", "locmem")
+if CACHE_BACKEND == "file":
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get("PRIVATE_MESSAGING_CACHE_LOCATION", BASE_DIR / 'cache'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }}
+elif CACHE_BACKEND == "db":
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': os.environ.get("PRIVATE_MESSAGING_CACHE_LOCATION", 'chat_cache'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }}
+else:
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -99,14 +194,35 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chat.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_THROTTLE_CLASSES': [
+        'chat.throttling.TokenBucketThrottle',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 50,
 }
+# MessagePack next to JSON for clients that ask for it (needs msgpack, in requirements.txt)
+if importlib.util.find_spec('msgpack'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].insert(1, 'chat.renderers.MessagePackRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].insert(1, 'chat.renderers.MessagePackParser')
+
+# Response compression (chat/compression.py); gzip unless brotli (in requirements.txt) is installed
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_CONTENT_TYPES = ('application/json', 'application/msgpack')
+COMPRESSION_BROTLI_QUALITY = 4
 
 # JWT Settings
 SIMPLE_JWT = {
@@ -117,6 +233,43 @@ SIMPLE_JWT = {
     'ALGORITHM': 'HS256',
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
+# Per-process cache of JWT-authenticated users (chat/authentication.py)
+AUTH_USER_CACHE_SECONDS = int(os.environ.get('PRIVATE_MESSAGING_AUTH_USER_CACHE_SECONDS', 30))
+AUTH_USER_CACHE_SIZE = 10000
+# Rendered conversation lists per user (chat/list_cache.py)
+CONVERSATION_LIST_CACHE_SECONDS = 300
+# Square WebP avatar variants made by the chat.avatar_variants job (chat/tasks.py)
+AVATAR_SIZES = (64, 128, 256)
+
+# QR codes of chat-request links (chat/qr.py): pixel sizes, server-side cache and browser max-age
+QR_DEFAULT_SIZE = 320
+QR_MIN_SIZE = 64
+QR_MAX_SIZE = 1024
+QR_CACHE_SECONDS = 7 * 86400
+QR_MAX_AGE = 86400
+# Rendered message bubbles in conversation_detail (chat/bubbles.py); markup only, never message text
+MESSAGE_FRAGMENT_CACHE_SECONDS = 3600
+# Most operations one /chat/api/batch/ request may carry
+BATCH_MAX_OPERATIONS = 50
+
+# Delta sync (chat/sync.py)
+SYNC_PAGE_SIZE = 500
+SYNC_EVENT_RETENTION_DAYS = int(os.environ.get('PRIVATE_MESSAGING_SYNC_EVENT_RETENTION_DAYS', 30))
+# Concurrent Postgres transactions can commit out of id order; hold back the newest events
+SYNC_SETTLE_SECONDS = 2 if DB_ENGINE == 'postgres' else 0
+
+# Online/typing indicators (chat/presence.py). MemoryBackend is per process;
+# multi-process deployments use 'chat.presence.CacheBackend' with a shared cache.
+PRESENCE_BACKEND = os.environ.get('PRIVATE_MESSAGING_PRESENCE_BACKEND', 'chat.presence.MemoryBackend')
+PRESENCE_BACKEND_OPTIONS = {}
+PRESENCE_ONLINE_SECONDS = 45
+PRESENCE_TYPING_SECONDS = 6
+
+# Background jobs (chat/jobs.py, `manage.py run_worker`)
+JOB_VISIBILITY_TIMEOUT = 300  # seconds a claimed job stays locked to its worker
+JOB_RETRY_BACKOFF_SECONDS = 10  # doubled on every further attempt
+JOB_RETRY_BACKOFF_MAX = 3600
+JOB_KEEP_FINISHED_DAYS = 7
 
 # CORS Settings
 CORS_ALLOW_ALL_ORIGINS = DEBUG  # only allow all origins in dev
@@ -127,6 +280,87 @@ ENCRYPTION_KEY = os.environ.get(
     "PRIVATE_MESSAGING_ENCRYPTION_KEY",
     b'9YeKt6gEQh8gYBlLutD_I6C1VezJILglDRcDDm0-nmE='
 )
+# Previous keys (comma separated), still accepted for decryption while the
+# `chat.reencrypt_messages` job rewrites old messages with ENCRYPTION_KEY
+ENCRYPTION_OLD_KEYS = [k for k in os.environ.get("PRIVATE_MESSAGING_ENCRYPTION_OLD_KEYS", "").split(",") if k]
+
+# Message archival (chat/archive.py, `manage.py archive_messages`)
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get("PRIVATE_MESSAGING_ARCHIVE_AFTER_DAYS", "365"))
+MESSAGE_ARCHIVE_BATCH_SIZE = 500
+
+# Purge of deleted messages (chat/purge.py, `manage.py purge_messages`)
+MESSAGE_PURGE_GRACE_DAYS = int(os.environ.get("PRIVATE_MESSAGING_PURGE_GRACE_DAYS", "30"))
+MESSAGE_PURGE_BATCH_SIZE = 500
+
+# Disappearing messages: the timers a conversation can choose (seconds), and
+# in what batches the `chat.expire_messages` job deletes expired ones. The job
+# runs at the next expiry, or after MESSAGE_EXPIRY_MAX_DELAY_SECONDS at most.
+DISAPPEARING_MESSAGE_TIMERS = (300, 3600, 86400, 7 * 86400, 30 * 86400)
+MESSAGE_EXPIRY_MAX_DELAY_SECONDS = 3600
+MESSAGE_EXPIRY_BATCH_SIZE = 500
+
+# User search (chat/user_search.py): results per query, candidates cached per
+# normalized query, and how common a trigram may be before fuzzy search ignores it
+USER_SEARCH_LIMIT = 10
+USER_SEARCH_MIN_LENGTH = 2
+USER_SEARCH_CANDIDATES = 50
+USER_SEARCH_CACHE_SECONDS = 30
+USER_SEARCH_GRAM_MAX_USERS = 5000
+
+# Event bus (chat/events.py): 'unix' reaches every worker process on this host
+# through Unix sockets in EVENT_BUS_SOCKET_DIR; 'inprocess' stays within one
+# process (tests, single-process servers). A dotted path selects another backend.
+EVENT_BUS = os.environ.get("PRIVATE_MESSAGING_EVENT_BUS", "unix" if os.name == "posix" else "inprocess")
+EVENT_BUS_SOCKET_DIR = os.environ.get("PRIVATE_MESSAGING_EVENT_BUS_DIR", BASE_DIR / 'run' / 'events')
+# Longest ?wait= a long poll of the async polling endpoints may hold a request
+EVENT_LONG_POLL_MAX_SECONDS = 25
+
+# Polling hints (chat/polling.py): (seconds since the conversation last changed,
+# ms until the next poll), first match wins; longer idle gets POLL_IDLE_INTERVAL_MS.
+# Hidden tabs wait at least POLL_HIDDEN_INTERVAL_MS, below PRESENCE_ONLINE_SECONDS
+# so their users stay online.
+POLL_INTERVALS = ((60, 2000), (600, 5000), (3600, 15000))
+POLL_IDLE_INTERVAL_MS = 30000
+POLL_HIDDEN_INTERVAL_MS = 30000
+POLL_JITTER = 0.1
+
+# Rate limits (chat/throttling.py): scope -> (requests per second, burst), per
+# user or, logged out, per client address. THROTTLE_CACHE holds the buckets;
+# with the default locmem cache every worker process limits on its own.
+# PRIVATE_MESSAGING_THROTTLE=0 turns the limits off (benchmarks, load tests).
+THROTTLE_RATES = {
+    'api': (5, 100),
+    'poll': (4, 120),
+    'send': (1, 30),
+    'search': (3, 30),
+    'auth': (0.1, 10),
+} if os.environ.get('PRIVATE_MESSAGING_THROTTLE', '1') != '0' else {}
+THROTTLE_CACHE = 'default'
+# Reverse proxies / load balancers in front of the app. Logged-out clients are
+# limited by the address the outermost one put in X-Forwarded-For; with 0 the
+# header is ignored (it can be forged) and REMOTE_ADDR is used.
+TRUSTED_PROXIES = int(os.environ.get('PRIVATE_MESSAGING_TRUSTED_PROXIES', '0'))
+
+# Instrumentation (chat/metrics.py). /metrics is open to staff users and to
+# scrapers sending "Authorization: Bearer <METRICS_TOKEN>".
+METRICS_TOKEN = os.environ.get("PRIVATE_MESSAGING_METRICS_TOKEN", "")
+METRICS_SLOW_REQUEST_SECONDS = float(os.environ.get("PRIVATE_MESSAGING_SLOW_REQUEST_SECONDS", "1.0"))
+
+# On-demand profiling (chat/profiling.py)
+PROFILE_CAPTURE_DIR = BASE_DIR / 'profile_captures'
+PROFILE_CAPTURE_KEEP = 50
+PROFILE_TOKEN_MAX_AGE = 3600  # seconds an X-Profile token stays valid
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'chat.slow_requests': {'handlers': ['console'], 'level': 'WARNING'},
+    },
+}
 
 # Login redirects
 LOGIN_REDIRECT_URL = '/chat/'
@@ -9,10 +9,12 @@ def home(request):
 
 from django.conf import settings
 from django.conf.urls.static import static
+from chat.views import metrics
 
 urlpatterns = [
     path('', home),
     path('admin/', admin.site.urls),
     path('chat/', include('chat.urls')),
     path('accounts/', include('django.contrib.auth.urls')),
+    path('metrics', metrics, name='metrics'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -10,7 +10,12 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'private_messaging.settings')
 
 application = get_wsgi_application()
+
+# Import the views now, at boot (and before a preforking server forks),
+# rather than on the first request
+get_resolver().url_patterns